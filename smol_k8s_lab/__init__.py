@@ -23,16 +23,15 @@ from .bitwarden.bw_cli import BwCLI
 from .bitwarden.tui.bitwarden_app import BitwardenCredentialsApp
 from .constants import KUBECONFIG, VERSION
 from .k8s_apps import (setup_oidc_provider, setup_base_apps,
-                       setup_k8s_secrets_management, setup_federated_apps)
-from .k8s_apps.monitoring.prometheus_stack import configure_prometheus_stack
-from .k8s_apps.networking.netmaker import configure_netmaker
+                       setup_k8s_secrets_management, setup_apps)
 from .k8s_apps.operators import setup_operators
-from .k8s_apps.operators.minio import configure_minio_tenant
-from .k8s_apps.social.libre_translate import configure_libretranslate
-from .k8s_apps.valkey import configure_valkey
-from .k8s_distros import create_k8s_distro, delete_cluster
+from .k8s_distros import (create_k8s_distro, delete_cluster,
+                          check_contexts_for_cluster)
+from .k8s_distros.snapshots import (snapshot_key, snapshot_path,
+                                    save_k3d_snapshot, wait_for_restore)
+from .k8s_tools.argocd_util import ArgoCD
 from .tui import launch_config_tui
-from .utils.rich_cli.console_logging import CONSOLE, sub_header, header
+from .utils.rich_cli.console_logging import CONSOLE
 from .utils.rich_cli.help_text import RichCommand, options_help
 from .utils.run.final_cmd import run_final_cmd
 
@@ -189,8 +188,10 @@ def main(config: str = "",
 
     # if we have bitwarden credetials unlock the vault
     if bitwarden_credentials:
-        strat = USR_CFG['smol_k8s_lab']['local_password_manager']['duplicate_strategy']
-        bw = BwCLI(**bitwarden_credentials, duplicate_strategy=strat)
+        password_manager = USR_CFG['smol_k8s_lab']['local_password_manager']
+        bw = BwCLI(**bitwarden_credentials,
+                   duplicate_strategy=password_manager['duplicate_strategy'],
+                   serve=password_manager.get('bw_serve', False))
         bw.unlock()
     else:
         bw = None
@@ -210,9 +211,22 @@ def main(config: str = "",
             selected_distro = distro
             break
 
+    # with golden snapshots, a new k3d cluster with the same base app config as
+    # a snapshot we took before starts from it, instead of installing them all
+    snapshot = ""
+    snapshot_id = ""
+    if selected_distro == "k3d" and metadata.get('golden_snapshot', False):
+        if metadata['nodes']['control_plane'] > 1:
+            log.warning("Golden snapshots only work with one control plane "
+                        "node, so we're installing the base apps as usual")
+        else:
+            snapshot_id = snapshot_key(cluster_name, metadata, apps, SECRETS)
+            if not check_contexts_for_cluster(cluster_name, selected_distro):
+                snapshot = snapshot_path(snapshot_id)
+
     # install the actual KIND, k3s, or k3d cluster
     k8s_obj = create_k8s_distro(cluster_name, selected_distro, metadata,
-                                metallb_enabled, cilium_enabled)
+                                metallb_enabled, cilium_enabled, snapshot)
 
     # run the final command immediately after k8s is up, if it's running in a
     # new tab, window, or pane
@@ -227,17 +241,33 @@ def main(config: str = "",
     # check if argo is enabled
     argo_enabled = apps['argo_cd']['enabled']
 
-    # installs all the base apps: metallb/cilium, ingess-nginx, cert-manager, and argocd
-    argocd = setup_base_apps(k8s_obj,
-                             distro,
-                             apps.get('cilium', {}),
-                             apps['metallb'],
-                             apps.get('ingress_nginx', {}),
-                             apps.get('cert_manager', {}),
-                             apps.get('cnpg_operator', {}),
-                             apps['argo_cd'],
-                             SECRETS,
-                             bw)
+    if snapshot:
+        # the base apps are already in the snapshot, we just wait for them
+        log.info(f"Started {cluster_name} from golden snapshot {snapshot_id}")
+        argocd_namespace = apps['argo_cd']['argo']['namespace']
+        wait_for_restore(k8s_obj, argocd_namespace if argo_enabled else "")
+        argocd = None
+        if argo_enabled:
+            argocd = ArgoCD(argocd_namespace,
+                            SECRETS['argo_cd_hostname'],
+                            k8s_obj,
+                            secrets_backend="bitwarden" if bw else "")
+    else:
+        # installs all the base apps: metallb/cilium, ingess-nginx, cert-manager, and argocd
+        argocd = setup_base_apps(k8s_obj,
+                                 distro,
+                                 apps.get('cilium', {}),
+                                 apps['metallb'],
+                                 apps.get('ingress_nginx', {}),
+                                 apps.get('cert_manager', {}),
+                                 apps.get('cnpg_operator', {}),
+                                 apps['argo_cd'],
+                                 SECRETS,
+                                 bw)
+
+        # save a golden snapshot for next time, if we don't have one yet
+        if snapshot_id and not snapshot_path(snapshot_id):
+            save_k3d_snapshot(cluster_name, snapshot_id)
 
     # 🦑 Install Argo CD: continuous deployment app for k8s
     if argo_enabled:
@@ -288,74 +318,20 @@ def main(config: str = "",
         # we need this for all the oidc apps we need to create
         zitadel_hostname = SECRETS.get('zitadel_hostname', "")
 
-        # setup netmaker, a wireguard vpn management web interface
-        netmaker_dict = apps.pop('netmaker', {'enabled': False})
-        # only do this if the user has smol-k8s-lab init enabled
-        if netmaker_dict['enabled']:
-            configure_netmaker(argocd,
-                               netmaker_dict,
-                               'zitadel',
-                               zitadel_hostname,
-                               bw,
-                               oidc_obj)
-
-        # this is currently just to make sure that grafana zitadel auth gets set up
-        prometheus_stack = apps.pop('prometheus', {'enabled': False})
-        if prometheus_stack['enabled']:
-            configure_prometheus_stack(argocd, prometheus_stack, oidc_obj, bw)
-
-        # set up self hosted translation
-        libre_translate_dict = apps.pop('libre_translate', {})
-        if libre_translate_dict:
-            libretranslate_api_key = configure_libretranslate(argocd,
-                                                              libre_translate_dict,
-                                                              bw)
-        else:
-            libretranslate_api_key = ""
-
-        # setup nextcloud, home assistant, mastodon, gotosocial, and matrix
-        setup_federated_apps(
-                argocd,
-                api_tls_verify,
-                apps.pop('home_assistant', {}),
-                apps.pop('nextcloud', {}),
-                apps.pop('mastodon', {}),
-                apps.pop('gotosocial', {}),
-                apps.pop('matrix', {}),
-                apps.pop('peertube', {}),
-                pvc_storage_class,
-                zitadel_hostname,
-                oidc_obj,
-                libretranslate_api_key,
-                bw
-                )
-
-        # stand alone valkey
-        if apps.get('valkey'):
-            configure_valkey(argocd, apps.pop('valkey'), bw)
-
-        if apps.get('valkey_cluster'):
-            configure_valkey(argocd, apps.pop('valkey_cluster'), bw)
-
-        # we support creating a default minio tenant with oidc enabled
-        # we set it up here in case other apps rely on it
-        minio_tenant_config = apps.pop('minio_tenant', {})
-        if minio_tenant_config and minio_tenant_config.get('enabled', False):
-            configure_minio_tenant(argocd,
-                                   minio_tenant_config,
-                                   api_tls_verify,
-                                   zitadel_hostname,
-                                   oidc_obj,
-                                   bw)
-
         # after argocd, zitadel, bweso, and vouch are up, we install all apps
-        # as Argo CD Applications
-        header("Installing the rest of the Argo CD apps")
-        for app_key, app_meta in apps.items():
-            if app_meta['enabled']:
-                argo_app = app_key.replace('_', '-')
-                sub_header(f"Installing app: {argo_app}")
-                argocd.install_app(argo_app, app_meta['argo'])
+        # as Argo CD Applications, as many at a time as the user allows
+        max_parallel = USR_CFG['smol_k8s_lab'].get('max_parallel_app_installs', 4)
+        setup_apps(argocd,
+                   apps,
+                   api_tls_verify,
+                   pvc_storage_class,
+                   zitadel_hostname,
+                   oidc_obj,
+                   bw,
+                   max_parallel)
+
+        # write any appset secret values that no app install picked up yet
+        argocd.flush_appset_secret()
 
         # lock the bitwarden vault on the way out, to be polite :3
         if bw:
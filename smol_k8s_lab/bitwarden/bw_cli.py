@@ -12,13 +12,22 @@ Example:
                         password="fakepassword")
         bw.lock()
 """
+import atexit
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 import json
 import logging as log
+import requests
 from rich.prompt import Prompt
 from shutil import which
+import socket
+from subprocess import Popen, DEVNULL, TimeoutExpired
 from sys import exit
+from threading import RLock
+from time import monotonic, sleep
 from os import environ as env
+from ..utils.passwords import DEFAULT_PASSWORD_POLICY, PasswordPolicy, create_password
 from ..utils.run.subproc import subproc
 from .tui.bitwarden_existing_item_app import AskUserForDuplicateStrategy
 
@@ -35,16 +44,21 @@ def create_custom_field(custom_field_name: str, value: str) -> dict:
    return custom_field
 
 
+
 class BwCLI():
     """
     Python Wrapper for the Bitwarden cli
     """
     def __init__(self, password: str, client_id: str, client_secret: str,
-                 duplicate_strategy: str = "ask"):
+                 duplicate_strategy: str = "ask", serve: bool = False,
+                 password_policy: PasswordPolicy = DEFAULT_PASSWORD_POLICY):
         """
         for storing the session token, credentials, and duplicate_strategy
 
         duplicate_strategy: str, must be one of: edit, ask, duplicate, no_action
+        serve: bool, if True, start "bw serve" on localhost once we're unlocked
+               and send every request to it, instead of running bw every time
+        password_policy: PasswordPolicy for the passwords generate() returns
         """
         self.bw_path = str(which("bw"))
         log.debug(f"self.bw_path is {self.bw_path}")
@@ -72,13 +86,102 @@ class BwCLI():
         self.client_id = client_id
         self.client_secret = client_secret
         self.duplicate_strategy = duplicate_strategy
+        self.password_policy = password_policy
+
+        # apps are installed concurrently, but the bw cli shares one local
+        # vault file, and only one duplicate strategy dialog can be shown
+        self.cli_lock = RLock()
+
+        # the bw serve process, and one keep-alive session to talk to it with
+        self.serve = serve
+        self.server = None
+        self.server_url = ""
+        self.server_session = None
+
+        # every item in the vault by id, and lists of item ids by lowercase
+        # name and uri, so we don't need to ask bw for each item we look up
+        self.items = None
+        self.item_names = {}
+        self.item_uris = {}
+
+    def start_server(self, timeout: int = 30) -> None:
+        """
+        starts "bw serve" on a free localhost port with our session token, and
+        waits for it to answer. It's stopped by lock() or when we exit
+        """
+        # ask the os for a free port
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+
+        log.info(f"Starting bw serve on localhost:{port}")
+        self.server = Popen([self.bw_path, "serve",
+                             "--hostname", "localhost",
+                             "--port", str(port)],
+                            env=self.env, stdout=DEVNULL, stderr=DEVNULL)
+        atexit.register(self.stop_server)
+
+        self.server_url = f"http://localhost:{port}"
+        self.server_session = requests.Session()
+
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                self.api("GET", "/status")
+                return
+            except requests.ConnectionError:
+                if self.server.poll() is not None or monotonic() > deadline:
+                    self.stop_server()
+                    raise Exception("bw serve didn't start, so we can't talk "
+                                    "to your Bitwarden vault")
+                sleep(0.25)
+
+    def stop_server(self) -> None:
+        """
+        stops the bw serve process, if we started one
+        """
+        if not self.server:
+            return
+
+        log.debug("Stopping bw serve")
+        self.server.terminate()
+        try:
+            self.server.wait(timeout=10)
+        except TimeoutExpired:
+            self.server.kill()
+        self.server_session.close()
+        self.server = None
+
+    def api(self, method: str, endpoint: str, **kwargs) -> dict:
+        """
+        sends a request to bw serve and returns the response json, which looks
+        like the output of a bw cli command run with --response. Raises an
+        Exception with bw serve's message if the request wasn't successful
+        """
+        res = self.server_session.request(method,
+                                          self.server_url + endpoint,
+                                          timeout=120,
+                                          **kwargs)
+        try:
+            response = res.json()
+        except ValueError:
+            response = {"success": False, "message": res.text}
+
+        if not response.get("success"):
+            message = response.get("message") or f"HTTP {res.status_code}"
+            raise Exception(f"bw serve {method} {endpoint} failed: {message}")
+        return response
 
     def sync(self) -> None:
         """
         syncs your bitwaren vault on initialize of this class
         """
-        res = subproc([f"{self.bw_path} sync"], env=self.env)
-        log.info(res)
+        with self.cli_lock:
+            if self.server:
+                res = self.api("POST", "/sync").get("data", {}).get("title", "")
+            else:
+                res = subproc([f"{self.bw_path} sync"], env=self.env)
+            log.info(res)
 
     def __get_credential__(self, credential: str) -> str:
         """
@@ -92,6 +195,8 @@ class BwCLI():
         generate a new password. Takes special_characters bool.
         """
         log.info('Checking if you are logged in...')
+        if self.server:
+            return self.api("GET", "/status")['data']['template']['status']
         return json.loads(subproc(["bw status"], env=self.env))['status']
 
     def unlock(self) -> None:
@@ -133,6 +238,12 @@ class BwCLI():
             log.info(f"[green]bw status[/] returned '{status}', so we won't "
                      "unlock the Bitwarden vault before starting.")
 
+        if self.serve and not self.server:
+            self.start_server()
+
+        # sync once, and then look up items in our own index for the whole run
+        self.refresh()
+
     def lock(self) -> None:
         """
         lock bitwarden vault, only if the user didn't have a session env var,
@@ -140,163 +251,211 @@ class BwCLI():
         """
         if self.delete_session:
             log.info('Locking the Bitwarden vault...')
-            subproc([f"{self.bw_path} lock"], env=self.env)
+            if self.server:
+                self.api("POST", "/lock")
+            else:
+                subproc([f"{self.bw_path} lock"], env=self.env)
             log.info('Bitwarden vault locked.')
         else:
             log.debug("We didn't lock the Bitwarden vault when we were done, "
                       "because we didn't set the BW_SESSION env var, so we don't"
                       " want to be rude.")
 
+        self.stop_server()
+
     def generate(self, special_characters: bool = False) -> str:
         """
-        generate a new password. Takes special_characters bool.
+        generate a new password with our password policy, locally, so we
+        don't need to run bw. Takes special_characters bool.
         """
         log.debug('Generating a new password...')
+        return create_password(special_characters, policy=self.password_policy)
+
+    def refresh(self) -> None:
+        """
+        syncs the vault and rebuilds our index of all of its items. We do this
+        once when we unlock, so only call this if something outside of
+        smol-k8s-lab changed the vault during a run
+        """
+        with self.cli_lock:
+            self.sync()
+            if self.server:
+                items = self.api("GET", "/list/object/items")['data']['data']
+            else:
+                items = json.loads(subproc([f"{self.bw_path} list items"],
+                                           quiet=True,
+                                           env=self.env))
+
+            self.items = {}
+            self.item_names = {}
+            self.item_uris = {}
+            for item in items:
+                self.index_item(item)
+            log.debug(f"Indexed {len(self.items)} Bitwarden items")
+
+    def index_item(self, item: dict) -> None:
+        """
+        adds an item to our index of the vault by id, name, and uri, or updates
+        it if it's already there
+        """
+        with self.cli_lock:
+            if self.items is None:
+                self.refresh()
 
-        command = "bw generate --length 32 --uppercase --lowercase --number"
-        if special_characters:
-            command += " --special"
+            # remove the old name and uris, in case they changed
+            old_item = self.items.get(item['id'], None)
+            if old_item:
+                for index, key in self.item_keys(old_item):
+                    index[key].remove(item['id'])
 
-        password = subproc([command], quiet=True)
-        log.debug('New password generated.')
-        return password
+            self.items[item['id']] = item
+            for index, key in self.item_keys(item):
+                index.setdefault(key, []).append(item['id'])
 
-    def get_item(self, item_name: str, sync_first: bool = True) -> list:
+    def item_keys(self, item: dict) -> list:
         """
-        Get Item and return False if it does not exist else return the item ID
+        returns a list of (index dict, key) for the name and each uri of an item
+        """
+        keys = [(self.item_names, item['name'].lower())]
+        for uri in (item.get('login', None) or {}).get('uris', None) or []:
+            if uri.get('uri', None):
+                keys.append((self.item_uris, uri['uri'].lower()))
+        return keys
 
-        Required Args:
-            - item_name: str of name of item
+    def find_items(self, item_name: str) -> list[dict]:
         """
-        # always sync vault before checking anything, unless otherwise stated
-        if sync_first:
-            self.sync()
+        returns a list of the items in the vault with an id, name, or uri of
+        item_name, from our index instead of the bw cli
+        """
+        with self.cli_lock:
+            if self.items is None:
+                self.refresh()
 
-        # go get the actual item
-        response = json.loads(
-                subproc([f'{self.bw_path} get item {item_name} --response'],
-                        error_ok=True,
-                        quiet=True,
-                        env=self.env
-                        )
-                )
+            if item_name in self.items:
+                return [self.items[item_name]]
 
-        message = response.get("message", "")
+            item_ids = (self.item_names.get(item_name.lower(), None) or
+                        self.item_uris.get(item_name.lower(), []))
+            return [self.items[item_id] for item_id in item_ids]
 
-        # if there is no item, just return False
-        if message == "Not found.":
-            log.debug(response)
-            return False, None
+    def get_item(self, item_name: str, sync_first: bool = False) -> list:
+        """
+        Get Item and return False if it does not exist else return the item ID
 
-        elif 'More than one result was found' in message:
-            item_list = response['data']
-            log.debug(f"found more than 1 entry for {item_name}: {item_list}")
+        Required Args:
+            - item_name: str of name of item
+        Optional Args:
+            - sync_first: bool, sync the vault and refresh our index first
+        """
+        with self.cli_lock:
+            # we sync when we unlock, so only sync again if we're asked to
+            if sync_first:
+                self.refresh()
 
-            # make a list of each full item
-            list_for_dialog = []
-            for id in item_list:
-                list_for_dialog.append(self.get_item(id)[0])
+            items = self.find_items(item_name)
 
-            # ask the user what to do
-            user_response = AskUserForDuplicateStrategy(list_for_dialog,
-                                                        item_name).run()
+            # if there is no item, just return False
+            if not items:
+                log.debug(f"No Bitwarden items found for {item_name}")
+                return False, None
 
-            action = user_response[0]
-            always_do_action = user_response[1]
-            item = user_response[2]
+            elif len(items) > 1:
+                log.debug(f"found more than 1 entry for {item_name}: "
+                          f"{[item['id'] for item in items]}")
 
-            # if they always want to do this, then set self.duplicate_strategy
-            if always_do_action:
-                # NOTE: we still always ask if there's more than 1 entry returned
-                self.duplicate_strategy = action
+                # ask the user what to do
+                user_response = AskUserForDuplicateStrategy(items,
+                                                            item_name).run()
 
-            return item, action
-        else:
-            return response['data'], self.duplicate_strategy
+                action = user_response[0]
+                always_do_action = user_response[1]
+                item = user_response[2]
 
-    def create_login(self,
-                     name: str = "",
-                     item_url: str = "",
-                     user: str = "",
-                     password: str = "",
-                     fields: list = [],
-                     org: str = None,
-                     collection: str = None,
-                     strategy: str = None) -> str:
-        """
-        Create login item to store a set of credentials for one site.
-        Required Args:
-            - name:        str of the name of the item to create in the vault
-        Optional Args:
-            - user:        str of username to use for login item
-            - password:    str of password you want to use for login item
-            - item_url:    str of URL you want to use the credentials for
-            - org:         str of organization to use for collection
-            - collection:  str collection inside organization to user
-            - fields:      list of {key: value} dicts for custom fields
-            - strategy:    str that defaults to self.duplicate_strategy
+                # if they always want to do this, then set self.duplicate_strategy
+                if always_do_action:
+                    # NOTE: we still always ask if there's more than 1 entry returned
+                    self.duplicate_strategy = action
 
-        Returns string of the item id created or updated
+                return item, action
+            else:
+                return items[0], self.duplicate_strategy
+
+    def resolve_login(self,
+                      name: str = "",
+                      item_url: str = "",
+                      user: str = "",
+                      password: str = "",
+                      fields: list = [],
+                      org: str = None,
+                      collection: str = None,
+                      strategy: str = None) -> tuple:
         """
-        # don't edit anything by default
-        edit = False
-
-        # fix naming for bitwarden items to inlude the url AND name
-        if name:
-            item_name = name
-            if item_url:
-                item_name += f"-{item_url}"
-        else:
-            item_name = item_url
+        checks our index for an existing login item, and decides what to do
+        with it based on the duplicate strategy. Takes the same args as
+        create_login.
 
-        # go check for existing items
-        item_res = self.get_item(item_name)
-        item = item_res[0]
+        Returns a tuple of (action, item), where action is "create", "edit",
+        or None if we shouldn't do anything, and item is the item to save
+        """
+        with self.cli_lock:
+            # fix naming for bitwarden items to inlude the url AND name
+            if name:
+                item_name = name
+                if item_url:
+                    item_name += f"-{item_url}"
+            else:
+                item_name = item_url
 
-        if not strategy:
-            strategy = item_res[1]
+            # go check for existing items
+            item_res = self.get_item(item_name)
+            item = item_res[0]
 
-        if item:
-            if strategy == "ask":
-                user_response = AskUserForDuplicateStrategy(item,
-                                                            item_name).run()
-                strategy = user_response[0]
-
-                # if the user set "always do this action"
-                if user_response[1] is True:
-                   # NOTE: we still always ask if there's more than 1 entry returned
-                   self.duplicate_strategy = strategy
-
-            if strategy == 'edit':
-                log.info("bitwarden.duplicate_strategy set to edit, so we will "
-                         f"edit the existing item: {name}")
-                edit = True
-
-            elif strategy == 'duplicate':
-                msg = (f"😵 Item named {name} already exists in your Bitwarden"
-                       " vault and bitwarden.duplicate_strategy is set to duplicate."
-                       " We will create the item anyway, but the Bitwarden ESO "
-                       "Provider may have trouble finding it :(")
-                log.warn(msg)
-
-            elif strategy == "no_action":
-                log.info(
-                    "We've encounted an existing entry for the item we were going "
-                    " to create. duplicate_strategy is set to 'no_action', so we "
-                    "will not replace or edit it nor will we create a new item."
-                    f"item: {item}"
-                    )
-                return
+            if not strategy:
+                strategy = item_res[1]
 
-        # create new item
-        if not edit:
             if item:
-                log.info(f'Not editing Bitwarden item "{item_name}", because we '
-                         'were instructed to create a duplicate.')
+                if strategy == "ask":
+                    user_response = AskUserForDuplicateStrategy(item,
+                                                                item_name).run()
+                    strategy = user_response[0]
+
+                    # if the user set "always do this action"
+                    if user_response[1] is True:
+                       # NOTE: we still always ask if there's more than 1 entry returned
+                       self.duplicate_strategy = strategy
+
+                if strategy == 'edit':
+                    log.info("bitwarden.duplicate_strategy set to edit, so we will "
+                             f"edit the existing item: {name}")
+                    log.info(f'Updating existing Bitwarden login item "{item_name}"...')
+                    # don't change the item in our index unless the edit works
+                    item = deepcopy(item)
+                    item['login']['password'] = password
+                    item['login']['username'] = user
+                    item['fields'] = fields
+                    return "edit", item
+
+                elif strategy == 'duplicate':
+                    msg = (f"😵 Item named {name} already exists in your Bitwarden"
+                           " vault and bitwarden.duplicate_strategy is set to duplicate."
+                           " We will create the item anyway, but the Bitwarden ESO "
+                           "Provider may have trouble finding it :(")
+                    log.warn(msg)
+                    log.info(f'Not editing Bitwarden item "{item_name}", because we '
+                             'were instructed to create a duplicate.')
+
+                elif strategy == "no_action":
+                    log.info(
+                        "We've encounted an existing entry for the item we were going "
+                        " to create. duplicate_strategy is set to 'no_action', so we "
+                        "will not replace or edit it nor will we create a new item."
+                        f"item: {item}"
+                        )
+                    return None, item
             else:
                 log.info(f'Creating Bitwarden login item "{item_name}"')
 
-            login_obj = json.dumps({
+            login_obj = {
                 "organizationId": org,
                 "collectionIds": collection,
                 "folderId": None,
@@ -313,31 +472,108 @@ class BwCLI():
                 "secureNote": None,
                 "card": None,
                 "identity": None,
-                "reprompt": 0})
+                "reprompt": 0}
 
-            encodedBytes = base64.b64encode(login_obj.encode("utf-8"))
-            encodedStr = str(encodedBytes, "utf-8")
+            return "create", login_obj
 
-            cmd = f"{self.bw_path} create item {encodedStr}"
+    def save_item(self, action: str, item: dict) -> str:
+        """
+        creates or edits an item in the vault, depending on if action is
+        "create" or "edit", adds it to our index, and returns its id
+        """
+        if self.server:
+            if action == "edit":
+                saved_item = self.api("PUT", f"/object/item/{item['id']}",
+                                      json=item)['data']
+            else:
+                saved_item = self.api("POST", "/object/item", json=item)['data']
+            self.index_item(saved_item)
+            return saved_item['id']
+
+        encodedBytes = base64.b64encode(json.dumps(item).encode("utf-8"))
+        encodedStr = str(encodedBytes, "utf-8")
 
-        # edit existing item
+        if action == "edit":
+            cmd = f"{self.bw_path} edit item {item['id']} {encodedStr}"
         else:
-            log.info(f'Updating existing Bitwarden login item "{item_name}"...')
-            item['login']['password'] = password
-            item['login']['username'] = user
-            item['fields'] = fields
+            cmd = f"{self.bw_path} create item {encodedStr}"
 
-            encodedBytes = base64.b64encode(json.dumps(item).encode("utf-8"))
-            encodedStr = str(encodedBytes, "utf-8")
+        # the bw cli shares one local vault file, so only one at a time
+        with self.cli_lock:
+            # edit OR create the item
+            bitwarden_return_item = subproc([cmd + " --response"],
+                                            quiet=True,
+                                            env=self.env)
+            log.debug(bitwarden_return_item)
 
-            cmd = f"{self.bw_path} edit item {item['id']} {encodedStr}"
+            # the cli returns the whole item, so we can keep our index up to date
+            saved_item = json.loads(bitwarden_return_item)['data']
+            self.index_item(saved_item)
+            return saved_item['id']
+
+    def create_login(self,
+                     name: str = "",
+                     item_url: str = "",
+                     user: str = "",
+                     password: str = "",
+                     fields: list = [],
+                     org: str = None,
+                     collection: str = None,
+                     strategy: str = None) -> str:
+        """
+        Create login item to store a set of credentials for one site.
+        Required Args:
+            - name:        str of the name of the item to create in the vault
+        Optional Args:
+            - user:        str of username to use for login item
+            - password:    str of password you want to use for login item
+            - item_url:    str of URL you want to use the credentials for
+            - org:         str of organization to use for collection
+            - collection:  str collection inside organization to user
+            - fields:      list of {key: value} dicts for custom fields
+            - strategy:    str that defaults to self.duplicate_strategy
 
+        Returns string of the item id created or updated
+        """
+        with self.cli_lock:
+            action, item = self.resolve_login(name, item_url, user, password,
+                                              fields, org, collection, strategy)
+            if action:
+                return self.save_item(action, item)
 
-        # edit OR create the item
-        bitwarden_return_item = subproc([cmd + " --response"], quiet=True, env=self.env)
-        log.debug(bitwarden_return_item)
+    def create_logins(self, logins: dict, max_workers: int = 4) -> dict:
+        """
+        Create or edit a batch of login items, like all the items for one app.
 
-        if edit:
-            return item['id']
+        Required Args:
+            - logins:      dict of {key: dict of create_login args}
+        Optional Args:
+            - max_workers: int, max items to save at once with bw serve
+
+        Checks every item for duplicates first, so any dialogs are shown up
+        front, and then saves them all. With bw serve, the items are saved
+        max_workers at a time, otherwise one at a time, because the bw cli
+        shares one local vault file.
+
+        Returns a dict of {key: item id created or updated}
+        """
+        with self.cli_lock:
+            resolved = {key: self.resolve_login(**login)
+                        for key, login in logins.items()}
+
+        to_save = {key: (action, item) for key, (action, item) in resolved.items()
+                   if action}
+        # like create_login, there's no id for items we didn't do anything with
+        item_ids = {key: None for key in resolved if key not in to_save}
+
+        if self.server:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                futures = {key: executor.submit(self.save_item, *action_item)
+                           for key, action_item in to_save.items()}
+                item_ids.update({key: future.result()
+                                 for key, future in futures.items()})
         else:
-            return json.loads(bitwarden_return_item)['data']['id']
+            item_ids.update({key: self.save_item(*action_item)
+                             for key, action_item in to_save.items()})
+
+        return {key: item_ids[key] for key in logins}
@@ -6,6 +6,7 @@ DESCRIPTION: installs helm repos, updates them, and installs charts for metallb,
     LICENSE: GNU AFFERO GENERAL PUBLIC LICENSE Version 3
 """
 # external libraries
+from functools import partial
 import logging as log
 from rich.prompt import Prompt
 
@@ -30,9 +31,36 @@ from .social.gotosocial import configure_gotosocial
 from .social.home_assistant import configure_home_assistant
 from .social.matrix import configure_matrix
 from .social.mastodon import configure_mastodon
-from .social.nextcloud import configure_nextcloud
+from .social.nextcloud import ask_for_smtp_values, configure_nextcloud
 from .social.peertube import configure_peertube
-from ..utils.rich_cli.console_logging import header
+from .monitoring.prometheus_stack import configure_prometheus_stack
+from .networking.netmaker import configure_netmaker
+from .operators.minio import configure_minio_tenant
+from .social.libre_translate import configure_libretranslate
+from .valkey import configure_valkey
+from ..utils.dag import run_dag
+from ..utils.rich_cli.console_logging import header, sub_header
+
+# apps that need other apps to be up before they can be installed. Apps that
+# aren't enabled, or that were already setup before Argo CD apps are installed
+# (like zitadel, k8up, or the cnpg operator), are ignored
+APP_DEPENDENCIES = {
+        "netmaker": ["zitadel"],
+        "prometheus": ["prometheus_crds", "zitadel"],
+        "home_assistant": ["k8up"],
+        "nextcloud": ["zitadel", "cnpg_operator", "k8up"],
+        "mastodon": ["libre_translate", "cnpg_operator", "k8up"],
+        "gotosocial": ["zitadel", "cnpg_operator", "k8up"],
+        "peertube": ["cnpg_operator", "k8up"],
+        "matrix": ["zitadel", "cnpg_operator", "k8up"],
+        "minio_tenant": ["minio_operator", "zitadel"],
+        }
+
+# apps that may need to ask the user for something before they're installed.
+# setup_apps asks first, so no app prompts while others are installing
+APP_PROMPTS = {
+        "nextcloud": ask_for_smtp_values,
+        }
 
 
 def setup_k8s_secrets_management(argocd: ArgoCD,
@@ -225,62 +253,104 @@ def setup_base_apps(k8s_obj: K8s,
         return argocd
 
 
-def setup_federated_apps(argocd: ArgoCD,
-                         api_tls_verify: bool = False,
-                         home_assistant_dict: dict = {},
-                         nextcloud_dict: dict = {},
-                         mastodon_dict: dict = {},
-                         gotosocial_dict: dict = {},
-                         matrix_dict: dict = {},
-                         peertube_dict: dict = {},
-                         pvc_storage_class: str = "local-path",
-                         zitadel_hostname: str = "",
-                         zitadel_obj: Zitadel = None,
-                         libretranslate_api_key: str = "",
-                         bw: BwCLI = None) -> None:
+def setup_apps(argocd: ArgoCD,
+               apps: dict,
+               api_tls_verify: bool = False,
+               pvc_storage_class: str = "local-path",
+               zitadel_hostname: str = "",
+               zitadel_obj: Zitadel = None,
+               bw: BwCLI = None,
+               max_parallel: int = 4) -> dict:
     """
-    Setup any federated apps with initialization supported
+    Installs every remaining enabled app, after argo cd, secrets management,
+    operators, and the oidc provider are already setup. Apps are installed
+    max_parallel at a time, and each app waits for the apps it depends on in
+    APP_DEPENDENCIES. Pops each app it installs from apps.
+
+    Returns a dict of {app: whatever its configure function returned}
     """
-    if home_assistant_dict.get('enabled', False):
-        configure_home_assistant(argocd,
-                                 home_assistant_dict,
-                                 pvc_storage_class,
-                                 api_tls_verify,
-                                 bw)
-
-    if nextcloud_dict.get('enabled', False):
-        configure_nextcloud(argocd,
-                            nextcloud_dict,
-                            pvc_storage_class,
-                            zitadel_obj,
-                            bw)
-
-    # federated social micro blogging apps
-    if mastodon_dict.get('enabled', False):
-        configure_mastodon(argocd,
-                           mastodon_dict,
-                           pvc_storage_class,
-                           libretranslate_api_key,
-                           bw)
-
-    if gotosocial_dict.get('enabled', False):
-        configure_gotosocial(argocd,
-                             gotosocial_dict,
-                             pvc_storage_class,
-                             zitadel_obj,
-                             bw)
-
-    # federated video hosting - similar to youtube
-    if peertube_dict.get('enabled', False):
-        configure_peertube(argocd,
-                           peertube_dict,
-                           pvc_storage_class,
-                           bw)
-
-    # federated chat apps
-    if matrix_dict.get('enabled', False):
-        configure_matrix(argocd,
-                         matrix_dict,
-                         pvc_storage_class,
-                         zitadel_obj,
-                         bw)
+    def install(app_key: str, app_meta: dict):
+        """
+        returns a task that installs an app with no smol-k8s-lab init support
+        """
+        def task(results: dict):
+            argo_app = app_key.replace('_', '-')
+            sub_header(f"Installing app: {argo_app}")
+            argocd.install_app(argo_app, app_meta['argo'])
+        return task
+
+    # apps with smol-k8s-lab initialization support
+    init_apps = {
+        "netmaker": lambda cfg, results: configure_netmaker(argocd,
+                                                             cfg,
+                                                             'zitadel',
+                                                             zitadel_hostname,
+                                                             bw,
+                                                             zitadel_obj),
+        # this is currently just to make sure that grafana zitadel auth gets set up
+        "prometheus": lambda cfg, results: configure_prometheus_stack(argocd,
+                                                                      cfg,
+                                                                      zitadel_obj,
+                                                                      bw),
+        "libre_translate": lambda cfg, results: configure_libretranslate(argocd,
+                                                                         cfg,
+                                                                         bw),
+        "home_assistant": lambda cfg, results: configure_home_assistant(argocd,
+                                                                        cfg,
+                                                                        pvc_storage_class,
+                                                                        api_tls_verify,
+                                                                        bw),
+        "nextcloud": lambda cfg, results: configure_nextcloud(argocd,
+                                                              cfg,
+                                                              pvc_storage_class,
+                                                              zitadel_obj,
+                                                              bw),
+        "mastodon": lambda cfg, results: configure_mastodon(argocd,
+                                                            cfg,
+                                                            pvc_storage_class,
+                                                            results.get('libre_translate') or "",
+                                                            bw),
+        "gotosocial": lambda cfg, results: configure_gotosocial(argocd,
+                                                                cfg,
+                                                                pvc_storage_class,
+                                                                zitadel_obj,
+                                                                bw),
+        "peertube": lambda cfg, results: configure_peertube(argocd,
+                                                            cfg,
+                                                            pvc_storage_class,
+                                                            bw),
+        "matrix": lambda cfg, results: configure_matrix(argocd,
+                                                        cfg,
+                                                        pvc_storage_class,
+                                                        zitadel_obj,
+                                                        bw),
+        "valkey": lambda cfg, results: configure_valkey(argocd, cfg, bw),
+        "valkey_cluster": lambda cfg, results: configure_valkey(argocd, cfg, bw),
+        "minio_tenant": lambda cfg, results: configure_minio_tenant(argocd,
+                                                                    cfg,
+                                                                    api_tls_verify,
+                                                                    zitadel_hostname,
+                                                                    zitadel_obj,
+                                                                    bw),
+        }
+
+    # ask for anything we need from the user before we start any installs
+    for app_key, ask in APP_PROMPTS.items():
+        if apps.get(app_key, {}).get('enabled', False):
+            ask(argocd, apps[app_key])
+
+    tasks = {}
+    for app_key in list(apps.keys()):
+        if not apps[app_key].get('enabled', False):
+            continue
+        app_meta = apps.pop(app_key)
+        if app_key in init_apps:
+            tasks[app_key] = partial(init_apps[app_key], app_meta)
+        else:
+            tasks[app_key] = install(app_key, app_meta)
+
+    if not tasks:
+        return {}
+
+    header(f"Installing {len(tasks)} Argo CD apps, {max_parallel} at a time")
+    return run_dag(tasks, APP_DEPENDENCIES, max_parallel)
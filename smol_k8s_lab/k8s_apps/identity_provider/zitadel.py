@@ -165,8 +165,7 @@ def configure_zitadel(argocd: ArgoCD,
             pass
 
         # Before initialization, we need to wait for zitadel's API to be up
-        argocd.wait_for_app('zitadel', retry=True)
-        argocd.wait_for_app('zitadel-web-app', retry=True)
+        argocd.wait_for_apps(['zitadel', 'zitadel-web-app'], retry=True)
 
         vouch_dict = initialize_zitadel(argocd,
                                         zitadel_hostname=zitadel_hostname,
@@ -369,8 +368,11 @@ def setup_bitwarden_items(argocd: ArgoCD,
     """
     setup all zitadel related bitwarden items and refresh the appset secret plugin
     """
+
+    # all of this app's login items, which we create at the same time below
+    logins = {}
     restic_repo_obj = create_custom_field('resticRepoPassword', restic_repo_pass)
-    s3_backup_id = bitwarden.create_login(
+    logins['s3_backup'] = dict(
             name='zitadel-backups-s3-credentials',
             item_url=zitadel_hostname,
             user=backups_s3_user,
@@ -380,7 +382,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # S3 credentials
     db_access_key = create_password()
-    s3_id = bitwarden.create_login(
+    logins['s3'] = dict(
             name='zitadel-postgres-s3-credentials',
             item_url=zitadel_hostname,
             user="zitadel-postgres",
@@ -388,7 +390,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     admin_s3_key = create_password()
-    s3_admin_id = bitwarden.create_login(
+    logins['s3_admin'] = dict(
             name='zitadel-admin-s3-credentials',
             item_url=zitadel_hostname,
             user="zitadel-root",
@@ -396,7 +398,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     # postgres db credentials creation
-    db_id = bitwarden.create_login(
+    logins['db'] = dict(
             name='zitadel-pgsql-credentials',
             item_url=zitadel_hostname,
             user='zitadel',
@@ -408,7 +410,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     smtp_from_address_obj = create_custom_field('from_address', smtp_from_address)
     smtp_from_name_obj = create_custom_field('from_name', smtp_from_name)
     smtp_reply_to_address_obj = create_custom_field('reply_to_address', smtp_reply_to_address)
-    smtp_id = bitwarden.create_login(
+    logins['smtp'] = dict(
             name='zitadel-smtp-credentials',
             item_url=zitadel_hostname,
             user=smtp_user,
@@ -421,19 +423,22 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # create zitadel core key
     new_key = bitwarden.generate()
-    core_id = bitwarden.create_login(name="zitadel-core-key",
+    logins['core'] = dict(name="zitadel-core-key",
                                      user="admin-service-account",
                                      item_url=zitadel_hostname,
                                      password=new_key)
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+
     # update the zitadel values for the argocd appset
     argocd.update_appset_secret(
-            {'zitadel_core_bitwarden_id': core_id,
-             'zitadel_smtp_credentials_bitwarden_id': smtp_id,
-             'zitadel_postgres_credentials_bitwarden_id': db_id,
-             'zitadel_s3_postgres_credentials_bitwarden_id': s3_id,
-             'zitadel_s3_admin_credentials_bitwarden_id': s3_admin_id,
-             'zitadel_s3_backups_credentials_bitwarden_id': s3_backup_id}
+            {'zitadel_core_bitwarden_id': item_ids['core'],
+             'zitadel_smtp_credentials_bitwarden_id': item_ids['smtp'],
+             'zitadel_postgres_credentials_bitwarden_id': item_ids['db'],
+             'zitadel_s3_postgres_credentials_bitwarden_id': item_ids['s3'],
+             'zitadel_s3_admin_credentials_bitwarden_id': item_ids['s3_admin'],
+             'zitadel_s3_backups_credentials_bitwarden_id': item_ids['s3_backup']}
             )
 
     # reload the bitwarden ESO provider
@@ -540,6 +545,8 @@ def restore_zitadel(argocd: ArgoCD,
                 "https://raw.githubusercontent.com/small-hack/argocd-apps/"
                 f"{revision}/{argo_path}/external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
         # postgresql s3 ID
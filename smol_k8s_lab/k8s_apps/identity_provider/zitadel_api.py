@@ -8,15 +8,71 @@ from datetime import datetime, timezone, timedelta
 import logging as log
 from json import dumps
 import jwt
-from requests import request
-from requests.exceptions import SSLError
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, SSLError
 from rich.prompt import Prompt
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep
+from urllib3.util.retry import Retry
 
 # internal libraries
 from smol_k8s_lab.bitwarden.bw_cli import BwCLI
 from smol_k8s_lab.utils.passwords import create_password
 
+
+# status codes we retry, because zitadel is still starting or is too busy
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# seconds we wait for any one request to zitadel
+REQUEST_TIMEOUT = 30
+
+# apps are installed concurrently, so they share this many open connections
+POOL_SIZE = 10
+
+
+class ZitadelRetry(Retry):
+    """
+    urllib3 Retry that only retries a POST when zitadel answers 429 (too
+    many requests), because then it didn't create anything. After a 5xx or
+    a read timeout, the POST may have worked, and our creates can't tell
+    that apart from a real error the second time around
+    """
+    def is_retry(self, method: str, status_code: int,
+                 has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST" and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def retrying_session(retries: int = 5, backoff: float = 0.5) -> Session:
+    """
+    returns a requests Session that keeps its connections open, and retries
+    connection errors and RETRYABLE_STATUS_CODES with exponential backoff
+    and jitter, or after the Retry-After header if there is one.
+
+    Requests that may have reached zitadel are never retried if they're
+    POSTs, unless it told us to slow down, see ZitadelRetry
+    """
+    retry = ZitadelRetry(total=retries,
+                         connect=retries,
+                         read=0,
+                         status=retries,
+                         backoff_factor=backoff,
+                         backoff_jitter=backoff,
+                         status_forcelist=RETRYABLE_STATUS_CODES,
+                         allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+                         raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=POOL_SIZE,
+                          max_retries=retry)
+
+    session = Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 class Zitadel():
     """
     Python Wrapper for the Zitadel API
@@ -36,6 +92,9 @@ class Zitadel():
 
         self.verify = tls_verify
 
+        # one session for every call, since they're all to the same host
+        self.session = retrying_session()
+
         # verify the api is even up
         self.check_api_health()
 
@@ -51,35 +110,53 @@ class Zitadel():
         self.user_id = ""
         self.resource_owner = ""
 
-    def check_api_health(self,) -> True:
+        # apps are installed concurrently, and updating a user's grant is a
+        # read of their existing roles followed by a write of all of them
+        self.grant_lock = Lock()
+
+    def check_api_health(self, timeout: int = 600, interval: int = 2) -> True:
         """
         Loops and checks https://{self.api_url}healthz for an HTTP status.
-        Returns True when the status code is 200 (success).
+        Returns True when the status code is 200 (success), and raises
+        TimeoutError if the api isn't up after timeout (in seconds).
         """
-        res = None
+        # retrying while zitadel starts up is this loop's job, not the session's
+        session = retrying_session(retries=0)
+        deadline = monotonic() + timeout
         while True:
             log.debug("checking if api is up by querying the healthz endpoint,"
                       f" {self.api_url}, using verify={self.verify}")
 
             try:
-                res = request("GET", f"{self.api_url}healthz", verify=self.verify)
+                res = session.get(f"{self.api_url}healthz", verify=self.verify,
+                                  timeout=min(interval * 5, REQUEST_TIMEOUT))
+                if res.status_code == 200:
+                    log.info("Zitadel API is up now :)")
+                    session.close()
+                    return True
+                log.debug("Zitadel API is not yet up :(")
             except SSLError:
                 log.warn(f"Looks like querying {self.api_url} gave an SSL error,"
                          "but we'll try again")
-                pass
+            except RequestException as e:
+                log.debug(f"Zitadel API is not yet up: {e}")
 
-            if res:
-                if res.status_code == 200:
-                    log.info("Zitadel API is up now :)")
-                    break
-                else:
-                    # sleep just a couple of seconds to avoid being locked out or something
-                    sleep(2)
-                    log.debug("Zitadel API is not yet up :(")
-            else:
-                sleep(2)
+            if monotonic() + interval > deadline:
+                session.close()
+                raise TimeoutError(f"Timed out after {timeout}s waiting on the "
+                                   f"Zitadel API at {self.api_url}healthz")
 
-        return True
+            # sleep just a couple of seconds to avoid being locked out or something
+            sleep(interval)
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        sends a request to zitadel with our session, so the connection is
+        reused, and with our verify setting and a timeout by default
+        """
+        kwargs.setdefault("verify", self.verify)
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        return self.session.request(method, url, **kwargs)
 
     def generate_token(self, hostname: str = "", secret_blob: dict = {}) -> str:
         """
@@ -121,8 +198,8 @@ class Zitadel():
                    'scope': scopes,
                    'assertion': encoded}
 
-        res = request("POST", f"https://{hostname}/oauth/v2/token",
-                      headers=headers, data=payload, verify=self.verify)
+        res = self.request("POST", f"https://{hostname}/oauth/v2/token",
+                           headers=headers, data=payload)
         log.debug(f"res is {res}")
 
         # I literally don't know if you should use json or json()
@@ -151,12 +228,11 @@ class Zitadel():
               "privateLabelingSetting": "PRIVATE_LABELING_SETTING_UNSPECIFIED"
             })
 
-        response = request(
+        response = self.request(
                 "POST",
                 self.api_url + "projects",
                 headers=self.headers,
-                data=payload,
-                verify=self.verify
+                data=payload
                 )
         log.debug(response.text)
 
@@ -221,8 +297,8 @@ class Zitadel():
         log.info(f"payload for create user is {payload}")
 
         # get the user ID from the response
-        response = request("POST", self.api_url + 'users/human/_import',
-                           headers=self.headers, data=payload, verify=self.verify)
+        response = self.request("POST", self.api_url + 'users/human/_import',
+                                headers=self.headers, data=payload)
         log.info(response.text)
         return response.json()['userId']
 
@@ -247,11 +323,10 @@ class Zitadel():
           "roleKeys": role_keys
         })
 
-        response = request("POST",
-                           self.api_url + f"users/{user_id}/grants",
-                           headers=self.headers,
-                           data=payload,
-                           verify=self.verify)
+        response = self.request("POST",
+                                self.api_url + f"users/{user_id}/grants",
+                                headers=self.headers,
+                                data=payload)
         log.info(response.text)
 
         return response.json()['userGrantId']
@@ -265,35 +340,36 @@ class Zitadel():
             user_id:    ID of the user we're grants a role to, if not provided,
                         we use self.user_id
         """
-        if not user_id:
-            user_id = self.user_id
+        with self.grant_lock:
+            if not user_id:
+                user_id = self.user_id
 
-        url = f"{self.api_url}users/grants/_search"
+            url = f"{self.api_url}users/grants/_search"
 
-        payload = dumps({
-                  "userIdQuery": {
-                    "userId": user_id
-                  }
-            })
+            payload = dumps({
+                      "userIdQuery": {
+                        "userId": user_id
+                      }
+                })
 
-        response = request("POST", url, headers=self.headers, data=payload,
-                           verify=self.verify)
-        log.info(response.text)
-        user_roles = response.json()['result'][0]['roleKeys']
-        grant_id = response.json()['result'][0]['id']
-        log.info(f"{user_id} has grant id {grant_id} with roles: {user_roles}")
+            response = self.request("POST", url, headers=self.headers,
+                                    data=payload)
+            log.info(response.text)
+            user_roles = response.json()['result'][0]['roleKeys']
+            grant_id = response.json()['result'][0]['id']
+            log.info(f"{user_id} has grant id {grant_id} with roles: {user_roles}")
 
-        # now we can update the user's roles
-        role_keys.extend(user_roles)
-        log.debug(f"Assiging user_id, {user_id} the roles of "
-                  f"[green]{role_keys}[/] in {self.project_id}")
+            # now we can update the user's roles
+            role_keys.extend(user_roles)
+            log.debug(f"Assiging user_id, {user_id} the roles of "
+                      f"[green]{role_keys}[/] in {self.project_id}")
 
-        url = f"{self.api_url}users/{user_id}/grants/{grant_id}"
+            url = f"{self.api_url}users/{user_id}/grants/{grant_id}"
 
-        payload = dumps({"roleKeys": role_keys})
+            payload = dumps({"roleKeys": role_keys})
 
-        response = request("PUT", url, headers=self.headers, data=payload,
-                           verify=self.verify)
+            response = self.request("PUT", url, headers=self.headers,
+                                    data=payload)
 
     def create_iam_membership(self, user_id: str, role: str):
         """
@@ -304,11 +380,10 @@ class Zitadel():
           "userId": user_id,
           "roles": [role]
         })
-        response = request("POST",
-                           url,
-                           headers=self.headers,
-                           data=payload,
-                           verify=self.verify)
+        response = self.request("POST",
+                                url,
+                                headers=self.headers,
+                                data=payload)
         log.info(response.text)
 
     def create_application(self,
@@ -356,11 +431,10 @@ class Zitadel():
         url = self.api_url + f'projects/{self.project_id}/apps/oidc'
         log.info(url)
 
-        response = request("POST",
-                           url,
-                           headers=self.headers,
-                           data=payload,
-                           verify=self.verify)
+        response = self.request("POST",
+                                url,
+                                headers=self.headers,
+                                data=payload)
         log.info(response.text)
         json_res = response.json()
 
@@ -436,11 +510,10 @@ class Zitadel():
         """
         log.info("Creating action...")
         while True:
-            response = request("POST",
-                               self.api_url + "actions",
-                               headers=self.headers,
-                               data=script,
-                               verify=self.verify)
+            response = self.request("POST",
+                                    self.api_url + "actions",
+                                    headers=self.headers,
+                                    data=script)
             log.debug(response.text)
             # if the response is not 200, just try again 🤷
             if response.status_code == 200:
@@ -458,11 +531,10 @@ class Zitadel():
             log.debug(f"url is {url}")
 
             while True:
-                response = request("POST",
-                                   url,
-                                   headers=self.headers,
-                                   data=action_payload,
-                                   verify=self.verify)
+                response = self.request("POST",
+                                        url,
+                                        headers=self.headers,
+                                        data=action_payload)
                 log.debug(f"flows response is {response.text}")
 
                 # if the response is not 200, just try again 🤷
@@ -487,8 +559,8 @@ class Zitadel():
         url = f"{self.api_url}projects/{self.project_id}/roles"
         log.info(f"Creating a role, {role_key} using {url}")
 
-        response = request("POST", url, headers=self.headers, data=payload,
-                           verify=self.verify)
+        response = self.request("POST", url, headers=self.headers,
+                                data=payload)
 
         log.info(response.text)
 
@@ -498,8 +570,7 @@ class Zitadel():
         """
         url = f"{self.api_url}global/users/_by_login_name?loginName={user}"
 
-        response = request("GET", url, headers=self.headers, data={},
-                           verify=self.verify).json()
+        response = self.request("GET", url, headers=self.headers, data={}).json()
         log.debug(response)
 
         self.user_id = response['user']['id']
@@ -533,8 +604,8 @@ class Zitadel():
 
         self.headers['Content-Type'] = 'application/json'
 
-        response = request("POST", url, headers=self.headers, data=payload,
-                           verify=self.verify)
+        response = self.request("POST", url, headers=self.headers,
+                                data=payload)
 
         log.debug(f'response from set_project_by_name for "{project_name}" '
                   f'_search: {response.text}')
@@ -7,7 +7,7 @@ DESCRIPTION: helm install, and optionally configure, cert manager
 """
 from smol_k8s_lab.k8s_tools.helm import Helm
 from smol_k8s_lab.k8s_tools.argocd_util import ArgoCD
-from smol_k8s_lab.k8s_tools.k8s_lib import K8s
+from smol_k8s_lab.k8s_tools.k8s_lib import K8s, raise_for_failed
 from smol_k8s_lab.bitwarden.bw_cli import BwCLI
 from smol_k8s_lab.utils.value_from import extract_secret
 import logging as log
@@ -98,4 +98,4 @@ def create_cluster_issuers(init_values: dict,
             }
 
         # backup plan till above issue is resolved
-        k8s_obj.apply_custom_resources([issuers_dict])
+        raise_for_failed(k8s_obj.apply_custom_resources([issuers_dict]))
@@ -6,7 +6,7 @@ DESCRIPTION: configures metallb
     LICENSE: GNU AFFERO GENERAL PUBLIC LICENSE Version 3
 """
 # internal libraries
-from smol_k8s_lab.k8s_tools.k8s_lib import K8s
+from smol_k8s_lab.k8s_tools.k8s_lib import K8s, raise_for_failed
 
 # external libraries
 import logging as log
@@ -60,4 +60,4 @@ def configure_metallb(k8s_obj: K8s, address_pool: list = []) -> None:
                         'metadata': {'name': 'default',
                                      'namespace': 'metallb-system'}}
 
-        k8s_obj.apply_custom_resources([ip_pool_cr, l2_advert_cr])
+        raise_for_failed(k8s_obj.apply_custom_resources([ip_pool_cr, l2_advert_cr]))
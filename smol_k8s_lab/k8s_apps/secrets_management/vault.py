@@ -108,14 +108,15 @@ def initialize_vault(namespace: str,
                                password="see custom fields",
                                fields=bw_objs)
 
-    # unseal each pod with each key...
+    # unseal each pod with each key. The pods don't depend on each other, so
+    # we unseal them at the same time, but each pod gets its key shares one
+    # at a time, in order. No tty, since these run without a terminal
+    pod_cmds = []
     for pod in pods:
-        cmds = []
         # Unseal the Vault server with the key shares until the key threshold is met
-        for key in keys:
-            cmds.append(f"kubectl exec -n {namespace} --stdin=true --tty=true {pod} -- "
-                        f"vault operator unseal {key}")
-        subproc(cmds, quiet=True)
+        pod_cmds.append([f"kubectl exec -n {namespace} {pod} -- "
+                         f"vault operator unseal {key}" for key in keys])
+    subproc(pod_cmds, quiet=True, parallel=True, max_workers=max(1, len(pods)))
 
     log.info("Vault is initialized and unsealed")
 
@@ -144,6 +144,8 @@ def restore_collabora(argocd: ArgoCD,
                 "main/collabora/toleration_and_affinity_app_of_apps/"
                 "external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
     if secrets['affinity_key']:
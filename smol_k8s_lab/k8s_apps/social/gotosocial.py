@@ -316,6 +316,9 @@ def setup_bitwarden_items(argocd: ArgoCD,
     setup secrets in bitwarden for gotosocial.
     """
 
+    # all of this app's login items, which we create at the same time below
+    logins = {}
+
     # S3 credentials
     # endpoint that gets put into the secret should probably have http in it
     if "http" not in s3_endpoint:
@@ -328,7 +331,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
                                                s3_endpoint.replace("https://",
                                                                    ""))
     gotosocial_s3_bucket_obj = create_custom_field("s3Bucket", "gotosocial")
-    s3_id = bitwarden.create_login(
+    logins['s3'] = dict(
             name='gotosocial-user-s3-credentials',
             item_url=gotosocial_hostname,
             user=s3_access_id,
@@ -341,7 +344,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     pgsql_s3_key = create_password()
-    s3_db_id = bitwarden.create_login(
+    logins['s3_db'] = dict(
             name='gotosocial-postgres-s3-credentials',
             item_url=gotosocial_hostname,
             user="gotosocial-postgres",
@@ -349,7 +352,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     admin_s3_key = create_password()
-    s3_admin_id = bitwarden.create_login(
+    logins['s3_admin'] = dict(
             name='gotosocial-admin-s3-credentials',
             item_url=gotosocial_hostname,
             user="gotosocial-root",
@@ -358,7 +361,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # credentials for remote backups of the s3 PVC
     restic_repo_pass_obj = create_custom_field("resticRepoPassword", restic_repo_pass)
-    s3_backups_id = bitwarden.create_login(
+    logins['s3_backups'] = dict(
             name='gotosocial-backups-s3-credentials',
             item_url=gotosocial_hostname,
             user=backups_s3_user,
@@ -370,7 +373,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     gotosocial_pgsql_password = bitwarden.generate()
     postrges_pass_obj = create_custom_field("postgresPassword",
                                             gotosocial_pgsql_password)
-    db_id = bitwarden.create_login(
+    logins['db'] = dict(
             name='gotosocial-pgsql-credentials',
             item_url=gotosocial_hostname,
             user='gotosocial',
@@ -381,7 +384,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     # SMTP credentials
     gotosocial_smtp_host_obj = create_custom_field("smtpHostname", mail_host)
     gotosocial_smtp_port_obj = create_custom_field("smtpPort", mail_port)
-    smtp_id = bitwarden.create_login(
+    logins['smtp'] = dict(
             name='gotosocial-smtp-credentials',
             item_url=gotosocial_hostname,
             user=mail_user,
@@ -404,7 +407,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     if oidc_creds:
         log.debug("Creating OIDC credentials for gotosocial in Bitwarden...")
         issuer_obj = create_custom_field("issuer", f"https://{zitadel_hostname}")
-        oidc_id = bitwarden.create_login(
+        logins['oidc'] = dict(
                 name='gotosocial-oidc-credentials',
                 item_url=gotosocial_hostname,
                 user=oidc_creds['client_id'],
@@ -416,16 +419,21 @@ def setup_bitwarden_items(argocd: ArgoCD,
                 f"gotosocial-oidc-credentials-{gotosocial_hostname}"
                 )[0]['id']
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+    if oidc_creds:
+        oidc_id = item_ids['oidc']
+
     # update the gotosocial values for the argocd appset
     # 'gotosocial_admin_credentials_bitwarden_id': admin_id,
     argocd.update_appset_secret(
-            {'gotosocial_smtp_credentials_bitwarden_id': smtp_id,
+            {'gotosocial_smtp_credentials_bitwarden_id': item_ids['smtp'],
              'gotosocial_oidc_credentials_bitwarden_id': oidc_id,
-             'gotosocial_postgres_credentials_bitwarden_id': db_id,
-             'gotosocial_s3_admin_credentials_bitwarden_id': s3_admin_id,
-             'gotosocial_s3_postgres_credentials_bitwarden_id': s3_db_id,
-             'gotosocial_s3_gotosocial_credentials_bitwarden_id': s3_id,
-             'gotosocial_s3_backups_credentials_bitwarden_id': s3_backups_id})
+             'gotosocial_postgres_credentials_bitwarden_id': item_ids['db'],
+             'gotosocial_s3_admin_credentials_bitwarden_id': item_ids['s3_admin'],
+             'gotosocial_s3_postgres_credentials_bitwarden_id': item_ids['s3_db'],
+             'gotosocial_s3_gotosocial_credentials_bitwarden_id': item_ids['s3'],
+             'gotosocial_s3_backups_credentials_bitwarden_id': item_ids['s3_backups']})
 
     # reload the bitwarden ESO provider
     try:
@@ -474,6 +482,8 @@ def restore_gotosocial(argocd: ArgoCD,
                 f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
                 f"{argo_path}external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
         # postgresql s3 ID
@@ -527,6 +537,7 @@ def restore_gotosocial(argocd: ArgoCD,
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argo_path}pvc_argocd_appset.yaml"
             )
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(podconfig_yaml, argocd.namespace)
 
     # then we begin the restic restore of all the gotosocial PVCs we lost
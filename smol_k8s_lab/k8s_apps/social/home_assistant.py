@@ -154,6 +154,8 @@ def restore_home_assistant(argocd: ArgoCD,
                 "main/home-assistant/toleration_and_affinity_app_of_apps/"
                 "external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
     if secrets['affinity_key']:
@@ -214,6 +216,9 @@ def setup_bitwarden_items(argocd: ArgoCD,
     setup initial bitwarden items for home assistant
     """
     sub_header("Creating home-assistant items in Bitwarden")
+
+    # all of this app's login items, which we create at the same time below
+    logins = {}
     # determine if using https or http for home assistant api calls
     if api_tls_verify:
         external_url = 'https://' + home_assistant_hostname + '/'
@@ -225,7 +230,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     admin_name_field = create_custom_field('name', admin_name)
     admin_lang_field = create_custom_field('language', admin_language)
     admin_password = bitwarden.generate()
-    admin_id = bitwarden.create_login(
+    logins['admin'] = dict(
             name=f'home-assistant-admin-credentials-{home_assistant_hostname}',
             item_url=home_assistant_hostname,
             user=admin_user,
@@ -235,7 +240,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # credentials for remote backups of the s3 PVC
     restic_repo_pass_obj = create_custom_field("resticRepoPassword", restic_repo_pass)
-    s3_backups_id = bitwarden.create_login(
+    logins['s3_backups'] = dict(
             name='home-assistant-backups-s3-credentials',
             item_url=home_assistant_hostname,
             user=backups_s3_user,
@@ -243,10 +248,13 @@ def setup_bitwarden_items(argocd: ArgoCD,
             fields=[restic_repo_pass_obj]
             )
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+
     # update the home-assistant values for the argocd appset
     argocd.update_appset_secret(
-            {'home_assistant_admin_credentials_bitwarden_id': admin_id,
-             'home_assistant_s3_backups_credentials_bitwarden_id': s3_backups_id}
+            {'home_assistant_admin_credentials_bitwarden_id': item_ids['admin'],
+             'home_assistant_s3_backups_credentials_bitwarden_id': item_ids['s3_backups']}
             )
 
 
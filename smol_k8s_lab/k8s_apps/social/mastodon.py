@@ -317,6 +317,9 @@ def setup_bitwarden_items(argocd: ArgoCD,
                           mastodon_libretranslate_hostname: str,
                           libre_api_key: str,
                           bitwarden: BwCLI) -> None:
+    # all of this app's login items, which we create at the same time below
+    logins = {}
+
     # S3 credentials
     # endpoint that gets put into the secret should probably have http in it
     if "http" not in s3_endpoint:
@@ -329,7 +332,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
                                                s3_endpoint.replace("https://",
                                                                    ""))
     mastodon_s3_bucket_obj = create_custom_field("s3Bucket", "mastodon")
-    s3_id = bitwarden.create_login(
+    logins['s3'] = dict(
             name='mastodon-user-s3-credentials',
             item_url=mastodon_hostname,
             user=s3_access_id,
@@ -342,7 +345,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     pgsql_s3_key = create_password()
-    s3_db_id = bitwarden.create_login(
+    logins['s3_db'] = dict(
             name='mastodon-postgres-s3-credentials',
             item_url=mastodon_hostname,
             user="mastodon-postgres",
@@ -350,7 +353,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     admin_s3_key = create_password()
-    s3_admin_id = bitwarden.create_login(
+    logins['s3_admin'] = dict(
             name='mastodon-admin-s3-credentials',
             item_url=mastodon_hostname,
             user="mastodon-root",
@@ -359,7 +362,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # credentials for remote backups of the s3 PVC
     restic_repo_pass_obj = create_custom_field("resticRepoPassword", restic_repo_pass)
-    s3_backups_id = bitwarden.create_login(
+    logins['s3_backups'] = dict(
             name='mastodon-backups-s3-credentials',
             item_url=mastodon_hostname,
             user=backups_s3_user,
@@ -369,7 +372,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # elastic search password
     mastodon_elasticsearch_password = bitwarden.generate()
-    elastic_id = bitwarden.create_login(
+    logins['elastic'] = dict(
             name='mastodon-elasticsearch-credentials',
             item_url=mastodon_hostname,
             user='mastodon',
@@ -380,7 +383,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     mastodon_pgsql_password = bitwarden.generate()
     postrges_pass_obj = create_custom_field("postgresPassword",
                                             mastodon_pgsql_password)
-    db_id = bitwarden.create_login(
+    logins['db'] = dict(
             name='mastodon-pgsql-credentials',
             item_url=mastodon_hostname,
             user='mastodon',
@@ -390,7 +393,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # valkey credentials
     mastodon_valkey_password = bitwarden.generate()
-    valkey_id = bitwarden.create_login(
+    logins['valkey'] = dict(
             name='mastodon-valkey-credentials',
             item_url=mastodon_hostname,
             user='mastodon',
@@ -399,7 +402,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # SMTP credentials
     mastodon_smtp_host_obj = create_custom_field("smtpHostname", mail_host)
-    smtp_id = bitwarden.create_login(
+    logins['smtp'] = dict(
             name='mastodon-smtp-credentials',
             item_url=mastodon_hostname,
             user=mail_user,
@@ -448,7 +451,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             rake_secrets['ACTIVE_RECORD_ENCRYPTION_PRIMARY_KEY']
             )
 
-    secrets_id = bitwarden.create_login(
+    logins['secrets'] = dict(
             name='mastodon-server-secrets',
             item_url=mastodon_hostname,
             user="mastodon",
@@ -465,7 +468,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     endpoint = create_custom_field('endpoint', mastodon_libretranslate_hostname)
-    libretranslate_api_key_id = bitwarden.create_login(
+    logins['libretranslate_api_key'] = dict(
             name=f'mastodon-libretranslate-credentials-{mastodon_hostname}',
             item_url=mastodon_libretranslate_hostname,
             user="n/a",
@@ -473,19 +476,22 @@ def setup_bitwarden_items(argocd: ArgoCD,
             fields=[endpoint]
             )
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+
     # update the mastodon values for the argocd appset
     # 'mastodon_admin_credentials_bitwarden_id': admin_id,
     argocd.update_appset_secret(
-            {'mastodon_smtp_credentials_bitwarden_id': smtp_id,
-             'mastodon_postgres_credentials_bitwarden_id': db_id,
-             'mastodon_valkey_bitwarden_id': valkey_id,
-             'mastodon_s3_admin_credentials_bitwarden_id': s3_admin_id,
-             'mastodon_s3_postgres_credentials_bitwarden_id': s3_db_id,
-             'mastodon_s3_mastodon_credentials_bitwarden_id': s3_id,
-             'mastodon_s3_backups_credentials_bitwarden_id': s3_backups_id,
-             'mastodon_elasticsearch_credentials_bitwarden_id': elastic_id,
-             'mastodon_server_secrets_bitwarden_id': secrets_id,
-             'mastodon_libretranslate_bitwarden_id': libretranslate_api_key_id})
+            {'mastodon_smtp_credentials_bitwarden_id': item_ids['smtp'],
+             'mastodon_postgres_credentials_bitwarden_id': item_ids['db'],
+             'mastodon_valkey_bitwarden_id': item_ids['valkey'],
+             'mastodon_s3_admin_credentials_bitwarden_id': item_ids['s3_admin'],
+             'mastodon_s3_postgres_credentials_bitwarden_id': item_ids['s3_db'],
+             'mastodon_s3_mastodon_credentials_bitwarden_id': item_ids['s3'],
+             'mastodon_s3_backups_credentials_bitwarden_id': item_ids['s3_backups'],
+             'mastodon_elasticsearch_credentials_bitwarden_id': item_ids['elastic'],
+             'mastodon_server_secrets_bitwarden_id': item_ids['secrets'],
+             'mastodon_libretranslate_bitwarden_id': item_ids['libretranslate_api_key']})
 
     # reload the bitwarden ESO provider
     try:
@@ -536,6 +542,8 @@ def restore_mastodon(argocd: ArgoCD,
                 f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
                 f"{argo_path}external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
         # postgresql s3 ID
@@ -589,6 +597,7 @@ def restore_mastodon(argocd: ArgoCD,
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argo_path}pvc_argocd_appset.yaml"
             )
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(podconfig_yaml, argocd.namespace)
 
     # then we begin the restic restore of all the mastodon PVCs we lost
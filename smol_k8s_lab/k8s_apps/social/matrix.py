@@ -402,6 +402,9 @@ def setup_bitwarden_items(argocd: ArgoCD,
     """
     sub_header("Creating matrix secrets in Bitwarden")
 
+    # all of this app's login items, which we create at the same time below
+    logins = {}
+
     # if trusted_key_servers:
     #     trusted_key_servers_id = bitwarden.create_login(
     #             name='matrix-trusted-key-servers',
@@ -419,7 +422,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     matrix_s3_host_obj = create_custom_field("s3Hostname",
                                              s3_endpoint.replace("https://", ""))
     matrix_s3_bucket_obj = create_custom_field("s3Bucket", s3_bucket)
-    s3_id = bitwarden.create_login(
+    logins['s3'] = dict(
             name='matrix-user-s3-credentials',
             item_url=matrix_hostname,
             user=s3_access_id,
@@ -432,7 +435,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     pgsql_s3_key = create_password()
-    s3_db_id = bitwarden.create_login(
+    logins['s3_db'] = dict(
             name='matrix-postgres-s3-credentials',
             item_url=matrix_hostname,
             user="matrix-postgres",
@@ -440,7 +443,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     admin_s3_key = create_password()
-    s3_admin_id = bitwarden.create_login(
+    logins['s3_admin'] = dict(
             name='matrix-admin-s3-credentials',
             item_url=matrix_hostname,
             user="matrix-root",
@@ -449,7 +452,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # credentials for remote backups of the s3 PVC
     restic_repo_pass_obj = create_custom_field("resticRepoPassword", restic_repo_pass)
-    s3_backups_id = bitwarden.create_login(
+    logins['s3_backups'] = dict(
             name='matrix-backups-s3-credentials',
             item_url=matrix_hostname,
             user=backups_s3_user,
@@ -462,7 +465,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
                                       f"matrix-postgres-rw.{matrix_namespace}.svc")
     # the database name
     db_obj = create_custom_field("database", "matrix")
-    db_id = bitwarden.create_login(
+    logins['db'] = dict(
             name='matrix-pgsql-credentials',
             item_url=matrix_hostname,
             user='matrix',
@@ -476,7 +479,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     mas_db_obj = create_custom_field("database", "mas")
     # MAS doesn't support TLS auth to databases yet
     mas_db_pw = create_password()
-    mas_db_id = bitwarden.create_login(
+    logins['mas_db'] = dict(
             name='mas-pgsql-credentials',
             item_url=matrix_hostname,
             user='mas',
@@ -490,7 +493,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
                 "sslkey=/etc/secrets/syncv3/tls.key "
                 "sslcert=/etc/secrets/syncv3/tls.crt "
                 "sslrootcert=/etc/secrets/ca/ca.crt")
-    sync_db_id = bitwarden.create_login(
+    logins['sync_db'] = dict(
             name='syncv3-pgsql-credentials',
             item_url=matrix_hostname,
             user='syncv3',
@@ -499,7 +502,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # SMTP credentials
     matrix_smtp_host_obj = create_custom_field("smtpHostname", mail_host)
-    smtp_id = bitwarden.create_login(
+    logins['smtp'] = dict(
             name='matrix-smtp-credentials',
             item_url=matrix_hostname,
             user=mail_user,
@@ -509,7 +512,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # registration key
     matrix_registration_key = bitwarden.generate()
-    reg_id = bitwarden.create_login(
+    logins['reg'] = dict(
             name='matrix-registration-key',
             item_url=matrix_hostname,
             user="admin",
@@ -521,7 +524,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     alertmanager_as_token_obj = create_custom_field("as_token", alertmanager_as_token)
     alertmanager_hs_token = bitwarden.generate()
     alertmanager_hs_token_obj = create_custom_field("hs_token", alertmanager_hs_token)
-    alertmanager_id = bitwarden.create_login(
+    logins['alertmanager'] = dict(
             name='matrix-alertmanager-bridge',
             item_url=matrix_hostname,
             user="none",
@@ -533,7 +536,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     discord_as_token_obj = create_custom_field("as_token", discord_as_token)
     discord_hs_token = bitwarden.generate()
     discord_hs_token_obj = create_custom_field("hs_token", discord_hs_token)
-    discord_id = bitwarden.create_login(
+    logins['discord'] = dict(
             name='matrix-discord-bridge',
             item_url=matrix_hostname,
             user="none",
@@ -541,7 +544,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     # matrix sliding sync
-    sync_id = bitwarden.create_login(
+    logins['sync'] = dict(
             name='matrix-syncv3-credentials',
             item_url=matrix_hostname,
             user="syncv3",
@@ -561,7 +564,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             idp_name_obj = create_custom_field("idp_name", idp_name)
 
             # for the credentials to zitadel
-            oidc_id = bitwarden.create_login(
+            logins['oidc'] = dict(
                     name='matrix-oidc-credentials',
                     item_url=matrix_hostname,
                     user=oidc_creds['client_id'],
@@ -574,7 +577,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             acct_url_obj = create_custom_field("account_management_url", issuer_url)
             issuer_obj = create_custom_field("issuer", mas_issuer)
             provider_ulid_obj = create_custom_field("provider_id", mas_provider_ulid)
-            mas_id = bitwarden.create_login(
+            logins['mas'] = dict(
                     name='matrix-authentication-service-credentials',
                     item_url=matrix_hostname,
                     user=mas_client_id,
@@ -590,23 +593,29 @@ def setup_bitwarden_items(argocd: ArgoCD,
                     f"matrix-authentication-service-credentials-{matrix_hostname}"
                     )[0]['id']
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+    if zitadel_hostname and oidc_creds:
+        oidc_id = item_ids['oidc']
+        mas_id = item_ids['mas']
+
     # update the matrix values for the argocd appset
     # 'matrix_trusted_key_servers_bitwarden_id': trusted_key_servers_id}
     argocd.update_appset_secret(
-            {'matrix_registration_credentials_bitwarden_id': reg_id,
-             'matrix_smtp_credentials_bitwarden_id': smtp_id,
-             'matrix_s3_admin_credentials_bitwarden_id': s3_admin_id,
-             'matrix_s3_postgres_credentials_bitwarden_id': s3_db_id,
-             'matrix_s3_matrix_credentials_bitwarden_id': s3_id,
-             'matrix_s3_backups_credentials_bitwarden_id': s3_backups_id,
-             'matrix_postgres_credentials_bitwarden_id': db_id,
-             'matrix_sliding_sync_bitwarden_id': sync_id,
-             'matrix_mas_postgres_credentials_bitwarden_id': mas_db_id,
-             'matrix_sliding_sync_postgres_credentials_bitwarden_id': sync_db_id,
+            {'matrix_registration_credentials_bitwarden_id': item_ids['reg'],
+             'matrix_smtp_credentials_bitwarden_id': item_ids['smtp'],
+             'matrix_s3_admin_credentials_bitwarden_id': item_ids['s3_admin'],
+             'matrix_s3_postgres_credentials_bitwarden_id': item_ids['s3_db'],
+             'matrix_s3_matrix_credentials_bitwarden_id': item_ids['s3'],
+             'matrix_s3_backups_credentials_bitwarden_id': item_ids['s3_backups'],
+             'matrix_postgres_credentials_bitwarden_id': item_ids['db'],
+             'matrix_sliding_sync_bitwarden_id': item_ids['sync'],
+             'matrix_mas_postgres_credentials_bitwarden_id': item_ids['mas_db'],
+             'matrix_sliding_sync_postgres_credentials_bitwarden_id': item_ids['sync_db'],
              'matrix_oidc_credentials_bitwarden_id': oidc_id,
              'matrix_authentication_service_bitwarden_id': mas_id,
-             'matrix_alertmanager_bitwarden_id': alertmanager_id,
-             'matrix_discord_bitwarden_id': discord_id,
+             'matrix_alertmanager_bitwarden_id': item_ids['alertmanager'],
+             'matrix_discord_bitwarden_id': item_ids['discord'],
              'matrix_idp_name': idp_name,
              'matrix_idp_id': idp_id}
             )
@@ -658,6 +667,8 @@ def restore_matrix(argocd: ArgoCD,
                 "https://raw.githubusercontent.com/small-hack/argocd-apps"
                 f"/{revision}/{argo_path}/external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
         # postgresql s3 ID
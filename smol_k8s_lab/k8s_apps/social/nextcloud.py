@@ -92,6 +92,9 @@ def configure_nextcloud(argocd: ArgoCD,
         nextcloud_namespace = cfg['argo']['namespace']
         argocd.k8s.create_namespace(nextcloud_namespace)
 
+        # ask for any smtp values we don't have yet, if setup_apps hasn't already
+        ask_for_smtp_values(argocd, cfg)
+
         if init_values:
             admin_user = init_values.get('admin_user', 'admin')
 
@@ -113,20 +116,6 @@ def configure_nextcloud(argocd: ArgoCD,
                                    access_key="nextcloud",
                                    secret_key=s3_access_key)
 
-        # configure SMTP
-        if not mail_host:
-            mail_host = Prompt.ask(
-                    "[green]Please enter the SMTP host for nextcoud"
-                    )
-
-        if not mail_user:
-            m = f"[green]Please enter an SMTP user for Nextcloud on server, {mail_host}"
-            mail_user = Prompt.ask(m)
-
-        if not mail_pass:
-            m = f"[green]Please enter the SMTP password of {mail_user} on {mail_host}"
-            mail_pass = Prompt.ask(m, password=True)
-
         # configure OIDC
         if zitadel and not restore_enabled:
             log.debug("Creating a Nextcloud OIDC application in Zitadel...")
@@ -226,6 +215,37 @@ def configure_nextcloud(argocd: ArgoCD,
                           bitwarden)
 
 
+def ask_for_smtp_values(argocd: ArgoCD, cfg: dict) -> None:
+    """
+    asks for any of nextcloud's smtp init values that aren't set yet, and
+    saves the answers in cfg. setup_apps calls this before it installs apps
+    concurrently, so we never prompt from a worker thread
+    """
+    init = cfg.get('init', {})
+    init_values = init.get('values', None)
+    if not init.get('enabled', True) or not init_values:
+        return
+
+    # we only need these to setup nextcloud the first time
+    if argocd.check_if_app_exists('nextcloud'):
+        return
+
+    if not init_values.get('smtp_host', None):
+        init_values['smtp_host'] = Prompt.ask(
+                "[green]Please enter the SMTP host for nextcoud"
+                )
+    mail_host = init_values['smtp_host']
+
+    if not init_values.get('smtp_user', None):
+        m = f"[green]Please enter an SMTP user for Nextcloud on server, {mail_host}"
+        init_values['smtp_user'] = Prompt.ask(m)
+    mail_user = init_values['smtp_user']
+
+    if not extract_secret(init_values.get('smtp_password', "")):
+        m = f"[green]Please enter the SMTP password of {mail_user} on {mail_host}"
+        init_values['smtp_password'] = Prompt.ask(m, password=True)
+
+
 def restore_nextcloud(argocd: ArgoCD,
                       nextcloud_hostname: str,
                       collabora_hostname: str,
@@ -269,6 +289,8 @@ def restore_nextcloud(argocd: ArgoCD,
                 f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
                 f"{argo_path}external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
         # postgresql s3 ID
@@ -322,6 +344,7 @@ def restore_nextcloud(argocd: ArgoCD,
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argo_path}pvc_argocd_appset.yaml"
             )
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(podconfig_yaml, argocd.namespace)
 
     # then we begin the restic restore of all the nextcloud PVCs we lost
@@ -381,10 +404,13 @@ def setup_bitwarden_items(argocd: ArgoCD,
     """
     sub_header("Creating Nextcloud items in Bitwarden")
 
+    # all of this app's login items, which we create at the same time below
+    logins = {}
+
     # s3 credentials creation
     bucket_obj = create_custom_field('bucket', "nextcloud-data")
     endpoint_obj = create_custom_field('endpoint', s3_endpoint)
-    s3_id = bitwarden.create_login(
+    logins['s3'] = dict(
             name='nextcloud-user-s3-credentials',
             item_url=nextcloud_hostname,
             user="nextcloud",
@@ -393,7 +419,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     pgsql_s3_key = create_password()
-    s3_db_id = bitwarden.create_login(
+    logins['s3_db'] = dict(
             name='nextcloud-postgres-s3-credentials',
             item_url=nextcloud_hostname,
             user="nextcloud-postgres",
@@ -401,7 +427,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     admin_s3_key = create_password()
-    s3_admin_id = bitwarden.create_login(
+    logins['s3_admin'] = dict(
             name='nextcloud-admin-s3-credentials',
             item_url=nextcloud_hostname,
             user="nextcloud-root",
@@ -410,7 +436,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # credentials for remote backups of the s3 PVC
     restic_repo_pass_obj = create_custom_field("resticRepoPassword", restic_repo_pass)
-    s3_backups_id = bitwarden.create_login(
+    logins['s3_backups'] = dict(
             name='nextcloud-backups-s3-credentials',
             item_url=nextcloud_hostname,
             user=backups_s3_user,
@@ -422,7 +448,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     if oidc_creds:
         log.debug("Creating OIDC credentials for Nextcloud in Bitwarden...")
         issuer_obj = create_custom_field("issuer", f"https://{zitadel_hostname}")
-        oidc_id = bitwarden.create_login(
+        logins['oidc'] = dict(
                 name='nextcloud-oidc-credentials',
                 item_url=nextcloud_hostname,
                 user=oidc_creds['client_id'],
@@ -438,7 +464,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     token = bitwarden.generate()
     admin_password = bitwarden.generate()
     serverinfo_token_obj = create_custom_field("serverInfoToken", token)
-    admin_id = bitwarden.create_login(
+    logins['admin'] = dict(
             name='nextcloud-admin-credentials',
             item_url=nextcloud_hostname,
             user=admin_user,
@@ -447,7 +473,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     # collabora admin credentials for initial owner user
-    collabora_admin_id = bitwarden.create_login(
+    logins['collabora_admin'] = dict(
             name=f'collabora-admin-credentials-{collabora_hostname}',
             item_url=collabora_hostname,
             user=collabora_user,
@@ -456,7 +482,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # smtp credentials
     smtpHost = create_custom_field("hostname", mail_host)
-    smtp_id = bitwarden.create_login(
+    logins['smtp'] = dict(
             name='nextcloud-smtp-credentials',
             item_url=nextcloud_hostname,
             user=mail_user,
@@ -465,7 +491,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     # postgres db credentials creation
-    db_id = bitwarden.create_login(
+    logins['db'] = dict(
             name='nextcloud-pgsql-credentials',
             item_url=nextcloud_hostname,
             user='nextcloud',
@@ -474,25 +500,30 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # redis credentials creation
     nextcloud_redis_password = bitwarden.generate()
-    redis_id = bitwarden.create_login(
+    logins['redis'] = dict(
             name='nextcloud-redis-credentials',
             item_url=nextcloud_hostname,
             user='nextcloud',
             password=nextcloud_redis_password
             )
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+    if oidc_creds:
+        oidc_id = item_ids['oidc']
+
     # update the nextcloud values for the argocd appset
     argocd.update_appset_secret(
-            {'nextcloud_admin_credentials_bitwarden_id': admin_id,
+            {'nextcloud_admin_credentials_bitwarden_id': item_ids['admin'],
              'nextcloud_oidc_credentials_bitwarden_id': oidc_id,
-             'nextcloud_smtp_credentials_bitwarden_id': smtp_id,
-             'nextcloud_postgres_credentials_bitwarden_id': db_id,
-             'nextcloud_redis_bitwarden_id': redis_id,
-             'nextcloud_s3_admin_credentials_bitwarden_id': s3_admin_id,
-             'nextcloud_s3_postgres_credentials_bitwarden_id': s3_db_id,
-             'nextcloud_s3_nextcloud_credentials_bitwarden_id': s3_id,
-             'nextcloud_s3_backups_credentials_bitwarden_id': s3_backups_id,
-             'collabora_admin_credentials_bitwarden_id': collabora_admin_id
+             'nextcloud_smtp_credentials_bitwarden_id': item_ids['smtp'],
+             'nextcloud_postgres_credentials_bitwarden_id': item_ids['db'],
+             'nextcloud_redis_bitwarden_id': item_ids['redis'],
+             'nextcloud_s3_admin_credentials_bitwarden_id': item_ids['s3_admin'],
+             'nextcloud_s3_postgres_credentials_bitwarden_id': item_ids['s3_db'],
+             'nextcloud_s3_nextcloud_credentials_bitwarden_id': item_ids['s3'],
+             'nextcloud_s3_backups_credentials_bitwarden_id': item_ids['s3_backups'],
+             'collabora_admin_credentials_bitwarden_id': item_ids['collabora_admin']
             })
 
 
@@ -313,6 +313,9 @@ def setup_bitwarden_items(argocd: ArgoCD,
     """
     a function to setup all peertube related items in Bitwarden
     """
+
+    # all of this app's login items, which we create at the same time below
+    logins = {}
     # S3 credentials
     # endpoint that gets put into the secret should probably have http in it
     if "http" not in s3_endpoint:
@@ -333,7 +336,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     user_s3_access_key_obj = create_custom_field("s3PeertubeUserAccessKey", user_s3_access_key)
     video_s3_access_id_obj = create_custom_field("s3PeertubeVideoAccessID", video_s3_access_id)
     video_s3_access_key_obj = create_custom_field("s3PeertubeVideoAccessKey", video_s3_access_key)
-    s3_id = bitwarden.create_login(
+    logins['s3'] = dict(
             name='peertube-user-s3-credentials',
             item_url=peertube_hostname,
             user=s3_access_id,
@@ -354,7 +357,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     pgsql_s3_key = create_password()
-    s3_db_id = bitwarden.create_login(
+    logins['s3_db'] = dict(
             name='peertube-postgres-s3-credentials',
             item_url=peertube_hostname,
             user="peertube-postgres",
@@ -362,7 +365,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
             )
 
     admin_s3_key = create_password()
-    s3_admin_id = bitwarden.create_login(
+    logins['s3_admin'] = dict(
             name='peertube-admin-s3-credentials',
             item_url=peertube_hostname,
             user="peertube-root",
@@ -371,7 +374,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # credentials for remote backups of the s3 PVC
     restic_repo_pass_obj = create_custom_field("resticRepoPassword", restic_repo_pass)
-    s3_backups_id = bitwarden.create_login(
+    logins['s3_backups'] = dict(
             name='peertube-backups-s3-credentials',
             item_url=peertube_hostname,
             user=backups_s3_user,
@@ -383,7 +386,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     peertube_pgsql_password = bitwarden.generate()
     postrges_pass_obj = create_custom_field("postgresPassword",
                                             peertube_pgsql_password)
-    db_id = bitwarden.create_login(
+    logins['db'] = dict(
             name='peertube-pgsql-credentials',
             item_url=peertube_hostname,
             user='peertube',
@@ -393,7 +396,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # valkey credentials
     peertube_valkey_password = bitwarden.generate()
-    valkey_id = bitwarden.create_login(
+    logins['valkey'] = dict(
             name='peertube-valkey-credentials',
             item_url=peertube_hostname,
             user='peertube',
@@ -403,7 +406,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
     # SMTP credentials
     peertube_smtp_host_obj = create_custom_field("smtpHostname", mail_host)
     peertube_smtp_port_obj = create_custom_field("smtpPort", mail_port)
-    smtp_id = bitwarden.create_login(
+    logins['smtp'] = dict(
             name='peertube-smtp-credentials',
             item_url=peertube_hostname,
             user=mail_user,
@@ -413,7 +416,7 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # peertube random secret
     peertube_secret = create_password()
-    secrets_id = bitwarden.create_login(
+    logins['secrets'] = dict(
             name='peertube-server-secret',
             item_url=peertube_hostname,
             user="peertube",
@@ -422,24 +425,27 @@ def setup_bitwarden_items(argocd: ArgoCD,
 
     # peertube admin credentials
     password = create_password()
-    admin_id = bitwarden.create_login(
+    logins['admin'] = dict(
             name='peertube-admin-credentials',
             item_url=peertube_hostname,
             user=admin_email,
             password=password
             )
 
+    # check every item for duplicates at once, and then save them together
+    item_ids = bitwarden.create_logins(logins)
+
     # update the peertube values for the argocd appset
     argocd.update_appset_secret(
-            {'peertube_smtp_credentials_bitwarden_id': smtp_id,
-             'peertube_admin_credentials_bitwarden_id': admin_id,
-             'peertube_postgres_credentials_bitwarden_id': db_id,
-             'peertube_valkey_bitwarden_id': valkey_id,
-             'peertube_s3_admin_credentials_bitwarden_id': s3_admin_id,
-             'peertube_s3_postgres_credentials_bitwarden_id': s3_db_id,
-             'peertube_s3_peertube_credentials_bitwarden_id': s3_id,
-             'peertube_s3_backups_credentials_bitwarden_id': s3_backups_id,
-             'peertube_secret_bitwarden_id': secrets_id})
+            {'peertube_smtp_credentials_bitwarden_id': item_ids['smtp'],
+             'peertube_admin_credentials_bitwarden_id': item_ids['admin'],
+             'peertube_postgres_credentials_bitwarden_id': item_ids['db'],
+             'peertube_valkey_bitwarden_id': item_ids['valkey'],
+             'peertube_s3_admin_credentials_bitwarden_id': item_ids['s3_admin'],
+             'peertube_s3_postgres_credentials_bitwarden_id': item_ids['s3_db'],
+             'peertube_s3_peertube_credentials_bitwarden_id': item_ids['s3'],
+             'peertube_s3_backups_credentials_bitwarden_id': item_ids['s3_backups'],
+             'peertube_secret_bitwarden_id': item_ids['secrets']})
 
     # reload the bitwarden ESO provider
     try:
@@ -488,6 +494,8 @@ def restore_peertube(argocd: ArgoCD,
                 f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
                 f"{argo_path}external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
         # postgresql s3 ID
@@ -541,6 +549,7 @@ def restore_peertube(argocd: ArgoCD,
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argo_path}pvc_argocd_appset.yaml"
             )
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(podconfig_yaml, argocd.namespace)
 
     # then we begin the restic restore of all the peertube PVCs we lost
@@ -167,6 +167,8 @@ def restore_valkey(argocd: ArgoCD,
                 f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
                 f"{argo_path}external_secrets_argocd_appset.yaml"
                 )
+        # the external secrets need the bitwarden IDs we just buffered
+        argocd.flush_appset_secret()
         argocd.k8s.apply_manifests(external_secrets_yaml, argocd.namespace)
 
     # then we create all the seaweedfs pvcs we lost and restore them
@@ -176,6 +178,7 @@ def restore_valkey(argocd: ArgoCD,
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argo_path}pvc_argocd_appset.yaml"
             )
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(podconfig_yaml, argocd.namespace)
 
     # then we begin the restic restore of all the valkey PVCs we lost
@@ -1,4 +1,5 @@
 # internal smol-k8s-lab libraries
+from ..constants import XDG_CACHE_DIR
 from ..k8s_tools.k8s_lib import K8s
 from ..utils.rich_cli.console_logging import sub_header, header
 from ..utils.run.subproc import subproc
@@ -8,84 +9,171 @@ from .k3d import create_k3d_cluster, delete_k3d_cluster
 from .k3s import install_k3s_cluster, uninstall_k3s
 
 # external libraries from standard lib
-from json import loads
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+from kubernetes import client, config
 import logging as log
+from os import path, replace
 from platform import machine, system
 from sys import exit
+from time import time
+from typing import Callable
 
+# seconds to remember each kubeconfig context's version info, so the TUI opens
+# quickly, even with lots of contexts or ones for clusters that are gone
+CONTEXT_CACHE_TTL = 300
+CONTEXT_CACHE_FILE = path.join(XDG_CACHE_DIR, 'contexts.json')
+# seconds to wait for each cluster's api server to answer
+CONTEXT_PROBE_TIMEOUT = 3
+# max number of clusters to ask for their version at the same time
+CONTEXT_PROBE_WORKERS = 8
 
-def check_all_contexts() -> list:
+
+def guess_distro(cluster_name: str, version: str) -> str:
     """
-    gets current context and returns and list of tuples like:
-        [(cluster_name, distro, version, platform)]
+    returns our best guess at the k8s distro of a cluster from its name and
+    server version, or "unknown" if we can't figure it out
     """
-    start_context = subproc(["kubectl config current-context"],
-                            error_ok=True, quiet=True)
-    print(f"Current context at the start is {start_context}")
+    # if k3s is in the git version, it could be k3s OR k3d
+    if "k3d" in cluster_name:
+        return "k3d"
 
-    all_contexts = subproc(["kubectl config get-contexts --no-headers"],
-                           error_ok=True, quiet=True)
-    return_contexts = []
+    # it might still be k3s if created outside of smol-k8s-lab, so we check
+    # the version
+    if "k3s" in cluster_name or "k3s" in version:
+        return "k3s"
 
-    if all_contexts:
-        # split all contexts outputs into a list of context lines
-        for k8s_context in all_contexts.split('\n'):
+    # if distro not k3s/k3d, we kinda guess :)
+    for distro_name in ["kind", "gke", "aks", "eks"]:
+        if distro_name in cluster_name:
+            return distro_name
+
+    return "unknown"
 
-            # split each context into fields
-            fields = k8s_context.split()
 
-            # HACK: I honestly have no clue why fields is empty sometimes &
-            # don't have time to troubleshoot it either 🤦
-            if fields:
-                # set the cluster name, making sure to not get the * context
-                if fields[0] and fields[0] != "*":
-                    cluster_name = fields[0]
-                    # change context only if it isn't already the current-context
-                    subproc([f"kubectl config use-context {cluster_name}"])
-                else:
-                    cluster_name = fields[1]
-
-                # get the version info for the distro and platform
-                version_json = loads(subproc(["kubectl version -o json"]))
-
-                # for k3s, this is nested in serverVersion
-                # for kind or k3d, it may not be present if docker is not enabled
-                server_version = version_json.get('serverVersion', None)
-                if server_version:
-                    version = server_version['gitVersion']
-                    os = server_version['platform']
-                else:
-                    log.error("Couldn't get server verison or platform. Is docker running?")
-                    version = "unknown"
-                    os = system() + "/" + machine()
-
-                # default the k8s distro to unknown in case we can't figure it out
-                distro = "unknown"
-
-                # if k3s is in the git version, it could be k3s OR k3d
-                if "k3d" in cluster_name:
-                    distro = "k3d"
-                elif "k3d" not in cluster_name:
-                    if "k3s" in cluster_name or "k3s" in version:
-                        distro = "k3s"
-                    else:
-                        # it might still be k3s if created outside of smol-k8s-lab
-                        # so we check the version
-
-                        # if distro not k3s/k3d, we kinda guess :)
-                        for distro_name in ["kind", "gke", "aks", "eks"]:
-                            if distro_name in cluster_name:
-                                distro = distro_name
-                                break
-
-                context_tuple = (cluster_name, distro, version, os)
-
-                return_contexts.append(context_tuple)
-
-        # set the cluster back to the starting context if we changed it
-        subproc([f"kubectl config use-context {start_context}"])
-
-    return return_contexts
+def probe_context(context_name: str,
+                  timeout: int = CONTEXT_PROBE_TIMEOUT) -> tuple:
+    """
+    asks the api server of a kubeconfig context for its /version, without
+    changing the current context, and returns a tuple like:
+        (cluster_name, distro, version, platform)
+    """
+    try:
+        configuration = client.Configuration()
+        config.load_kube_config(context=context_name,
+                                client_configuration=configuration)
+        # fail fast instead of retrying clusters that aren't there anymore
+        configuration.retries = 0
+        with client.ApiClient(configuration) as api_client:
+            server_version = client.VersionApi(api_client).get_code(
+                    _request_timeout=timeout)
+        version = server_version.git_version
+        os = server_version.platform
+    except Exception as e:
+        # for kind or k3d, this fails if docker is not running
+        log.error(f"Couldn't get server version or platform for {context_name}."
+                  f" Is docker running? {e}")
+        version = "unreachable"
+        os = system() + "/" + machine()
+
+    return (context_name, guess_distro(context_name, version), version, os)
+
+
+def load_context_cache() -> dict:
+    """
+    returns the dict of {context: {"key": list, "checked": float, "row": list}}
+    from the last time we probed each kubeconfig context
+    """
+    try:
+        with open(CONTEXT_CACHE_FILE, 'r') as cache_contents:
+            return json.load(cache_contents)
+    except (OSError, ValueError):
+        return {}
+
+
+def list_contexts() -> list:
+    """
+    returns the list of context dicts in the kubeconfig, or an empty list if
+    there's no kubeconfig or it has no contexts
+    """
+    try:
+        all_contexts, _ = config.list_kube_config_contexts()
+    except (config.ConfigException, OSError) as e:
+        log.debug(f"Couldn't read any contexts from the kubeconfig: {e}")
+        return []
+    return all_contexts
+
+
+def cached_contexts() -> list:
+    """
+    returns the rows we saved the last time we probed each context that's
+    still in the kubeconfig, no matter how old they are, like:
+        [(cluster_name, distro, version, platform)]
+    """
+    cache = load_context_cache()
+    return [tuple(cache[k8s_context['name']]['row'])
+            for k8s_context in list_contexts()
+            if k8s_context['name'] in cache]
+
+
+def check_all_contexts(ttl: int = CONTEXT_CACHE_TTL,
+                       refresh: bool = False,
+                       max_workers: int = CONTEXT_PROBE_WORKERS,
+                       on_probed: Callable[[tuple], None] = None) -> list:
+    """
+    reads all the contexts in the kubeconfig, and returns a list of tuples like:
+        [(cluster_name, distro, version, platform)]
+
+    Contexts we probed less than ttl seconds ago come from the cache, unless
+    refresh is True, and the rest are probed at the same time, max_workers at
+    a time. If on_probed is passed in, it's called with each probed row as
+    soon as that cluster answers (or doesn't). This never changes the current
+    context.
+    """
+    all_contexts = list_contexts()
+    if not all_contexts:
+        return []
+
+    cache = load_context_cache()
+    rows = {}
+    to_probe = []
+
+    for k8s_context in all_contexts:
+        name = k8s_context['name']
+        # if the cluster or user for a context changes, we probe it again
+        key = [k8s_context['context'].get('cluster', ''),
+               k8s_context['context'].get('user', '')]
+        cached = cache.get(name, {})
+        if (not refresh and cached.get('key') == key
+                and time() - cached.get('checked', 0) < ttl):
+            rows[name] = tuple(cached['row'])
+        else:
+            to_probe.append((name, key))
+
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {executor.submit(probe_context, name): (name, key)
+                       for name, key in to_probe}
+            for future in as_completed(futures):
+                name, key = futures[future]
+                row = future.result()
+                rows[name] = row
+                cache[name] = {"key": key, "checked": time(), "row": list(row)}
+                if on_probed:
+                    on_probed(row)
+
+        # forget any contexts that aren't in the kubeconfig anymore
+        cache = {name: cache[name] for name in rows}
+        try:
+            # write to a temp file first, so a crash can't leave half a file
+            with open(CONTEXT_CACHE_FILE + ".tmp", 'w') as cache_contents:
+                json.dump(cache, cache_contents, indent=2)
+            replace(CONTEXT_CACHE_FILE + ".tmp", CONTEXT_CACHE_FILE)
+        except OSError as e:
+            log.debug(f"Couldn't save the kubeconfig context cache: {e}")
+
+    # keep the same order as the kubeconfig
+    return [rows[k8s_context['name']] for k8s_context in all_contexts]
 
 
 def check_contexts_for_cluster(cluster_name: str,
@@ -124,7 +212,8 @@ def create_k8s_distro(cluster_name: str,
                       k8s_distro: str,
                       distro_metadata: dict = {},
                       metallb_enabled: bool = True,
-                      cilium_enabled: bool = False) -> K8s:
+                      cilium_enabled: bool = False,
+                      snapshot: str = "") -> K8s:
     """
     Install a specific distro of k8s
 
@@ -136,6 +225,7 @@ def create_k8s_distro(cluster_name: str,
                           servicelb for k3s
         cilium_enabled:   if we're enabling cilium it requires we disable flannel
                           for k3s and disable network-policy for all distros
+        snapshot:         path to a golden snapshot to start a k3d cluster from
 
     Returns K8s object with current context selected
     """
@@ -159,7 +249,8 @@ def create_k8s_distro(cluster_name: str,
                             kubelet_args,
                             networking_args,
                             distro_metadata['nodes']['control_plane'],
-                            distro_metadata['nodes']['workers'])
+                            distro_metadata['nodes']['workers'],
+                            distro_metadata.get('registry_mirrors', False))
 
     elif k8s_distro == "k3s" or k8s_distro == "k3d":
         # get any extra args the user has passed in
@@ -178,14 +269,20 @@ def create_k8s_distro(cluster_name: str,
             k3s_args['disable-network-policy'] = True
 
         if k8s_distro == "k3s":
-            install_k3s_cluster(cluster_name, k3s_args, distro_metadata['nodes'])
+            install_k3s_cluster(cluster_name,
+                                k3s_args,
+                                distro_metadata['nodes'],
+                                distro_metadata.get('version', ''),
+                                distro_metadata.get('airgap_images', False))
 
         # curently unsupported - in alpha state
         if k8s_distro == "k3d":
             create_k3d_cluster(cluster_name,
                                k3s_args,
                                distro_metadata['nodes']['control_plane'],
-                               distro_metadata['nodes']['workers'])
+                               distro_metadata['nodes']['workers'],
+                               distro_metadata.get('registry_mirrors', False),
+                               snapshot)
 
     return K8s()
 
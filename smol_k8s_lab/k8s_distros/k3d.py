@@ -8,6 +8,8 @@ DESCRIPTION: install k3d :D Not affiliated with k3s, rancher, or suse. just a fa
 from ..utils.rich_cli.console_logging import sub_header
 from ..utils.run.subproc import subproc
 from ..constants import XDG_CACHE_DIR
+from .registry_mirrors import start_registry_mirrors
+from .snapshots import clean_k3d_restores, prepare_k3d_restore, K3S_SERVER_DIR
 import logging as log
 from yaml import dump
 
@@ -15,20 +17,35 @@ from yaml import dump
 # where we write this config
 K3D_CFG_FILENAME = f"{XDG_CACHE_DIR}/k3d-config.yaml"
 
+# docker network we share with the registry mirrors, if they're enabled
+K3D_MIRRORS_NETWORK = "smol-k8s-lab"
+
 
 def create_k3d_cluster(cluster_name: str,
                         k3s_yaml: dict,
                         control_plane_nodes: int = 1,
-                        worker_nodes: int = 0) -> None:
+                        worker_nodes: int = 0,
+                        registry_mirrors: bool = False,
+                        snapshot: str = "") -> None:
     """
-    python installation for k3d
+    python installation for k3d. If registry_mirrors is True, the nodes pull
+    images through local registry mirrors that are kept between clusters. If
+    snapshot is the path to a golden snapshot, the cluster starts from it
     """
     sub_header("Creating k3d cluster...")
 
+    mirrors = {}
+    if registry_mirrors:
+        mirrors = start_registry_mirrors(K3D_MIRRORS_NETWORK)
+
+    restore = prepare_k3d_restore(cluster_name, snapshot) if snapshot else {}
+
     k3d_cfg = K3dConfig(cluster_name,
                         k3s_yaml,
                         control_plane_nodes,
-                        worker_nodes)
+                        worker_nodes,
+                        mirrors,
+                        restore)
     k3d_cfg.write_yaml()
 
     # actually running the k3d command
@@ -44,6 +61,7 @@ def delete_k3d_cluster(cluster_name: str) -> str:
         cluster_name = cluster_name.replace("k3d-", "")
 
     res = subproc([f'k3d cluster delete {cluster_name}'])
+    clean_k3d_restores(cluster_name)
     return res
 
 
@@ -55,7 +73,9 @@ class K3dConfig():
                  cluster_name: str,
                  k3s_yaml: dict,
                  control_plane_nodes: int = 1,
-                 worker_nodes: int = 0) -> None:
+                 worker_nodes: int = 0,
+                 registry_mirrors: dict = {},
+                 restore: dict = {}) -> None:
 
         # base config for k3s
         self.k3d_cfg = {"apiVersion": "k3d.io/v1alpha5",
@@ -69,6 +89,23 @@ class K3dConfig():
                             }
                         }
 
+        # put the nodes on the same network as the mirrors, and have k3s try
+        # the mirrors before the real registry
+        if registry_mirrors:
+            self.k3d_cfg["network"] = K3D_MIRRORS_NETWORK
+            mirrors = {registry: {"endpoint": [endpoint]}
+                       for registry, endpoint in registry_mirrors.items()}
+            self.k3d_cfg["registries"] = {"config": dump({"mirrors": mirrors})}
+
+        # start the first server from a copy of a golden snapshot, with the
+        # same token the snapshot's datastore was encrypted with
+        if restore:
+            self.k3d_cfg["token"] = restore["token"]
+            self.k3d_cfg["volumes"] = [
+                    {"volume": f"{restore['server_dir']}:{K3S_SERVER_DIR}",
+                     "nodeFilters": ["server:0"]}
+                    ]
+
         # filter for which nodes to apply which k3s args to
         self.node_filters = []
 
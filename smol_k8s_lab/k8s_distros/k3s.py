@@ -8,44 +8,167 @@ DESCRIPTION: install k3s :D not affiliated with rancher, suse, or k3s
 # local libraries
 from ..constants import USER, KUBECONFIG
 from ..constants import XDG_CACHE_DIR
+from ..k8s_tools.k8s_lib import K8s
 from ..utils.run.subproc import subproc
 
 # external libraries
+from hashlib import sha256
 import logging as log
-from os import chmod, remove, path
+from os import chmod, environ, makedirs, path, replace
+from platform import machine
 import requests
 import stat
 from ruamel.yaml import YAML
-from time import sleep
+from time import time
+from urllib.parse import quote
+
+# max number of nodes to join to the cluster at the same time
+K3S_JOIN_WORKERS = 4
+
+# where we keep the k3s installer, binaries, and airgap images between runs
+K3S_CACHE_DIR = path.join(XDG_CACHE_DIR, 'k3s')
+# seconds before we check for a newer k3s installer script
+K3S_INSTALLER_TTL = 86400
+K3S_RELEASES_URL = "https://github.com/k3s-io/k3s/releases/download"
+# where k3s looks for airgap images tarballs to import on startup
+K3S_IMAGES_DIR = "/var/lib/rancher/k3s/agent/images"
+
+
+def sha256_file(file_path: str) -> str:
+    """
+    returns the sha256 hex digest of a file, without reading it all at once
+    """
+    digest = sha256()
+    with open(file_path, 'rb') as file_contents:
+        for chunk in iter(lambda: file_contents.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(url: str, file_path: str) -> str:
+    """
+    downloads url to file_path, via a temp file so we never leave half a file
+    in the cache, and returns the sha256 of what we downloaded
+    """
+    log.info(f"Downloading {url}")
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with requests.get(url, stream=True, timeout=30) as res:
+        res.raise_for_status()
+        with open(file_path + ".tmp", 'wb') as tmp_file:
+            for chunk in res.iter_content(chunk_size=1024 * 1024):
+                tmp_file.write(chunk)
+    replace(file_path + ".tmp", file_path)
+    return sha256_file(file_path)
+
+
+def k3s_arch(machine_name: str) -> str:
+    """
+    returns the k3s release name for an architecture from uname -m
+    """
+    if machine_name in ["aarch64", "arm64"]:
+        return "arm64"
+    if machine_name.startswith("arm"):
+        return "arm"
+    return "amd64"
+
+
+def get_k3s_installer(ttl: int = K3S_INSTALLER_TTL) -> str:
+    """
+    returns the path to the cached k3s install script, downloading it from
+    get.k3s.io if we don't have it, it's older than ttl seconds, or it doesn't
+    match the sha256 we saved when we downloaded it. If get.k3s.io can't be
+    reached, we use the cached one anyway, as long as its sha256 matches
+    """
+    installer = path.join(K3S_CACHE_DIR, "install.sh")
+    checksum_file = installer + ".sha256"
+
+    verified = False
+    if path.exists(installer) and path.exists(checksum_file):
+        with open(checksum_file, 'r') as checksum:
+            verified = checksum.read().strip() == sha256_file(installer)
+        if not verified:
+            log.warning(f"{installer} doesn't match its checksum, so we'll "
+                        "download it again")
+
+    if not verified or time() - path.getmtime(installer) > ttl:
+        try:
+            digest = download("https://get.k3s.io", installer)
+        except requests.RequestException as e:
+            if not verified:
+                raise
+            log.warning(f"Couldn't download the k3s installer, so we're using "
+                        f"the cached one: {e}")
+        else:
+            with open(checksum_file, 'w') as checksum:
+                checksum.write(digest)
+
+    # make sure we can actually execute the script
+    chmod(installer, stat.S_IRWXU)
+    return installer
+
+
+def get_k3s_artifacts(version: str, arch: str, airgap_images: bool = False) -> dict:
+    """
+    returns a dict with the path to the cached k3s binary for a version and
+    architecture, and the airgap images tarball if airgap_images is True.
+    Both are checked against the sha256sum file from the k3s release, and
+    only downloaded if they're missing or don't match it
+    """
+    release_dir = path.join(K3S_CACHE_DIR, version.replace("+", "-"), arch)
+    release_url = f"{K3S_RELEASES_URL}/{quote(version)}"
+
+    # the checksums for a release never change, so we only download them once
+    sums_file = path.join(release_dir, f"sha256sum-{arch}.txt")
+    if not path.exists(sums_file):
+        download(f"{release_url}/sha256sum-{arch}.txt", sums_file)
+    with open(sums_file, 'r') as sums:
+        checksums = {line.split()[1]: line.split()[0]
+                     for line in sums if line.strip()}
+
+    names = {"binary": {"amd64": "k3s", "arm64": "k3s-arm64", "arm": "k3s-armhf"}[arch]}
+    if airgap_images:
+        names["images"] = f"k3s-airgap-images-{arch}.tar.zst"
+
+    artifacts = {}
+    for artifact, name in names.items():
+        file_path = path.join(release_dir, name)
+        if path.exists(file_path) and sha256_file(file_path) == checksums[name]:
+            log.debug(f"Using cached {file_path}")
+        elif download(f"{release_url}/{name}", file_path) != checksums[name]:
+            raise Exception(f"Downloaded {name} for k3s {version} doesn't match "
+                            "the release's sha256 checksum")
+        artifacts[artifact] = file_path
+
+    return artifacts
 
 
 def install_k3s_cluster(cluster_name: str,
                         extra_k3s_parameters: dict = {
                             "write-kubeconfig-mode": 700
                             },
-                        extra_nodes: dict = {}
+                        extra_nodes: dict = {},
+                        version: str = "",
+                        airgap_images: bool = False
                         ) -> None:
     """
     python installation for k3s, emulates curl -sfL https://get.k3s.io | sh -
     Notes: --flannel-backend=none will break k3s on metal
+
+    If version is set, we use a cached and checksum verified k3s binary (and
+    airgap images tarball, if airgap_images is True) instead of letting the
+    install script download them, and we copy them to any extra nodes too
     """
     # always prepend k3s- to the beginning of the cluster name
     if not cluster_name.startswith("k3s-"):
         cluster_name = "k3s-" + cluster_name
 
-    # download the k3s installer if we don't have it here already
-    url = requests.get("https://get.k3s.io")
-    k3s_installer_file = open("./install.sh", "wb")
-    k3s_installer_file.write(url.content)
-    k3s_installer_file.close()
-
-    # make sure we can actually execute the script
-    chmod("./install.sh", stat.S_IRWXU)
+    # get the k3s installer from our cache, or download it if we need to
+    installer = get_k3s_installer()
 
     # for creating a config file for k3s
     k3s_yaml_file = XDG_CACHE_DIR + '/k3s.yml'
     # install command to create k3s cluster (just one server, control plane, node)
-    install_cmd = f'./install.sh --config {k3s_yaml_file}'
+    install_cmd = f'{installer} --config {k3s_yaml_file}'
 
     config_dict = extra_k3s_parameters
 
@@ -54,91 +177,172 @@ def install_k3s_cluster(cluster_name: str,
     with open(k3s_yaml_file, 'w') as k3s_cfg:
         yaml.dump(config_dict, k3s_cfg)
 
-    subproc([install_cmd], spinner=False)
+    install_env = dict(environ)
+    if version:
+        artifacts = get_k3s_artifacts(version, k3s_arch(machine()), airgap_images)
+        cmds = [f"sudo install -m 755 {artifacts['binary']} /usr/local/bin/k3s"]
+        if airgap_images:
+            cmds.extend([f"sudo mkdir -p {K3S_IMAGES_DIR}",
+                         f"sudo cp {artifacts['images']} {K3S_IMAGES_DIR}/"])
+        subproc(cmds, spinner=False)
+        install_env.update({"INSTALL_K3S_SKIP_DOWNLOAD": "true",
+                            "INSTALL_K3S_VERSION": version})
+
+    subproc([install_cmd], spinner=False, env=install_env)
 
     # adds our newly created cluster for k3s to the user's kubeconfig
     update_user_kubeconfig(cluster_name)
 
-    # remove the script after we're done
-    remove('./install.sh')
-
     # if we have extra remote nodes to join to the cluster...
     if extra_nodes:
-        join_k3s_nodes(extra_nodes)
+        join_k3s_nodes(extra_nodes, version=version, airgap_images=airgap_images)
 
 
-def join_k3s_nodes(extra_nodes: dict) -> None:
+def ssh_command(node: str, metadata: dict) -> str:
     """
-    process extra remote nodes to join to the cluster as well as apply any labels,
-    or taints, after we're done joining the node
+    returns the start of an ssh command for a node, which shares one
+    multiplexed connection to the node for every command we run on it
     """
-    # this gets the internal ip address of our current control plane node
-    ip_cmd = ("kubectl get nodes -o custom-columns=NAME:.status.addresses[0].address"
-              " -l node-role.kubernetes.io/master --no-headers")
-
-    k3s_control_plane_ip = subproc([ip_cmd])
-
-    # we loop b/c sometimes the server isn't ready yet, so this might return None
-    while not k3s_control_plane_ip:
-        # sleep 3 seconds to avoid clogging the logs
-        sleep(3)
-        k3s_control_plane_ip = subproc([ip_cmd])
-
-    # strips new line character from end of ip address
-    internal_ip = k3s_control_plane_ip.strip()
-
-    # token from the server is needed for the new agent
-    k3s_token = subproc(["sudo cat /var/lib/rancher/k3s/server/node-token"]).strip()
-    k3s_cmd = ('\'curl -sfL https://get.k3s.io | '
-               f'K3S_URL="https://{internal_ip}:6443" '
-               f'K3S_TOKEN="{k3s_token}" sh -\'')
-
-    # for each node and it's meta data, ssh in and join the node
-    for node, metadata in extra_nodes.items():
-        ssh_cmd = "ssh -o StrictHostKeyChecking=no "
+    control_path = path.join(XDG_CACHE_DIR, "ssh-%C")
+    ssh_cmd = ("ssh -o StrictHostKeyChecking=no -o ControlMaster=auto "
+               f"-o ControlPath={control_path} -o ControlPersist=60s ")
 
-        # only add the port if it's not 22
-        ssh_port = metadata.get('ssh_port', '22')
-        if str(ssh_port) != "22":
-            ssh_cmd += f"-p {ssh_port} "
-        else:
-            ssh_cmd += f"{node} "
+    # only add the port if it's not 22
+    ssh_port = metadata.get('ssh_port', '22')
+    if str(ssh_port) != "22":
+        ssh_cmd += f"-p {ssh_port} "
 
-        # only add the ssh key if it's not id_rsa
-        ssh_key = metadata.get('ssh_key', 'id_rsa')
-        if ssh_key != "id_rsa":
-            ssh_cmd += f"-i {ssh_key} {node} "
-        else:
-            ssh_cmd += f"{node} "
+    # only add the ssh key if it's not id_rsa
+    ssh_key = metadata.get('ssh_key', 'id_rsa')
+    if ssh_key != "id_rsa":
+        ssh_cmd += f"-i {ssh_key} "
 
-        # join node to cluster
-        subproc([ssh_cmd + k3s_cmd], shell=True, universal_newlines=True)
+    return ssh_cmd + f"{node} "
 
 
-        # check if we have taints or labels to apply to this new node
-        labels = metadata.get('node_labels', None)
-        taints = metadata.get('node_taints', None)
-        if labels or taints:
-            log.debug(f"Checking if {node} is ready for labeling and/or tainting.")
+def node_patch(node: dict, labels: list = [], taints: list = []) -> dict:
+    """
+    returns one patch for a node dict with all the labels, e.g. "key=value",
+    and taints, e.g. "key=value:NoSchedule", we want to add to it
+    """
+    patch = {}
+    if labels:
+        patch["metadata"] = {"labels": {}}
+        for label in labels:
+            key, _, value = label.partition("=")
+            patch["metadata"]["labels"][key] = value
+
+    if taints:
+        # taints are replaced as a whole list, so keep the existing ones
+        node_taints = list(node.get('spec', {}).get('taints', None) or [])
+        for taint in taints:
+            key_value, _, effect = taint.partition(":")
+            key, _, value = key_value.partition("=")
+            new_taint = {"key": key, "effect": effect}
+            if value:
+                new_taint["value"] = value
+            node_taints = [existing for existing in node_taints
+                           if (existing['key'], existing['effect']) != (key, effect)]
+            node_taints.append(new_taint)
+        patch["spec"] = {"taints": node_taints}
+
+    return patch
+
+
+def join_k3s_nodes(extra_nodes: dict,
+                   max_workers: int = K3S_JOIN_WORKERS,
+                   version: str = "",
+                   airgap_images: bool = False) -> None:
+    """
+    process extra remote nodes to join to the cluster as well as apply any labels,
+    or taints, after we're done joining the node. Nodes are joined max_workers
+    at a time, and then we watch for all of them to register at once.
 
-            k_get_nodes = subproc(["kubectl get nodes"])
+    We copy our cached k3s installer to each node over ssh, so the nodes don't
+    download it. If version is set, we also copy the cached k3s binary for each
+    node's architecture (and the airgap images, if airgap_images is True)
+    """
 
-            # if new node is not available, keep checking
-            while node not in k_get_nodes:
-                log.info(f"Waiting for {node} to be available")
-                sleep(1)
-                k_get_nodes = subproc(["kubectl get nodes"])
+    k8s = K8s()
 
-            # apply labels to new node
-            if labels:
-                for label in labels:
-                    subproc([f"kubectl label nodes {node} {label}"])
+    # this gets the internal ip address of our current control plane node. We
+    # wait b/c sometimes the server isn't ready yet, so it might not have one
+    control_plane = k8s.wait_for(
+            "v1", "Node", "",
+            lambda node: bool(node.get('status', {}).get('addresses')),
+            label_selector="node-role.kubernetes.io/master")[0]
+    addresses = control_plane['status']['addresses']
+    internal_ip = next((address['address'] for address in addresses
+                        if address['type'] == "InternalIP"),
+                       addresses[0]['address'])
 
-            # apply taints to new node
-            if taints:
-                for taint in taints:
-                    subproc([f"kubectl taint nodes {node} {taint}"],
-                            error_ok=True)
+    # token from the server is needed for the new agent
+    k3s_token = subproc(["sudo cat /var/lib/rancher/k3s/server/node-token"]).strip()
+    k3s_env = f'K3S_URL="https://{internal_ip}:6443" K3S_TOKEN="{k3s_token}"'
+    if version:
+        k3s_env += f' INSTALL_K3S_SKIP_DOWNLOAD=true INSTALL_K3S_VERSION="{version}"'
+
+    installer = get_k3s_installer()
+
+    # we need to know each node's architecture to copy the right k3s binary
+    if version:
+        arches = subproc([ssh_command(node, metadata) + "uname -m"
+                          for node, metadata in extra_nodes.items()],
+                         shell=True,
+                         universal_newlines=True,
+                         quiet=True,
+                         parallel=True,
+                         max_workers=max_workers)
+        node_arches = {node: k3s_arch(arch.strip())
+                       for node, arch in zip(extra_nodes, arches)}
+        artifacts = {arch: get_k3s_artifacts(version, arch, airgap_images)
+                     for arch in set(node_arches.values())}
+
+    # for each node, copy everything over its ssh connection and then join it
+    cmds = []
+    for node, metadata in extra_nodes.items():
+        ssh_cmd = ssh_command(node, metadata)
+        node_cmds = [f"{ssh_cmd}'cat > /tmp/k3s-install.sh' < {installer}"]
+
+        if version:
+            node_artifacts = artifacts[node_arches[node]]
+            node_cmds.append(
+                    f"{ssh_cmd}'sudo tee /usr/local/bin/k3s > /dev/null && "
+                    f"sudo chmod 755 /usr/local/bin/k3s' < {node_artifacts['binary']}")
+            if airgap_images:
+                images = path.basename(node_artifacts['images'])
+                node_cmds.append(
+                        f"{ssh_cmd}'sudo mkdir -p {K3S_IMAGES_DIR} && sudo tee "
+                        f"{K3S_IMAGES_DIR}/{images} > /dev/null' < "
+                        f"{node_artifacts['images']}")
+
+        node_cmds.append(f"{ssh_cmd}'{k3s_env} sh /tmp/k3s-install.sh'")
+        cmds.append(" && ".join(node_cmds))
+
+    # ssh into all the nodes and join them to the cluster at the same time
+    subproc(cmds,
+            shell=True,
+            universal_newlines=True,
+            parallel=True,
+            max_workers=max_workers)
+
+    # check if we have taints or labels to apply to any of the new nodes
+    to_patch = {node: metadata for node, metadata in extra_nodes.items()
+                if metadata.get('node_labels') or metadata.get('node_taints')}
+    if not to_patch:
+        return
+
+    log.info(f"Waiting for {', '.join(to_patch)} to be available")
+    nodes = k8s.watch_until("v1", "Node", "",
+                            lambda nodes: set(to_patch).issubset(nodes))
+
+    # apply all the labels and taints for each node in one patch
+    for node, metadata in to_patch.items():
+        patch = node_patch(nodes[node],
+                           metadata.get('node_labels', None) or [],
+                           metadata.get('node_taints', None) or [])
+        log.debug(f"Patching node {node} with {patch}")
+        k8s.core_v1_api.patch_node(node, patch)
 
 
 def uninstall_k3s(cluster_name: str) ->  str:
@@ -147,17 +351,16 @@ def uninstall_k3s(cluster_name: str) ->  str:
     returns True
     """
     log.debug("Uninstalling k3s")
+    # the kubectl config commands all rewrite the same kubeconfig, so they run
+    # in order, but at the same time as the uninstall script
     cmds = ["k3s-uninstall.sh",
-            f"kubectl config delete-cluster {cluster_name}",
-            f"kubectl config delete-context {cluster_name}",
-            f"kubectl config delete-user {cluster_name}"]
+            [f"kubectl config delete-cluster {cluster_name}",
+             f"kubectl config delete-context {cluster_name}",
+             f"kubectl config delete-user {cluster_name}"]]
 
-    res = subproc(cmds, spinner=False, error_ok=True)
+    res = subproc(cmds, spinner=False, error_ok=True, parallel=True)
 
-    if isinstance(res, list):
-        return res.join('\n')
-    else:
-        return res
+    return '\n'.join([output for output in [res[0], *res[1]] if output])
 
 
 def update_user_kubeconfig(cluster_name: str = 'smol-k8s-lab-k3s') -> None:
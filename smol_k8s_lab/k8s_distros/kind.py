@@ -6,6 +6,7 @@ DESCRIPTION: create or delete a kind cluster, part of smol-k8s-lab
     LICENSE: GNU AFFERO GENERAL PUBLIC LICENSE Version 3
 """
 from ..constants import XDG_CACHE_DIR
+from .registry_mirrors import start_registry_mirrors
 from ..utils.rich_cli.console_logging import sub_header
 from ..utils.run.subproc import subproc
 import logging as log
@@ -26,9 +27,12 @@ def create_kind_cluster(cluster_name: str,
                         kubelet_args: dict = {},
                         networking_args: dict = {},
                         control_plane_nodes: int = 1,
-                        worker_nodes: int = 1) -> True:
+                        worker_nodes: int = 1,
+                        registry_mirrors: bool = False) -> True:
     """
-    Run installation process for kind and create cluster
+    Run installation process for kind and create cluster. If registry_mirrors
+    is True, the nodes pull images through local registry mirrors that are
+    kept between clusters
     returns True
     """
 
@@ -47,9 +51,12 @@ def create_kind_cluster(cluster_name: str,
 
     log.debug("Creating a kind cluster...")
 
+    # kind always puts its nodes on a docker network called kind
+    mirrors = start_registry_mirrors("kind") if registry_mirrors else {}
+
     kind_cfg = path.join(XDG_CACHE_DIR, 'kind_cfg.yaml')
     build_kind_config(kind_cfg, kubelet_args, networking_args,
-                      control_plane_nodes, worker_nodes)
+                      control_plane_nodes, worker_nodes, mirrors)
 
     cmd = f"kind create cluster --name {cluster_name} --config={kind_cfg}"
     subproc([cmd])
@@ -79,9 +86,11 @@ def build_kind_config(cfg_file: str = "~/.config/smol-k8s-lab/kind_cfg.yaml",
                       kubelet_extra_args: dict = {},
                       networking_args: dict = {},
                       control_plane_nodes: int = 1,
-                      worker_nodes: int = 0) -> None:
+                      worker_nodes: int = 0,
+                      registry_mirrors: dict = {}) -> None:
     """
-    builds a kind config including any extra kubelet or networking args and then
+    builds a kind config including any extra kubelet or networking args, and
+    any {registry: mirror endpoint} for containerd to pull through, and then
     writes it to a yaml in our cache dir
     """
     node_config = {'role': 'control-plane',
@@ -119,6 +128,15 @@ def build_kind_config(cfg_file: str = "~/.config/smol-k8s-lab/kind_cfg.yaml",
             'nodes': [node_config.copy()]
             }
 
+    # have containerd on every node try the mirrors before the real registry
+    if registry_mirrors:
+        containerd_patch = ""
+        for registry, endpoint in registry_mirrors.items():
+            containerd_patch += (
+                    '[plugins."io.containerd.grpc.v1.cri".registry.mirrors.'
+                    f'"{registry}"]\n  endpoint = ["{endpoint}"]\n')
+        kind_cfg['containerdConfigPatches'] = [pss(containerd_patch)]
+
     # if networking args were passed in
     if networking_args:
         kind_cfg["networking"] = networking_args.copy()
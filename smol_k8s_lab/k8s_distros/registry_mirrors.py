@@ -0,0 +1,95 @@
+#!/usr/bin/env python3.11
+"""
+       Name: registry_mirrors
+DESCRIPTION: local pull through registry mirrors for kind and k3d clusters, so
+             that rebuilding a cluster doesn't pull every image from the
+             internet again. Part of smol-k8s-lab
+     AUTHOR: <https://github.com/jessebot>
+    LICENSE: GNU AFFERO GENERAL PUBLIC LICENSE Version 3
+"""
+from ..utils.run.subproc import subproc
+import logging as log
+
+
+# registries we mirror, and the upstream url each mirror pulls through to
+REGISTRY_MIRRORS = {"docker.io": "https://registry-1.docker.io",
+                    "ghcr.io": "https://ghcr.io",
+                    "quay.io": "https://quay.io",
+                    "registry.k8s.io": "https://registry.k8s.io"}
+
+# image we use for each mirror
+REGISTRY_IMAGE = "registry:2"
+
+# port each mirror listens on inside the docker network
+REGISTRY_PORT = 5000
+
+
+def mirror_name(registry: str) -> str:
+    """
+    returns the docker container name of the mirror for a registry, which is
+    also its hostname on the docker network, e.g. smol-k8s-lab-mirror-quay-io
+    """
+    return "smol-k8s-lab-mirror-" + registry.replace(".", "-")
+
+
+def mirror_endpoints(registries: dict = REGISTRY_MIRRORS) -> dict:
+    """
+    returns a dict of {registry: mirror endpoint} for the nodes to pull from
+    """
+    return {registry: f"http://{mirror_name(registry)}:{REGISTRY_PORT}"
+            for registry in registries}
+
+
+def start_registry_mirrors(network: str,
+                           registries: dict = REGISTRY_MIRRORS) -> dict:
+    """
+    makes sure there's a running pull through cache container for each
+    registry on the given docker network, creating the network if needed.
+
+    The mirrors are left running after the cluster is deleted, and each one
+    keeps its images in a docker volume, so the next cluster gets them from
+    the mirror instead of the internet.
+
+    Returns a dict of {registry: mirror endpoint}
+    """
+    networks = subproc(["docker network ls --format {{.Name}}"],
+                       quiet=True, spinner=False).split()
+    if network not in networks:
+        log.info(f"Creating docker network {network} for the registry mirrors")
+        subproc([f"docker network create {network}"], spinner=False)
+
+    # {container name: (state, networks)} for the mirrors that already exist
+    containers = {}
+    ps = subproc(["docker ps -a --filter name=smol-k8s-lab-mirror- "
+                  "--format {{.Names}};{{.State}};{{.Networks}}"],
+                 quiet=True, spinner=False)
+    for line in ps.splitlines():
+        if line.count(";") == 2:
+            name, state, container_networks = line.split(";")
+            containers[name] = (state, container_networks.split(","))
+
+    # we connect existing mirrors to the network before we start them back up
+    connect_cmds = []
+    start_cmds = []
+    for registry, upstream in registries.items():
+        name = mirror_name(registry)
+
+        if name not in containers:
+            start_cmds.append(
+                    f"docker run -d --restart=always --name {name} "
+                    f"--network {network} -v {name}:/var/lib/registry "
+                    f"-e REGISTRY_PROXY_REMOTEURL={upstream} {REGISTRY_IMAGE}")
+            continue
+
+        state, container_networks = containers[name]
+        # the same mirrors are shared by kind and k3d, which use different networks
+        if network not in container_networks:
+            connect_cmds.append(f"docker network connect {network} {name}")
+        if state != "running":
+            start_cmds.append(f"docker start {name}")
+
+    for cmds in [connect_cmds, start_cmds]:
+        if cmds:
+            subproc(cmds, parallel=True)
+
+    return mirror_endpoints(registries)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3.11
+"""
+       Name: snapshots
+DESCRIPTION: golden snapshots of k3d clusters, taken right after the base apps
+             are installed, so the next cluster with the same config can start
+             from the snapshot instead of installing them all again
+     AUTHOR: <https://github.com/jessebot>
+    LICENSE: GNU AFFERO GENERAL PUBLIC LICENSE Version 3
+"""
+from ..constants import XDG_CACHE_DIR, VERSION
+from ..k8s_tools.k8s_lib import K8s
+from ..utils.run.subproc import subproc
+from glob import glob
+from hashlib import sha256
+import json
+import logging as log
+from os import makedirs, path, rename
+from shutil import copytree, rmtree
+from tempfile import mkdtemp
+
+
+# where we keep each snapshot, in a directory named after its key
+SNAPSHOT_DIR = path.join(XDG_CACHE_DIR, 'snapshots')
+
+# where we keep the copy of a snapshot that a restored cluster is running on
+RESTORE_DIR = path.join(XDG_CACHE_DIR, 'restores')
+
+# the base apps that are installed before we take a snapshot
+BASE_APPS = ["cilium", "metallb", "ingress_nginx", "cert_manager",
+             "cnpg_operator", "argo_cd"]
+
+# k3s keeps its datastore, certificates, and token in this directory
+K3S_SERVER_DIR = "/var/lib/rancher/k3s/server"
+
+
+def snapshot_key(cluster_name: str,
+                 distro_metadata: dict,
+                 apps: dict,
+                 secrets: dict) -> str:
+    """
+    returns a hash of everything that changes what the base apps look like, so
+    we only restore a snapshot for a cluster that would end up the same anyway
+    """
+    config = {"smol_k8s_lab": VERSION,
+              "cluster_name": cluster_name,
+              "distro": distro_metadata,
+              "apps": {app: apps.get(app, {}) for app in BASE_APPS},
+              "secrets": secrets}
+    return sha256(json.dumps(config, sort_keys=True, default=str).encode()
+                  ).hexdigest()[:16]
+
+
+def snapshot_path(key: str) -> str:
+    """
+    returns the path to a snapshot, or an empty string if we don't have one
+    """
+    snapshot = path.join(SNAPSHOT_DIR, key)
+    if path.exists(path.join(snapshot, "token")):
+        return snapshot
+    return ""
+
+
+def save_k3d_snapshot(cluster_name: str, key: str) -> str:
+    """
+    saves the k3s server directory of a running single server k3d cluster
+    as a snapshot. The cluster is stopped while we copy it, so the datastore
+    is consistent, and then started again.
+
+    Returns the path to the snapshot
+    """
+    if cluster_name.startswith("k3d-"):
+        cluster_name = cluster_name.replace("k3d-", "", 1)
+    server = f"k3d-{cluster_name}-server-0"
+
+    # each node saves its password in a secret the first time it joins, and
+    # the new nodes of a restored cluster have different passwords
+    k8s = K8s()
+    for secret in k8s.core_v1_api.list_namespaced_secret("kube-system").items:
+        if secret.metadata.name.endswith(".node-password.k3s"):
+            k8s.delete_secret(secret.metadata.name, "kube-system")
+
+    # the token is needed to decrypt the bootstrap data in the datastore
+    env = subproc(["docker inspect -f {{json .Config.Env}} " + server],
+                  quiet=True, spinner=False)
+    token = next((var.split("=", 1)[1] for var in json.loads(env)
+                  if var.startswith("K3S_TOKEN=")), "")
+
+    log.info(f"Saving a golden snapshot of {cluster_name} as {key}")
+    makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_dir = mkdtemp(dir=SNAPSHOT_DIR)
+    subproc([f"k3d cluster stop {cluster_name}"])
+    try:
+        subproc([f"docker cp {server}:{K3S_SERVER_DIR} {tmp_dir}/server"],
+                spinner=False)
+    finally:
+        subproc([f"k3d cluster start {cluster_name}"])
+
+    with open(path.join(tmp_dir, "token"), 'w') as token_file:
+        token_file.write(token)
+
+    # only move it into place once it's all there, so we never restore half
+    snapshot = path.join(SNAPSHOT_DIR, key)
+    rmtree(snapshot, ignore_errors=True)
+    rename(tmp_dir, snapshot)
+    return snapshot
+
+
+def prepare_k3d_restore(cluster_name: str, snapshot: str) -> dict:
+    """
+    copies a snapshot for a new cluster to run on, so the snapshot itself is
+    never changed, and returns a dict of {"server_dir": path, "token": str}
+    """
+    if cluster_name.startswith("k3d-"):
+        cluster_name = cluster_name.replace("k3d-", "", 1)
+
+    makedirs(RESTORE_DIR, exist_ok=True)
+    restore = mkdtemp(prefix=f"{cluster_name}-", dir=RESTORE_DIR)
+    copytree(path.join(snapshot, "server"), path.join(restore, "server"))
+
+    with open(path.join(snapshot, "token"), 'r') as token_file:
+        token = token_file.read().strip()
+
+    return {"server_dir": path.join(restore, "server"), "token": token}
+
+
+def clean_k3d_restores(cluster_name: str) -> None:
+    """
+    removes the copies of snapshots that a deleted cluster was running on
+    """
+    for restore in glob(path.join(RESTORE_DIR, f"{cluster_name}-*")):
+        # files k3s created as root inside the node can't always be removed
+        rmtree(restore, ignore_errors=True)
+
+
+def wait_for_restore(k8s_obj: K8s, argocd_namespace: str = "") -> None:
+    """
+    waits for the nodes of a restored cluster to be ready, and then for the
+    argo cd pods, if argo cd was part of the snapshot
+    """
+    def node_ready(node: dict) -> bool:
+        conditions = node.get('status', {}).get('conditions', [])
+        return any(condition['type'] == "Ready" and condition['status'] == "True"
+                   for condition in conditions)
+
+    k8s_obj.wait_for("v1", "Node", "", node_ready)
+    if argocd_namespace:
+        k8s_obj.wait(argocd_namespace, instance="argo-cd")
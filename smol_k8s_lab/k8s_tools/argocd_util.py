@@ -1,9 +1,62 @@
 # it was only a matter of time before I had to query argocd directly
 import logging as log
-from .k8s_lib import K8s
-from ..utils.run.subproc import subproc
-from json import loads
-from time import sleep
+from .k8s_lib import K8s, raise_for_failed
+from base64 import b64decode as b64dec
+from kubernetes.client.rest import ApiException
+from kubernetes.dynamic.exceptions import ResourceNotFoundError
+from rich.errors import LiveError
+from rich.live import Live
+from rich.table import Table
+from threading import Lock, RLock
+from time import monotonic, sleep
+from ..utils.rich_cli.console_logging import CONSOLE
+
+
+ARGO_API_VERSION = "argoproj.io/v1alpha1"
+
+# added to apps before deleting them, so Argo CD deletes their resources too
+CASCADE_FINALIZER = "resources-finalizer.argocd.argoproj.io"
+
+
+def app_healthy(app: dict) -> bool:
+    """
+    predicate for K8s.wait_for: Argo CD Application health status is Healthy
+    """
+    return app.get('status', {}).get('health', {}).get('status', "") == "Healthy"
+
+
+def app_degraded(app: dict) -> bool:
+    """
+    Argo CD Application health status is Degraded
+    """
+    return app.get('status', {}).get('health', {}).get('status', "") == "Degraded"
+
+
+def operation_running(app: dict) -> bool:
+    """
+    an Argo CD Application has an operation (like a sync) that isn't done yet
+    """
+    phase = app.get('status', {}).get('operationState', {}).get('phase')
+    return bool(app.get('operation')) or phase in ["Running", "Terminating"]
+
+
+def apps_table(apps: dict) -> Table:
+    """
+    returns a rich table of the sync and health status of each app in apps, a
+    dict of {app name: Application dict}
+    """
+    colors = {"Healthy": "green", "Synced": "green", "Progressing": "yellow",
+              "OutOfSync": "yellow", "Degraded": "red", "Suspended": "blue"}
+    table = Table("App", "Sync", "Health", box=None, title_justify="left",
+                  title="[cornflower_blue]Waiting on Argo CD apps")
+    for name, app in apps.items():
+        status = app.get('status', {})
+        sync = status.get('sync', {}).get('status', "Missing")
+        health = status.get('health', {}).get('status', "Missing")
+        table.add_row(f"[cyan]{name}",
+                      f"[{colors.get(sync, 'dim')}]{sync}",
+                      f"[{colors.get(health, 'dim')}]{health}")
+    return table
 
 
 class ArgoCD():
@@ -19,64 +72,269 @@ class ArgoCD():
         """
         secrets_backend: str, if set to "bitwarden", resets bitwarden eso
         provider when updating Argo CD Appset Secret Plugin
-        """
 
-        # setup Argo CD to talk directly to k8s
-        log.debug(f"setting namespace to {namespace} and configuring argocd "
-                  "to use k8s for auth")
-        subproc([f'kubectl config set-context --current --namespace={namespace}',
-                 f'argocd login {argo_cd_domain} --core'])
+        We talk to the Application, ApplicationSet, and AppProject custom
+        resources directly with k8s_obj's api client, the same way the argocd
+        cli does in --core mode, so we don't need to log in or fork argocd
+        """
         self.namespace = namespace
         self.hostname = argo_cd_domain
         self.k8s = k8s_obj
         self.secrets_backend = secrets_backend
 
-    def check_if_app_exists(self, app: str) -> bool:
+        # apps are installed concurrently, but they all share one appset secret
+        self.appset_secret_lock = RLock()
+
+        # fields for the appset secret that haven't been written yet. They're
+        # written all at once, with one plugin reload, by flush_appset_secret()
+        self.appset_secret_buffer = {}
+        self.appset_buffer_lock = Lock()
+
+        # {kind: {name: app}} of every Application and ApplicationSet, from one
+        # list call, so checking if an app exists doesn't need an api call each
+        self.apps_snapshot = None
+        self.snapshot_lock = RLock()
+
+    def list_apps(self, refresh: bool = False) -> dict:
         """
-        check if argocd application has already been installed
+        returns a dict of {kind: {name: app dict}} of all the Argo CD
+        Applications and ApplicationSets, listing each kind once and keeping
+        the result until it's invalidated, or refresh is True
         """
-        res = subproc([f"argocd app get {app}"], error_ok=True)
-        if app in res:
-            return True
-        else:
-            return False
+        with self.snapshot_lock:
+            if self.apps_snapshot is not None and not refresh:
+                return self.apps_snapshot
+
+            snapshot = {}
+            for kind in ["Application", "ApplicationSet"]:
+                try:
+                    resource = self.k8s.get_resource(ARGO_API_VERSION, kind)
+                    res = self.k8s.dynamic_client.get(resource,
+                                                      namespace=self.namespace)
+                except ResourceNotFoundError:
+                    # don't keep an empty snapshot around if argo isn't up yet
+                    log.debug(f"{kind} isn't a known resource yet. Is Argo CD installed?")
+                    return {}
+                snapshot[kind] = {item['metadata']['name']: item
+                                  for item in res.to_dict().get('items', [])}
+
+            log.debug(f"Found {len(snapshot['Application'])} Argo CD Applications "
+                      f"and {len(snapshot['ApplicationSet'])} ApplicationSets")
+            self.apps_snapshot = snapshot
+            return snapshot
+
+    def invalidate_apps(self) -> None:
+        """
+        forget the apps snapshot, so the next list_apps() lists them again
+        """
+        with self.snapshot_lock:
+            self.apps_snapshot = None
+
+    def get_app(self, app: str, kind: str = "Application") -> dict:
+        """
+        get an Argo CD Application (or ApplicationSet) as a dict. Returns an
+        empty dict if it doesn't exist, or Argo CD isn't installed yet
+        """
+        try:
+            resource = self.k8s.get_resource(ARGO_API_VERSION, kind)
+            return self.k8s.dynamic_client.get(resource,
+                                               name=app,
+                                               namespace=self.namespace).to_dict()
+        except ResourceNotFoundError:
+            log.debug(f"{kind} isn't a known resource yet. Is Argo CD installed?")
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        return {}
+
+    def check_if_app_exists(self, app: str, kind: str = "Application") -> bool:
+        """
+        check if argocd application has already been installed, using the
+        snapshot of all apps from list_apps()
+        """
+        return app in self.list_apps().get(kind, {})
 
     def sync_app(self,
                  app: str,
                  spinner: bool = True,
                  replace: bool = False,
                  force: bool = False,
-                 sleep_time: int = 1) -> str:
+                 sleep_time: int = 1,
+                 wait: bool = True,
+                 timeout: int = 600) -> str:
         """
-        syncs an argocd app and returns the result
+        syncs an argocd app and returns the result. Like the argocd cli, this
+        requests a sync by setting the operation field on the Application.
+
+        If wait is True, we also wait (like argocd app sync does) until the
+        sync is done, and raise an Exception if it Failed or had an Error, so
+        the next wait_for_app doesn't see the app's status from before it
         """
-        # build sync command
-        cmd = "argocd app sync --retry-limit 3 --loglevel warn "
+        # make sure the app gets any appset secret values it's waiting on
+        if app not in ['appset-secrets-plugin', 'bitwarden-eso-provider']:
+            self.flush_appset_secret()
+
+        sync = {"syncStrategy": {"hook": {"force": force}}}
         if replace:
-            cmd += "--replace "
-        if force:
-            cmd += "--force "
-        cmd += app
+            sync["syncOptions"] = ["Replace=true"]
+        operation = {"operation": {"initiatedBy": {"username": "smol-k8s-lab"},
+                                   "sync": sync,
+                                   "retry": {"limit": 3}}}
 
+        resource = self.k8s.get_resource(ARGO_API_VERSION, "Application")
         counter = 0
         while True:
-            # run sync command
-            if spinner:
-                res = subproc([cmd], error_ok=True)
+            current = self.get_app(app)
+            if not current:
+                return f"Application {app} not found"
+
+            if operation_running(current):
+                if not wait:
+                    return f"Another operation is already in progress for {app}"
+                # our sync would be refused, so let the other one finish first
+                log.info(f"Waiting on the operation already in progress for {app}")
+                self.wait_for_operation(app, timeout)
+                continue
+
+            try:
+                self.k8s.dynamic_client.patch(
+                        resource,
+                        body=operation,
+                        name=app,
+                        namespace=self.namespace,
+                        content_type="application/merge-patch+json")
+            except ApiException as e:
+                # permissions aren't always ready right after a fresh install
+                if e.status != 403 or counter == 10:
+                    log.error(f"Something has gone wrong with syncing {app}: {e}")
+                    return str(e)
+                log.error(f"Sleeping {sleep_time} seconds before next attempt to sync...")
+                sleep(sleep_time)
+                counter += 1
             else:
-                res = subproc([cmd], spinner=False, error_ok=True)
+                log.info(f"Requested a sync of Argo CD app {app}")
+                if not wait:
+                    return f"Sync of {app} requested"
+                break
 
-            if "permission denied" not in res:
-                return res
-            else:
-                if counter == 10:
-                    log.error("Something has gone wrong with syncs! we tried 10 times!")
-                    break
-                else:
-                    log.error(f"Sleeping {sleep_time} seconds before next attempt to sync...")
-                    sleep(sleep_time)
+        state = self.wait_for_operation(app, timeout)
+        phase = state.get('phase')
+        if phase != "Succeeded":
+            raise Exception(f"Sync of Argo CD app {app} {phase}: "
+                            f"{state.get('message', '')}")
 
-            counter += 1
+        log.info(f"Synced Argo CD app {app}")
+        return f"Sync of {app} succeeded"
+
+    def wait_for_operation(self, app: str, timeout: int = 600) -> dict:
+        """
+        waits until an Argo CD app's current operation is done, which is when
+        Argo CD clears the operation field and sets a final phase in its
+        status.operationState. Returns the operationState dict
+        """
+        def finished(objects: dict) -> bool:
+            return app in objects and not operation_running(objects[app])
+
+        objects = self.k8s.watch_until(ARGO_API_VERSION,
+                                       "Application",
+                                       self.namespace,
+                                       finished,
+                                       name=app,
+                                       timeout=timeout)
+        return objects[app].get('status', {}).get('operationState', {})
+
+    def delete_argo_resource(self,
+                             name: str,
+                             kind: str = "Application",
+                             force: bool = False) -> str:
+        """
+        delete an Argo CD Application or ApplicationSet and return the result.
+        Unless force is True, Applications get the cascade finalizer first, so
+        Argo CD deletes all the resources they created too, and any other
+        finalizers are left alone. If force is True, we remove all finalizers
+        instead, so nothing can keep it stuck around
+        """
+        if not self.check_if_app_exists(name, kind):
+            return ""
+
+        resource = self.k8s.get_resource(ARGO_API_VERSION, kind)
+
+        try:
+            if force:
+                self.k8s.dynamic_client.patch(
+                        resource,
+                        body={"metadata": {"finalizers": []}},
+                        name=name,
+                        namespace=self.namespace,
+                        content_type="application/merge-patch+json")
+            elif kind == "Application":
+                self.add_cascade_finalizer(resource, name)
+
+            self.k8s.dynamic_client.delete(
+                    resource,
+                    name=name,
+                    namespace=self.namespace,
+                    body={"propagationPolicy": "Foreground"})
+        except ApiException as e:
+            log.error(f"Could not delete {kind} {name}: {e}")
+            return str(e)
+        finally:
+            self.invalidate_apps()
+
+        return f"{kind.lower()} '{name}' deleted\n"
+
+    def add_cascade_finalizer(self, resource, name: str, retries: int = 3) -> None:
+        """
+        adds the cascade finalizer to an Application, if it's not there yet,
+        like argocd app delete does. This is a json patch that only applies
+        to the resourceVersion we read, so we never drop a finalizer that
+        someone else added in the meantime, and we read it again if so
+        """
+        for attempt in range(retries):
+            metadata = self.get_app(name).get('metadata', {})
+            finalizers = metadata.get('finalizers') or []
+            if not metadata or CASCADE_FINALIZER in finalizers:
+                return
+
+            if finalizers:
+                add = {"op": "add", "path": "/metadata/finalizers/-",
+                       "value": CASCADE_FINALIZER}
+            else:
+                add = {"op": "add", "path": "/metadata/finalizers",
+                       "value": [CASCADE_FINALIZER]}
+            patch = [{"op": "test", "path": "/metadata/resourceVersion",
+                      "value": metadata['resourceVersion']},
+                     add]
+
+            try:
+                self.k8s.dynamic_client.patch(
+                        resource,
+                        body=patch,
+                        name=name,
+                        namespace=self.namespace,
+                        content_type="application/json-patch+json")
+                return
+            except ApiException as e:
+                # a failed test op means the Application changed since we read it
+                if e.status not in [409, 422] or attempt == retries - 1:
+                    raise
+
+    def terminate_op(self, app: str) -> str:
+        """
+        terminate the currently running operation for an app, if there is one
+        """
+        current = self.get_app(app)
+        phase = current.get('status', {}).get('operationState', {}).get('phase')
+        if phase != "Running":
+            return ""
+
+        self.k8s.dynamic_client.patch(
+                self.k8s.get_resource(ARGO_API_VERSION, "Application"),
+                body={"status": {"operationState": {"phase": "Terminating"}}},
+                name=app,
+                namespace=self.namespace,
+                content_type="application/merge-patch+json")
+        return f"Application '{app}' operation terminating\n"
 
     def delete_app(self,
                    app: str,
@@ -85,16 +343,7 @@ class ArgoCD():
         """
         delete an app and associated appsets, and returns the result for all
         """
-        # build delete command
-        cmd = "argocd app delete -y "
-        if force:
-            cmd += "--force "
-        cmd += app
-
-        # run sync command
-        app_res = subproc([cmd], spinner=spinner, error_ok=True)
-        if not app_res:
-            app_res = ""
+        app_res = self.delete_argo_resource(app, force=force)
 
         # clean up old appsets as well
         appsets = ["web-app-set",
@@ -106,16 +355,11 @@ class ArgoCD():
 
         if app in ["nextcloud", "matrix", "mastodon", "zitadel"]:
             for appset in appsets:
-                res = subproc([f"argocd appset delete -y {app}-{appset}"],
-                              error_ok=True, spinner=spinner)
-                if res:
-                    app_res += res
+                app_res += self.delete_argo_resource(f"{app}-{appset}",
+                                                     "ApplicationSet")
 
             # sometimes seaweedfs gets stuck...
-            res = subproc([f"argocd app terminate-op {app}-seaweedfs-app"],
-                          error_ok=True, spinner=spinner)
-            if res:
-                app_res += res
+            app_res += self.terminate_op(f"{app}-seaweedfs-app")
 
         # delete any remaining pods, just in case
         res = self.k8s.delete_namespaced_pods(app)
@@ -133,9 +377,14 @@ class ArgoCD():
         """
         if self.check_if_app_exists(app):
             log.debug(f"An Argo CD app called [green]{app}[/] already [green]exists[/] :)")
+            # it may still be waiting on appset secret values we've buffered
+            self.flush_appset_secret()
             return True
         else:
             log.info(f"Installing an Argo CD app called {app} :)")
+            # make sure the app gets any appset secret values it's waiting on
+            self.flush_appset_secret()
+
             repo = argo_dict['repo']
             path = argo_dict['path']
             revision = argo_dict['revision']
@@ -160,45 +409,105 @@ class ArgoCD():
                                        app_cluster,
                                        set(source_repos))
 
-            cmd = (f"argocd app create {app} --upsert "
-                   f"--repo {repo} "
-                   f"--path {path} "
-                   f"--revision {revision} "
-                   "--sync-policy automated "
-                   "--sync-option ApplyOutOfSyncOnly=true "
-                   "--self-heal "
-                   f"--dest-namespace {app_namespace} "
-                   f"--dest-server {app_cluster}")
-
+            # the same Application that argocd app create would make for us
+            source = {"repoURL": repo,
+                      "path": path,
+                      "targetRevision": revision}
             if argo_dict['directory_recursion']:
-                cmd += " --directory-recurse"
+                source["directory"] = {"recurse": True}
+
+            argocd_app = {
+                "apiVersion": ARGO_API_VERSION,
+                "kind": "Application",
+                "metadata": {"name": app, "namespace": self.namespace},
+                "spec": {
+                    "project": "default",
+                    "source": source,
+                    "destination": {"namespace": app_namespace,
+                                    "server": app_cluster},
+                    "syncPolicy": {
+                        "automated": {"selfHeal": True},
+                        "syncOptions": ["ApplyOutOfSyncOnly=true"]
+                        }
+                    }
+                }
 
-            response = subproc([cmd])
+            response = self.k8s.apply_custom_resources([argocd_app])[0]
             log.debug(response)
+            self.invalidate_apps()
+            if not response['applied']:
+                raise Exception(f"Could not create Argo CD app {app}: "
+                                f"{response['error']}")
 
             # wait for the app to be healthy if requested by the user
             if wait:
                 self.wait_for_app(app)
 
-    def wait_for_app(self, app: str, retry: bool = False) -> None:
+    def wait_for_app(self, app: str, retry: bool = False, timeout: int = 900) -> None:
+        """
+        checks the status of an Argo CD app and waits till it is healthy
+        """
+        self.wait_for_apps([app], timeout, retry)
+
+    def wait_for_apps(self,
+                      apps: list,
+                      timeout: int = 900,
+                      retry: bool = False) -> dict:
         """
-        checks the status of an Argo CD app and waits till it is ready
+        waits on several Argo CD apps at once, with one watch on all of the
+        Applications, while showing their sync and health status in a table.
+
+        Returns a dict of {app: Application dict} as soon as all of the apps
+        are Healthy. Raises an Exception as soon as any app is Degraded, unless
+        retry is True, in which case we keep waiting, and retry api errors
+        with a backoff, until timeout (in seconds) runs out.
         """
-        if retry:
-            # set error to true by default
-            error = True
-            # while error still equals True, keep retrying the command
-            while error:
+        apps = list(dict.fromkeys(apps))
+        deadline = monotonic() + timeout
+
+        live = Live(apps_table({app: {} for app in apps}), console=CONSOLE)
+        try:
+            live.start()
+        except LiveError:
+            # another install is already showing its table, so just log instead
+            log.info(f"Waiting on Argo CD apps: {', '.join(apps)}")
+            live = None
+
+        def done(objects: dict) -> bool:
+            current = {app: objects.get(app, {}) for app in apps}
+            if live:
+                live.update(apps_table(current))
+
+            degraded = [app for app, obj in current.items() if app_degraded(obj)]
+            if degraded and not retry:
+                raise Exception(f"Argo CD apps are Degraded: {', '.join(degraded)}")
+
+            return all(app_healthy(obj) for obj in current.values())
+
+        attempt = 0
+        try:
+            while True:
                 try:
-                    subproc([f"argocd app wait {app} --health --loglevel warn"])
+                    objects = self.k8s.watch_until(
+                            ARGO_API_VERSION,
+                            "Application",
+                            self.namespace,
+                            done,
+                            timeout=max(1, int(deadline - monotonic())))
+                    return {app: objects[app] for app in apps}
+                except TimeoutError:
+                    raise
                 except Exception as e:
-                    log.debug(e)
-                    error = True
-                    log.debug(f"Retrying wait for for {app}")
-                else:
-                    error = False
-        else:
-            subproc([f"argocd app wait {app} --health --loglevel warn"])
+                    remaining = deadline - monotonic()
+                    if not retry or remaining <= 0:
+                        raise
+                    backoff = min(2 ** attempt, 30, remaining)
+                    log.debug(f"{e}. Retrying wait for {', '.join(apps)} in {backoff}s")
+                    sleep(backoff)
+                    attempt += 1
+        finally:
+            if live:
+                live.stop()
 
     def create_project(self,
                        project_name: str,
@@ -246,37 +555,92 @@ class ArgoCD():
                 server = "https://kubernetes.default.svc"
                 name = "in-cluster"
             else:
-                cluster_json = loads(subproc(f"argocd cluster get {clusters} -o json"))
-                name = cluster_json["name"]
-                server = cluster_json["server"]
+                name, server = self.get_cluster(clusters)
 
             for namespace in namespaces:
                 extra_dest = {"name": name, "namespace": namespace, "server": server}
                 argocd_proj['spec']['destinations'].append(extra_dest)
 
         try:
-            self.k8s.apply_custom_resources([argocd_proj])
+            raise_for_failed(self.k8s.apply_custom_resources([argocd_proj]))
         except Exception as e:
             log.warn(e)
 
-    def update_appset_secret(self, fields: dict, argo_managed: bool = True) -> None:
+    def get_cluster(self, cluster: str) -> tuple[str, str]:
         """
-        pass in k8s context and dict of fields to add to the argocd appset secret
-        and reload the deployment
+        looks up an Argo CD cluster by name or server url from its cluster
+        secret, like argocd cluster get, and returns (name, server)
         """
-        self.k8s.update_secret_key('appset-secret-vars',
-                                   self.namespace,
-                                   fields,
-                                   'secret_vars.yaml')
+        secrets = self.k8s.core_v1_api.list_namespaced_secret(
+                self.namespace,
+                label_selector="argocd.argoproj.io/secret-type=cluster")
+
+        for secret in secrets.items:
+            name = b64dec(secret.data['name']).decode('utf8')
+            server = b64dec(secret.data['server']).decode('utf8')
+            if cluster in [name, server]:
+                return name, server
+
+        raise Exception(f"Argo CD cluster {cluster} not found")
+
+    def update_appset_secret(self,
+                             fields: dict,
+                             argo_managed: bool = True,
+                             flush: bool = False) -> None:
+        """
+        pass in dict of fields to add to the argocd appset secret. They're
+        buffered until the next flush_appset_secret(), which happens before
+        any app is installed or synced, so that many updates only reload the
+        appset secret plugin once.
 
-        if argo_managed:
-            # reload the argocd appset secret plugin
-            self.sync_app('appset-secrets-plugin', spinner=True, replace=True, force=True)
-            self.wait_for_app('appset-secrets-plugin')
-        else:
-            self.k8s.reload_deployment("appset-secrets-plugin", self.namespace)
+        If flush is True, or argo_managed is False (the plugin isn't an Argo
+        CD app yet), we write the fields and reload the plugin right away
+        """
+        with self.appset_buffer_lock:
+            self.appset_secret_buffer.update(fields)
+
+        if flush or not argo_managed:
+            self.flush_appset_secret(argo_managed)
+
+    def flush_appset_secret(self, argo_managed: bool = True) -> None:
+        """
+        writes all the buffered appset secret fields with one update, and then
+        reloads the appset secret plugin (and the bitwarden eso provider)
+        """
+        with self.appset_secret_lock:
+            with self.appset_buffer_lock:
+                fields = self.appset_secret_buffer
+                self.appset_secret_buffer = {}
+
+            if not fields:
+                return
+
+            log.debug(f"Writing {len(fields)} fields to the appset secret")
+            try:
+                self.k8s.update_secret_key('appset-secret-vars',
+                                           self.namespace,
+                                           fields,
+                                           'secret_vars.yaml')
+            except Exception:
+                # put them back so the next flush tries again, but don't
+                # overwrite anything newer that came in while we were busy
+                with self.appset_buffer_lock:
+                    self.appset_secret_buffer = {**fields, **self.appset_secret_buffer}
+                raise
+
+            if argo_managed:
+                # reload the argocd appset secret plugin
+                self.sync_app('appset-secrets-plugin', spinner=True, replace=True, force=True)
+                reloaded = ['appset-secrets-plugin']
+            else:
+                self.k8s.reload_deployment("appset-secrets-plugin", self.namespace)
+                reloaded = []
+
+            # if bweso enabled, reload the bitwarden ESO provider
+            if self.secrets_backend == "bitwarden":
+                self.sync_app('bitwarden-eso-provider', spinner=True, replace=True, force=True)
+                reloaded.append('bitwarden-eso-provider')
 
-        # if bweso enabled, reload the bitwarden ESO provider
-        if self.secrets_backend == "bitwarden":
-            self.sync_app('bitwarden-eso-provider', spinner=True, replace=True, force=True)
-            self.wait_for_app('bitwarden-eso-provider')
+            # wait on everything we reloaded at the same time
+            if reloaded:
+                self.wait_for_apps(reloaded)
@@ -1,6 +1,5 @@
 # local libs
-from smol_k8s_lab.utils.run.subproc import subproc
-from smol_k8s_lab.k8s_tools.k8s_lib import K8s
+from smol_k8s_lab.k8s_tools.k8s_lib import K8s, job_complete, raise_for_failed
 from smol_k8s_lab.k8s_apps.social.nextcloud_occ_commands import Nextcloud
 from smol_k8s_lab.utils.minio_lib import BetterMinio
 
@@ -84,20 +83,12 @@ def create_pvc_restic_backup(app: str,
 
     # then we can do the actual backup
     k8s = K8s()
-    k8s.apply_custom_resources([backup_yaml])
+    raise_for_failed(k8s.apply_custom_resources([backup_yaml]))
 
     # wait for backup to complete
-    wait_cmd = (f"kubectl wait job -n {namespace} --for=condition=complete "
-                f"backup-{backup_name}-0 --timeout=15m")
-    print(wait_cmd)
-    while True:
-        log.debug(f"Waiting for backup job: backup-{backup_name}-0")
-        res = subproc([wait_cmd], error_ok=True, spinner=quiet)
-        log.debug(res)
-        if "NotFound" in res:
-            sleep(1)
-        else:
-            break
+    log.info(f"Waiting for backup job: backup-{backup_name}-0")
+    k8s.wait_for("batch/v1", "Job", namespace, job_complete,
+                 name=f"backup-{backup_name}-0", timeout=900)
 
     if app == "nextcloud":
         # turn nextcloud maintenance_mode off after the backup
@@ -106,6 +97,18 @@ def create_pvc_restic_backup(app: str,
     return True
 
 
+def cnpg_backup_completed(backup: dict) -> bool:
+    """
+    predicate for K8s.wait_for: cnpg Backup phase is completed. Raises an
+    Exception if the backup failed
+    """
+    phase = backup.get('status', {}).get('phase', "")
+    if phase == "failed":
+        raise Exception(f"cnpg backup {backup['metadata']['name']} failed: "
+                        f"{backup['status'].get('error', '')}")
+    return phase == "completed"
+
+
 def create_cnpg_cluster_backup(app: str,
                                namespace: str,
                                s3_endpoint: str,
@@ -134,19 +137,12 @@ def create_cnpg_cluster_backup(app: str,
 
     # then we can do the actual backup
     k8s = K8s()
-    k8s.apply_custom_resources([cnpg_backup])
+    raise_for_failed(k8s.apply_custom_resources([cnpg_backup]))
 
     # wait for backup to complete
-    wait_cmd = (f"kubectl get -n {namespace} --no-headers "
-                "-o custom-columns=PHASE:.status.phase "
-                f"backups.postgresql.cnpg.io/{backup_name}")
-    while True:
-        log.error(f"Waiting on backups.postgresql.cnpg.io/{backup_name} to complete")
-        res = subproc([wait_cmd], error_ok=True, spinner=quiet)
-        log.error(res)
-        if "completed" in res:
-            break
-        sleep(1)
+    log.info(f"Waiting on backups.postgresql.cnpg.io/{backup_name} to complete")
+    backup = k8s.wait_for("postgresql.cnpg.io/v1", "Backup", namespace,
+                          cnpg_backup_completed, name=backup_name)[0]
 
     # get credentials and setup s3 object to check if all wal archives are there
     credentials = k8s.get_secret("s3-postgres-credentials", namespace)
@@ -157,11 +153,7 @@ def create_cnpg_cluster_backup(app: str,
     all_wals = f"{cluster_name}/wals"
 
     # after the backup is completed, check which wal archive it says is the last one
-    end_wal_cmd = (
-            f"kubectl get -n {namespace} backups.postgresql.cnpg.io/{backup_name}"
-            f" -o custom-columns=endwal:.status.endWal --no-headers"
-            )
-    end_wal = subproc([end_wal_cmd]).strip()
+    end_wal = backup['status']['endWal']
     end_wal_folder = f"{all_wals}/{end_wal[:16]}/{end_wal}"
     log.error(f"Wal folder we expect for {cluster_name} backup is: '{end_wal_folder}'")
     check_for_specific_wal(s3, cluster_name, all_wals, end_wal)
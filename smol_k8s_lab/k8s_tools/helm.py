@@ -5,15 +5,28 @@ LICENSE: AGPLv4
 """
 
 # internal libraries
+from ..constants import XDG_CACHE_DIR
+from .k8s_lib import get_api_client
 from ..utils.run.subproc import subproc
 from ..utils.rich_cli.console_logging import header, sub_header
 
 # external libraries
+from base64 import b64decode as b64dec
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+from hashlib import sha256
+import json
+from kubernetes import client
 import logging as log
+from os import makedirs, path, replace
+from os.path import getmtime
 import requests
 from ruamel.yaml import YAML
 from shutil import which
+from threading import Lock
+from time import time
+from typing import TypedDict
 
 # these are the URLs of each manually installed helm chart, so that the appset matches
 APPSET_URLS = {
@@ -25,6 +38,211 @@ APPSET_URLS = {
         "cnpg-cluster": "https://raw.githubusercontent.com/small-hack/argocd-apps/main/nextcloud/app_of_apps/postgres_argocd_appset.yaml"
         }
 
+# on disk cache of the chart version (targetRevision) in each appset url
+APPSET_CACHE_DIR = path.join(XDG_CACHE_DIR, 'appsets')
+# seconds before we check if a cached appset has changed
+APPSET_CACHE_TTL = 3600
+# seconds before we update a helm repo whose index is already cached
+HELM_INDEX_MAX_AGE = 3600
+# digest of the chart version and values of each release we've installed, so
+# we can skip upgrades that wouldn't change anything
+HELM_STATE_FILE = path.join(XDG_CACHE_DIR, 'helm_releases.json')
+HELM_STATE_LOCK = Lock()
+# chart versions we already looked up during this run, by url
+APPSET_VERSIONS = {}
+APPSET_VERSIONS_LOCK = Lock()
+
+
+def appset_target_revision(manifest: str) -> str:
+    """
+    returns the helm chart version (targetRevision) of an Argo CD Application
+    or ApplicationSet yaml manifest
+    """
+    obj = YAML(typ='safe').load(manifest)
+
+    # this is an app
+    if obj['kind'] == "Application":
+        return obj['spec']['source']['targetRevision']
+    # this is an appset
+    else:
+        # return the current version of the app
+        return obj['spec']['template']['spec']['source']['targetRevision']
+
+
+def fetch_appset_version(url: str, ttl: int = APPSET_CACHE_TTL) -> str:
+    """
+    returns the chart version in the appset at url, from this run's versions,
+    then from the on disk cache if it's newer than ttl seconds. Otherwise we
+    ask for it with the cached ETag, so an unchanged appset isn't downloaded
+    again. If we can't reach url, we fall back to the cache, however old
+    """
+    with APPSET_VERSIONS_LOCK:
+        if url in APPSET_VERSIONS:
+            return APPSET_VERSIONS[url]
+
+    cache_file = path.join(APPSET_CACHE_DIR,
+                           sha256(url.encode()).hexdigest() + ".json")
+    cached = {}
+    if path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as cache_contents:
+                cached = json.load(cache_contents)
+        except (OSError, ValueError) as e:
+            log.debug(f"Ignoring unreadable appset cache file {cache_file}: {e}")
+
+    if cached and time() - cached['fetched'] < ttl:
+        log.debug(f"Using cached chart version {cached['target_revision']} for {url}")
+    else:
+        headers = {}
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+
+        try:
+            res = requests.get(url, headers=headers, timeout=10)
+            if cached and res.status_code == 304:
+                log.debug(f"{url} hasn't changed since we cached it")
+                cached['fetched'] = time()
+            else:
+                res.raise_for_status()
+                cached = {"url": url,
+                          "etag": res.headers.get('ETag', ""),
+                          "fetched": time(),
+                          "target_revision": appset_target_revision(res.text)}
+        except requests.RequestException as e:
+            if not cached:
+                raise
+            log.warning(f"Couldn't get {url}, so we're using chart version "
+                        f"{cached['target_revision']} from the cache: {e}")
+        else:
+            makedirs(APPSET_CACHE_DIR, exist_ok=True)
+            # write to a temp file first, so a crash can't leave half a file
+            with open(cache_file + ".tmp", 'w') as cache_contents:
+                json.dump(cached, cache_contents)
+            replace(cache_file + ".tmp", cache_file)
+
+    with APPSET_VERSIONS_LOCK:
+        APPSET_VERSIONS[url] = cached['target_revision']
+    return cached['target_revision']
+
+
+def prefetch_appset_versions(urls: list = list(APPSET_URLS.values()),
+                             ttl: int = APPSET_CACHE_TTL) -> dict:
+    """
+    looks up the chart versions of all the appset urls at the same time, so
+    later chart installs don't have to wait on them one by one.
+
+    Returns dict of {url: chart version} for every url we could look up
+    """
+    def fetch(url: str) -> str | None:
+        try:
+            return fetch_appset_version(url, ttl)
+        except Exception as e:
+            # we'll try again (and fail loudly) if a chart install needs it
+            log.debug(f"Couldn't prefetch the chart version in {url}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as executor:
+        versions = dict(zip(urls, executor.map(fetch, urls)))
+
+    return {url: version for url, version in versions.items() if version}
+
+
+class HelmRelease(TypedDict):
+    """
+    the latest revision of a helm release, from its helm storage secret
+    """
+    name: str
+    namespace: str
+    revision: int
+    chart: str
+    chart_version: str
+    status: str
+
+
+def values_digest(values: dict) -> str:
+    """
+    returns a sha256 of a dict of everything we pass to helm for a release,
+    that doesn't depend on key order
+    """
+    return sha256(json.dumps(values or {}, sort_keys=True).encode()).hexdigest()
+
+
+def get_helm_releases(namespace: str = "") -> list[HelmRelease]:
+    """
+    reads every helm release straight from helm's storage secrets
+    (sh.helm.release.v1.<release>.v<revision>) with one list call, instead of
+    running helm. If namespace is empty, we list releases in all namespaces.
+
+    Returns a list of HelmRelease, only including the latest revision of each
+    """
+    core_v1_api = client.CoreV1Api(get_api_client())
+    if namespace:
+        secrets = core_v1_api.list_namespaced_secret(namespace,
+                                                     label_selector="owner=helm")
+    else:
+        secrets = core_v1_api.list_secret_for_all_namespaces(
+                label_selector="owner=helm")
+
+    releases = {}
+    for secret in secrets.items:
+        if secret.type != "helm.sh/release.v1":
+            continue
+
+        # helm base64s its gzipped release json, and then k8s base64s it again
+        data = b64dec(b64dec(secret.data['release']))
+        if data[:3] == b'\x1f\x8b\x08':
+            data = gzip.decompress(data)
+        release = json.loads(data)
+
+        metadata = release.get('chart', {}).get('metadata', {})
+        key = (release['namespace'], release['name'])
+        if key in releases and releases[key]['revision'] > release['version']:
+            continue
+
+        releases[key] = HelmRelease(name=release['name'],
+                                    namespace=release['namespace'],
+                                    revision=release['version'],
+                                    chart=metadata.get('name', ""),
+                                    chart_version=metadata.get('version', ""),
+                                    status=release.get('info', {}).get('status', ""))
+
+    return list(releases.values())
+
+
+def load_helm_state() -> dict:
+    """
+    returns the dict of {cluster/namespace/release: {"digest": str,
+    "revision": int}} of the releases we've installed
+    """
+    try:
+        with open(HELM_STATE_FILE, 'r') as state_contents:
+            return json.load(state_contents)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_helm_state(key: str, digest: str, revision: int) -> None:
+    """
+    remember the digest of what we installed for a release at a revision
+    """
+    with HELM_STATE_LOCK:
+        state = load_helm_state()
+        state[key] = {"digest": digest, "revision": revision}
+        # write to a temp file first, so a crash can't leave half a file
+        with open(HELM_STATE_FILE + ".tmp", 'w') as state_contents:
+            json.dump(state, state_contents, indent=2)
+        replace(HELM_STATE_FILE + ".tmp", HELM_STATE_FILE)
+
+
+def helm_repo_cache_dir() -> str:
+    """
+    returns the directory where helm caches the index.yaml of each repo
+    """
+    for line in subproc(['helm env'], quiet=True, spinner=False).splitlines():
+        key, _, value = line.partition('=')
+        if key == "HELM_REPOSITORY_CACHE":
+            return value.strip('"')
+    return ""
+
 
 class Helm:
     """
@@ -47,19 +265,45 @@ class Helm:
             """
             self.repo_dict = repo_dict
 
-        def add(self):
+        def add(self, max_index_age: int = HELM_INDEX_MAX_AGE):
             """
-            helm repo add a dict of repos
+            helm repo add a dict of repos, all at once, and then helm repo
+            update only those of them whose cached index is older than
+            max_index_age seconds. Any other repos you have are left alone
             """
+            existing = {}
+            repo_list = subproc(['helm repo list -o json'], quiet=True,
+                                spinner=False, error_ok=True)
+            try:
+                existing = {repo['name']: repo['url']
+                            for repo in json.loads(repo_list)}
+            except (TypeError, ValueError):
+                # helm errors instead of returning [] if there are no repos
+                log.debug(f"No existing helm repos found: {repo_list}")
+
+            # helm repo add downloads the index too, so new repos are up to date
             cmds = []
+            stale = []
+            cache_dir = helm_repo_cache_dir()
             for repo_name, repo_url in self.repo_dict.items():
-                cmds.append(f'helm repo add {repo_name} {repo_url}')
+                if existing.get(repo_name, "").rstrip('/') != repo_url.rstrip('/'):
+                    cmds.append(f'helm repo add --force-update {repo_name} {repo_url}')
+                    continue
 
-            # update any repos that are out of date
-            cmds.append("helm repo update")
+                index = path.join(cache_dir, f"{repo_name}-index.yaml")
+                if not path.exists(index) or time() - getmtime(index) > max_index_age:
+                    stale.append(repo_name)
+                else:
+                    log.debug(f"helm repo {repo_name}'s index is fresh, so "
+                              "we're not updating it")
 
             # fire all of these off at once
-            subproc(cmds)
+            if cmds:
+                subproc(cmds, parallel=True)
+
+            # update any repos that are out of date
+            if stale:
+                subproc([f'helm repo update {" ".join(stale)}'])
 
         def remove(self):
             """
@@ -96,14 +340,50 @@ class Helm:
             self.values_file = values_file
             self.set_options = set_options
 
-        def check_existing(self,):
+        def get_release(self) -> HelmRelease | dict:
+            """
+            returns the latest revision of this release as a HelmRelease, or
+            an empty dict if it has never been installed
+            """
+            for release in get_helm_releases(self.namespace):
+                if release['name'] == self.release_name:
+                    return release
+            return {}
+
+        def check_existing(self,) -> HelmRelease | dict:
+            """
+            check if we already have an existing install, the same way helm
+            list does, which only shows deployed and failed releases
+            """
+            release = self.get_release()
+            if release.get('status', "") in ["deployed", "failed"]:
+                return release
+            return {}
+
+
+        def state_key(self) -> str:
+            """
+            returns the key for this release in the helm state file, which
+            includes the cluster, since the same release can be in many
+            """
+            return (f"{get_api_client().configuration.host}/"
+                    f"{self.namespace}/{self.release_name}")
+
+        def install_digest(self, version: str) -> str:
             """
-            check if we already have an existing install
+            returns a sha256 of everything we pass to helm for this release:
+            the chart, its version, the values file contents, and set options
             """
-            cmd = (f'helm list --short --filter {self.release_name} '
-                   f' -n {self.namespace}')
-            return subproc([cmd], quiet=True)
+            values = ""
+            if self.values_file and path.exists(self.values_file):
+                with open(self.values_file, 'r') as values_contents:
+                    values = values_contents.read()
 
+            return values_digest({"chart": self.chart_name,
+                                  "version": version,
+                                  "values": values,
+                                  "set": {str(key): str(value) for key, value
+                                          in self.set_options.items()}})
 
         def install(self,
                     wait: bool = False,
@@ -113,23 +393,35 @@ class Helm:
             Installs helm chart to current k8s context, takes optional args:
 
             - wait: bool default: False, if True, will wait till helm release stable
-            - upgrade: bool default: False, if True, will upgrade
+            - upgrade: bool default: False, if True, will upgrade. If the
+                       deployed release is still the revision we last installed
+                       with the exact same chart version and values, we skip it
             """
             if not upgrade:
                 if self.check_existing():
                     log.info(f"{self.release_name} is already installed :)")
                     return True
 
+            version = self.chart_version or self.get_appset_version()
+            digest = self.install_digest(version)
+            state_key = self.state_key()
+
+            if upgrade:
+                release = self.get_release()
+                installed = load_helm_state().get(state_key, {})
+                if release.get('status', "") == "deployed" and \
+                        installed.get('revision') == release['revision'] and \
+                        installed.get('digest') == digest:
+                    log.info(f"{self.release_name} is already up to date with "
+                             "the same chart version and values, so we're not "
+                             "upgrading it :)")
+                    return True
+
             cmd = (f'helm upgrade {self.release_name} {self.chart_name}'
-                   f' --install -n {self.namespace} --create-namespace')
+                   f' --install -n {self.namespace} --create-namespace'
+                   f' --version {version}')
             # f' --atomic')
 
-            if self.chart_version:
-                cmd += f' --version {self.chart_version}'
-            else:
-                version = self.get_appset_version()
-                cmd += f' --version {version}'
-
             if self.values_file:
                 cmd += f' --values {self.values_file}'
 
@@ -142,27 +434,19 @@ class Helm:
 
             subproc([cmd])
 
+            # remember what we installed, so we can skip the same upgrade later
+            release = self.get_release()
+            if release:
+                save_helm_state(state_key, digest, release['revision'])
+
         def get_appset_version(self) -> str:
             """
             go get the version of the helm chart installed by the live appset
             """
-            # get the contents of the remote url
             if "postgres-cluster" in self.release_name:
-                res = requests.get(APPSET_URLS['cnpg-cluster']).text
+                return fetch_appset_version(APPSET_URLS['cnpg-cluster'])
             else:
-                res = requests.get(APPSET_URLS[self.release_name]).text
-
-            # use the ruamel.yaml library to load the yaml
-            yaml = YAML()
-            obj = yaml.load(res)
-
-            # this is an app
-            if obj['kind'] == "Application":
-                return obj['spec']['source']['targetRevision']
-            # this is an appset
-            else:
-                # return the current version of the app
-                return obj['spec']['template']['spec']['source']['targetRevision']
+                return fetch_appset_version(APPSET_URLS[self.release_name])
 
         def uninstall(self):
             """
@@ -178,7 +462,8 @@ def add_default_repos(k8s_distro: str,
                       cilium: bool = False,
                       cnpg_operator: bool = False,
                       argo: bool = False,
-                      argo_secrets: bool = False) -> None:
+                      argo_secrets: bool = False,
+                      max_index_age: int = HELM_INDEX_MAX_AGE) -> None:
     """
     Add all the default helm chart repos:
     - metallb is for loadbalancing and assigning ips, on metal...
@@ -186,6 +471,8 @@ def add_default_repos(k8s_distro: str,
     - ingress-nginx allows us to do ingress, so access outside the cluster
     - jetstack is for cert-manager for TLS certs
     - argo is argoCD to manage k8s resources in the future through a gui
+
+    repos with a cached index newer than max_index_age seconds aren't updated
     """
     repos = OrderedDict()
 
@@ -215,7 +502,7 @@ def add_default_repos(k8s_distro: str,
         repos.pop('ingress-nginx')
 
     # install and update any repos needed
-    Helm.repo(repos).add()
+    Helm.repo(repos).add(max_index_age)
 
 
 def prepare_helm(k8s_distro: str,
@@ -223,7 +510,8 @@ def prepare_helm(k8s_distro: str,
                  cilium: bool = False,
                  cnpg_operator: bool = False,
                  argo: bool = False,
-                 argo_app_set: bool = False) -> bool:
+                 argo_app_set: bool = False,
+                 max_index_age: int = HELM_INDEX_MAX_AGE) -> bool:
     """
     get helm installed if needed, and then install/update all the helm repos
     """
@@ -234,6 +522,10 @@ def prepare_helm(k8s_distro: str,
         sub_header(msg)
         subproc(['brew install helm'])
 
+    # look up the chart versions the appsets use, all at once
+    prefetch_appset_versions()
+
     # this is where we add all the helm repos we're going to use
-    add_default_repos(k8s_distro, metallb, cilium, cnpg_operator, argo, argo_app_set)
+    add_default_repos(k8s_distro, metallb, cilium, cnpg_operator, argo,
+                      argo_app_set, max_index_age)
     return True
@@ -1,17 +1,164 @@
 # external libraries
 from base64 import b64decode as b64dec
-from base64 import standard_b64encode as b64enc
-from json import loads
+from datetime import datetime, timezone
 from kubernetes import client, config
 from kubernetes.client.rest import ApiException
+from kubernetes.dynamic import DynamicClient
+from kubernetes.dynamic.exceptions import ResourceNotFoundError
+import json
 import logging as log
-from os import path
+import requests
 from ruamel.yaml import YAML
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, TypedDict
 
-# internal libraries
-from ..constants import XDG_CACHE_DIR
-from ..utils.run.subproc import subproc, simple_loading_bar
+
+# field manager we use for server side applies, so k8s knows who owns what
+FIELD_MANAGER = "smol-k8s-lab"
+
+# one ApiClient (and so one pool of keep-alive connections) per cluster, shared
+# by every K8s object we create during a run. Keyed by the kubeconfig context
+# name, the api server, and the credentials, so a recreated cluster gets a
+# fresh client instead of reusing a pool with old certs
+API_CLIENTS = {}
+
+
+# api errors that usually mean the cluster isn't quite ready for an object yet,
+# e.g. an admission webhook that isn't up yet, so it's worth trying again
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# apps are installed concurrently, and many of them reload the same deployment
+# (like the bitwarden eso provider), so we only reload each one at a time:
+# {(namespace, name): Lock}, and when its last reload started (monotonic time)
+RELOAD_LOCKS = {}
+RELOAD_STARTED = {}
+RELOAD_LOCKS_LOCK = Lock()
+
+
+class NodeInfo(TypedDict):
+    """
+    the same info you'd get from: kubectl get node {name}
+    """
+    name: str
+    status: str
+    role: str
+    age: str
+    version: str
+
+
+class ApplyResult(TypedDict):
+    """
+    result of server side applying one object with K8s.apply_custom_resources
+    """
+    kind: str
+    name: str
+    namespace: str
+    applied: bool
+    error: str
+    object: dict
+
+
+def get_api_client() -> client.ApiClient:
+    """
+    loads the current kubeconfig context and returns the shared ApiClient for
+    it, creating one if we haven't talked to this cluster yet
+    """
+    configuration = client.Configuration()
+    config.load_kube_config(client_configuration=configuration)
+    # keep the old behavior of load_kube_config() setting the default config
+    client.Configuration.set_default(configuration)
+
+    _, active_context = config.list_kube_config_contexts()
+    key = (active_context['name'],
+           configuration.host,
+           configuration.ssl_ca_cert,
+           configuration.cert_file,
+           str(configuration.api_key))
+
+    if key not in API_CLIENTS:
+        log.debug(f"Creating new k8s ApiClient for {configuration.host}")
+        API_CLIENTS[key] = client.ApiClient(configuration)
+
+    return API_CLIENTS[key]
+
+
+def k8s_age(timestamp: datetime) -> str:
+    """
+    returns how long ago a timestamp was, formatted like kubectl does, e.g. 5d
+    """
+    seconds = int((datetime.now(timezone.utc) - timestamp).total_seconds())
+    for unit, unit_seconds in [("d", 86400), ("h", 3600), ("m", 60)]:
+        if seconds >= unit_seconds:
+            return f"{seconds // unit_seconds}{unit}"
+    return f"{seconds}s"
+
+
+def condition_true(obj: dict, condition_type: str) -> bool:
+    """
+    returns True if a resource dict has a status condition of condition_type
+    that is currently "True"
+    """
+    for condition in obj.get('status', {}).get('conditions', None) or []:
+        if condition['type'] == condition_type and condition['status'] == "True":
+            return True
+    return False
+
+
+def pod_ready(pod: dict) -> bool:
+    """
+    predicate for K8s.wait_for: pod has a Ready condition
+    """
+    return condition_true(pod, "Ready")
+
+
+def job_complete(job: dict) -> bool:
+    """
+    predicate for K8s.wait_for: job has completed. Raises an Exception if the
+    job failed, because it's never going to complete at that point
+    """
+    if condition_true(job, "Failed"):
+        raise Exception(f"Job {job['metadata']['name']} failed")
+    return condition_true(job, "Complete")
+
+
+def deployment_ready(deployment: dict) -> bool:
+    """
+    predicate for K8s.wait_for: all of a deployment's replicas are updated and
+    ready, same as kubectl rollout status
+    """
+    status = deployment.get('status', {})
+    replicas = deployment['spec'].get('replicas', 1)
+    return (status.get('observedGeneration', 0) >= deployment['metadata']['generation']
+            and status.get('updatedReplicas', 0) == replicas
+            and status.get('readyReplicas', 0) == replicas)
+
+
+def namespace_not_found(error: ApiException) -> bool:
+    """
+    an api error is a 404 because the object's namespace doesn't exist yet,
+    e.g. because the Argo CD app that creates it is still syncing
+    """
+    if error.status != 404:
+        return False
+    try:
+        details = json.loads(error.body).get('details', {})
+    except (TypeError, ValueError):
+        return False
+    return details.get('kind') == "namespaces"
+
+
+def raise_for_failed(results: list[ApplyResult]) -> list[ApplyResult]:
+    """
+    raises an Exception if any of the results from K8s.apply_custom_resources
+    weren't applied, so we don't go on to wait for something that was never
+    created. Returns results
+    """
+    failed = [f"{result['kind']}/{result['name']}: {result['error']}"
+              for result in results if not result['applied']]
+    if failed:
+        raise Exception(f"Could not apply {'; '.join(failed)}")
+    return results
 
 
 class K8s():
@@ -23,10 +170,20 @@ class K8s():
         """
         This is mostly for storing the k8s config
         """
-        config.load_kube_config()
         client.rest.logger.setLevel(log.WARNING)
-        self.api_client = client.ApiClient()
+        self.api_client = get_api_client()
         self.core_v1_api = client.CoreV1Api(self.api_client)
+        self._dynamic_client = None
+
+    @property
+    def dynamic_client(self) -> DynamicClient:
+        """
+        dynamic client for resources we don't have typed apis for, e.g. CRDs.
+        Created lazily, because it has to do api discovery against the cluster
+        """
+        if not self._dynamic_client:
+            self._dynamic_client = DynamicClient(self.api_client)
+        return self._dynamic_client
 
     def create_secret(self,
                       name: str,
@@ -64,69 +221,90 @@ class K8s():
             self.core_v1_api.create_namespaced_secret(namespace, body,
                                                       pretty=pretty)
         except ApiException as e:
-            log.error("Exception when calling "
-                      f"CoreV1Api->create_namespaced_secret: {e}")
+            if e.status != 409:
+                log.error("Exception when calling "
+                          f"CoreV1Api->create_namespaced_secret: {e}")
+                return
 
-            # delete the secret if it already exists
+            # replace the secret in place if it already exists, so it's never
+            # missing for anything that reads it
+            log.debug(f"Secret, {name}, already exists in {namespace}, replacing it")
             try:
-                self.core_v1_api.delete_namespaced_secret(name, namespace)
-                self.core_v1_api.create_namespaced_secret(namespace, body,
-                                                          pretty=pretty)
+                self.core_v1_api.replace_namespaced_secret(name, namespace, body,
+                                                           pretty=pretty)
             except ApiException as e:
                 log.error("Exception when calling "
-                          f"CoreV1Api->create_namespaced_secret: {e}")
+                          f"CoreV1Api->replace_namespaced_secret: {e}")
 
     def get_secret(self, name: str, namespace: str) -> dict:
         """
-        get an existing k8s secret
+        get an existing k8s secret as a dict, the same as kubectl get -o json.
+        returns an empty dict if the secret does not exist
         """
         log.debug(f"Getting secret: {name} in namespace: {namespace}")
 
-        res = subproc([f"kubectl get secret -n {namespace} {name} -o json"],
-                      quiet=True)
-        return loads(res)
+        try:
+            secret = self.core_v1_api.read_namespaced_secret(name, namespace)
+        except ApiException as e:
+            if e.status == 404:
+                log.debug(f"Secret, {name}, does not exist in {namespace}")
+                return {}
+            raise
+
+        return self.api_client.sanitize_for_serialization(secret)
 
     def delete_secret(self, name: str, namespace: str) -> None:
         """
-        get an existing k8s secret
+        delete an existing k8s secret
         """
         log.debug(f"Deleting secret: {name} in namespace: {namespace}")
 
-        subproc([f"kubectl delete secret -n {namespace} {name}"])
+        try:
+            self.core_v1_api.delete_namespaced_secret(name, namespace)
+        except ApiException as e:
+            if e.status == 404:
+                log.debug(f"Secret, {name}, was already deleted in {namespace}")
+            else:
+                raise
 
-    def get_nodes(self,) -> list|str:
+    def node_info(self, node: client.V1Node) -> NodeInfo:
         """
-        get all nodes fo current cluster and returns them in a list
+        takes a V1Node and returns the same info as kubectl get node as a dict
         """
-        # todo: figure out how to parse this data
-        # node_list_sdk = self.core_v1_api.list_node()['items']
-        # print(node_list_sdk)
+        status = "NotReady"
+        for condition in node.status.conditions or []:
+            if condition.type == "Ready" and condition.status == "True":
+                status = "Ready"
+        if node.spec.unschedulable:
+            status += ",SchedulingDisabled"
 
-        list_cmd = "kubectl get nodes --no-headers=true"
+        role_prefix = "node-role.kubernetes.io/"
+        roles = [label.replace(role_prefix, "")
+                 for label in (node.metadata.labels or {})
+                 if label.startswith(role_prefix)]
 
-        node_list_cmd = subproc([list_cmd]).rstrip().split('\n')
-        return node_list_cmd
+        return NodeInfo(name=node.metadata.name,
+                        status=status,
+                        role=",".join(sorted(roles)) or "<none>",
+                        age=k8s_age(node.metadata.creation_timestamp),
+                        version=node.status.node_info.kubelet_version)
 
-    def get_node(self, node: str) -> dict:
+    def get_nodes(self,) -> list[NodeInfo]:
+        """
+        get all nodes fo current cluster and returns them in a list of dicts
+        """
+        return [self.node_info(node) for node in self.core_v1_api.list_node().items]
+
+    def get_node(self, node: str) -> NodeInfo | dict:
         """
         checks for specific node and returns info on it as a dict if it exists.
         returns empty dict if node does not return any info
         """
-        return_dict = {}
-        node_list_cmd = subproc([f"kubectl get node {node} --no-headers=true"],
-                                error_ok=True)
-
-        # provided there's no errors, create a dict of relevant info for the node
-        if "Error from server" not in node_list_cmd:
-            res = node_list_cmd.split()
-
-            return_dict["name"] = res[0]
-            return_dict["status"] = res[1]
-            return_dict["role"] = res[2]
-            return_dict["age"] = res[3]
-            return_dict["version"] = res[4]
-
-        return return_dict
+        try:
+            return self.node_info(self.core_v1_api.read_node(node))
+        except Exception as e:
+            log.debug(f"Could not get node {node}: {e}")
+            return {}
 
     def get_namespace(self, name: str) -> bool:
         """
@@ -156,28 +334,46 @@ class K8s():
 
     def reload_deployment(self, name: str, namespace: str, replicas: int = 1) -> None:
         """
-        restart a deployment's pod scaling it up and then down again
-        currently only works with one pod
+        restart a deployment's pods by scaling it down and then up again.
+
+        Only one reload of a deployment runs at a time. If another one started
+        while we were waiting for it, its new pods already have everything we
+        wanted them to pick up, so we don't reload it again
         """
-        # check the current pod name
-        pods = self.get_pod_names(name, namespace)
-        if pods:
-            pod_name = pods[0]
+        key = (namespace, name)
+        requested = monotonic()
+        with RELOAD_LOCKS_LOCK:
+            reload_lock = RELOAD_LOCKS.setdefault(key, Lock())
 
-        # scale deployment down
-        subproc([f"kubectl scale deploy -n {namespace} {name} --replicas=0",
-                 f"kubectl rollout status deployment -n {namespace} {name}"])
+        with reload_lock:
+            if RELOAD_STARTED.get(key, 0) > requested:
+                log.info(f"Deployment {name} in {namespace} was just reloaded")
+                return
+            RELOAD_STARTED[key] = monotonic()
+            self.scale_down_and_up(name, namespace, replicas)
 
-        # make sure the old pod is gone
-        while True:
-            if not pod_name:
-                break
-            if pod_name not in self.get_pod_names(name, namespace):
-                break
+    def scale_down_and_up(self, name: str, namespace: str, replicas: int = 1) -> None:
+        """
+        scales a deployment down to 0, waits for its pods to be gone, and then
+        scales it back up and waits for it to be ready
+        """
+        apps_v1_api = client.AppsV1Api(self.api_client)
+        deployment = apps_v1_api.read_namespaced_deployment(name, namespace)
+        selector = ",".join([f"{key}={value}" for key, value in
+                             deployment.spec.selector.match_labels.items()])
 
-        # scale deployment back up
-        subproc([f"kubectl scale deploy -n {namespace} {name} --replicas={replicas}",
-                 f"kubectl rollout status deployment -n {namespace} {name}"])
+        # scale deployment down and make sure the old pods are gone
+        log.info(f"Scaling deployment {name} in {namespace} down to 0")
+        apps_v1_api.patch_namespaced_deployment_scale(
+                name, namespace, {"spec": {"replicas": 0}})
+        self.wait_for_deleted("v1", "Pod", namespace, label_selector=selector)
+
+        # scale deployment back up and wait for the new pods to be ready
+        log.info(f"Scaling deployment {name} in {namespace} up to {replicas}")
+        apps_v1_api.patch_namespaced_deployment_scale(
+                name, namespace, {"spec": {"replicas": replicas}})
+        self.wait_for("apps/v1", "Deployment", namespace, deployment_ready,
+                      name=name)
 
     def get_pod_names(self,
                       name: str,
@@ -186,29 +382,27 @@ class K8s():
         """
         get the pod name from a deployment or job based on the label
         """
-        pod_cmd = (f"kubectl get pods -n {namespace} --no-headers"
-                   " -o custom-columns=NAME:.metadata.name"
-                   f" -l app.kubernetes.io/instance={name}")
-
+        label_selector = f"app.kubernetes.io/instance={name}"
         if extra_label:
-            pod_cmd += "," + extra_label
+            label_selector += "," + extra_label
 
-        pods = subproc([pod_cmd])
+        pods = self.core_v1_api.list_namespaced_pod(namespace,
+                                                    label_selector=label_selector)
+        return [pod.metadata.name for pod in pods.items]
 
-        if pods:
-            if "\n" in pods:
-                return pods.split('\n')
-            else:
-                return [pods.strip()]
-        else:
-            return []
-
-    def delete_namespaced_pods(self, namespace: str = "") -> None:
+    def delete_namespaced_pods(self, namespace: str = "") -> str:
         """
-        deletes all the pods in a given namespace
+        deletes all the pods in a given namespace and returns which ones
         """
-        return subproc([f"kubectl delete pods -n {namespace} --all"],
-                       error_ok=True)
+        try:
+            pods = self.core_v1_api.list_namespaced_pod(namespace)
+            self.core_v1_api.delete_collection_namespaced_pod(namespace)
+        except ApiException as e:
+            log.error(f"Could not delete pods in namespace {namespace}: {e}")
+            return str(e)
+
+        return "".join([f'pod "{pod.metadata.name}" deleted\n'
+                        for pod in pods.items])
 
     # def create_from_manifest_dict(self,
     #                               api_group: str = "",
@@ -236,108 +430,199 @@ class K8s():
     #                   f"create_namespaced_custom_object: {e}")
     #     return True
 
+    def get_resource(self, api_version: str, kind: str):
+        """
+        returns the dynamic client resource for an apiVersion and kind
+        """
+        try:
+            return self.dynamic_client.resources.get(api_version=api_version,
+                                                     kind=kind)
+        except ResourceNotFoundError:
+            # the CRD may have been created after we cached api discovery
+            self.dynamic_client.resources.invalidate_cache()
+            return self.dynamic_client.resources.get(api_version=api_version,
+                                                     kind=kind)
+
+    def apply_manifest_dict(self, manifest: dict, namespace: str = "") -> dict:
+        """
+        server side applies a single manifest dict via the dynamic client and
+        returns the applied object as a dict. namespace is only used if the
+        resource is namespaced and the manifest doesn't already have one
+        """
+        kind = manifest['kind']
+        resource = self.get_resource(manifest['apiVersion'], kind)
+
+        if resource.namespaced:
+            namespace = manifest['metadata'].get('namespace', namespace) or "default"
+        else:
+            namespace = None
+
+        log.debug(f"Applying {kind} {manifest['metadata']['name']}")
+        res = self.dynamic_client.server_side_apply(resource,
+                                                    body=manifest,
+                                                    namespace=namespace,
+                                                    field_manager=FIELD_MANAGER,
+                                                    force_conflicts=True)
+        return res.to_dict()
+
     def apply_manifests(self,
                         manifest_file_name: str,
                         namespace: str = "default",
                         deployment: str = "",
                         selector: str = "component=controller"):
         """
-        applies a manifest and waits with a nice loading bar if deployment name
-        is passed in
+        applies a manifest file or url and waits with a nice loading bar if
+        deployment name is passed in
         """
-        if not namespace:
-            cmds = [f"kubectl apply --wait -f {manifest_file_name}"]
+        # manifests can be either a url or a local file
+        if manifest_file_name.startswith(("https://", "http://")):
+            res = requests.get(manifest_file_name)
+            res.raise_for_status()
+            manifest_text = res.text
         else:
-            cmds = [f"kubectl apply -n {namespace} --wait -f {manifest_file_name}"]
-
-        if deployment:
-            # these commands let us monitor a deployment rollout
-            cmds.append(f"kubectl rollout status -n {namespace} "
-                       f"deployment/{deployment}")
+            with open(manifest_file_name, 'r') as manifest_file:
+                manifest_text = manifest_file.read()
 
-            cmds.append("kubectl wait --for=condition=ready pod --selector="
-                       f"{selector} --timeout=5m -n {namespace}")
+        yaml = YAML(typ='safe')
+        for manifest in yaml.load_all(manifest_text):
+            # skip empty documents, e.g. a trailing ---
+            if manifest:
+                self.apply_manifest_dict(manifest, namespace)
 
-        # loops with progress bar until this succeeds
-        subproc(cmds)
+        if deployment:
+            # monitor the deployment rollout and then make sure the pods are up
+            self.wait_for("apps/v1", "Deployment", namespace, deployment_ready,
+                          name=deployment, timeout=300)
+            self.wait_for("v1", "Pod", namespace, pod_ready,
+                          label_selector=selector, timeout=300)
         return True
 
-    def apply_custom_resources(self, custom_resource_dict_list: list[dict]):
+    def apply_custom_resources(self,
+                               custom_resource_dict_list: list[dict],
+                               namespace: str = "",
+                               timeout: int = 120) -> list[ApplyResult]:
         """
-        Does a kube apply on a custom resource dict, and retries if it fails
-        using loading bar for progress
+        Server side applies a list of resource dicts, in order, straight
+        through the dynamic client, and returns a result for each object.
+
+        Only retries errors that usually mean the cluster isn't ready for the
+        object yet: a CRD or namespace that doesn't exist yet, or a
+        webhook/api server that isn't answering yet. Those are retried with a backoff until timeout
+        (in seconds). Any other error is logged and returned in the results.
         """
-        k_cmd = 'kubectl apply --wait -f '
-        commands = {}
         log.debug(custom_resource_dict_list)
-        yaml = YAML()
+        results = []
 
-        # Write YAML data to f'{XDG_CACHE_DIR}/{resource_name}.yaml'.
         for custom_resource_dict in custom_resource_dict_list:
-            resource_name = "_".join([custom_resource_dict['kind'],
-                                      custom_resource_dict['metadata']['name']])
-            yaml_file_name = path.join(XDG_CACHE_DIR, f'{resource_name}.yaml')
-
-            with open(yaml_file_name, 'w') as cr_file:
-                yaml.dump(custom_resource_dict, cr_file)
+            metadata = custom_resource_dict['metadata']
+            resource_name = f"{custom_resource_dict['kind']}/{metadata['name']}"
+            result = ApplyResult(kind=custom_resource_dict['kind'],
+                                 name=metadata['name'],
+                                 namespace=metadata.get('namespace', namespace),
+                                 applied=False,
+                                 error="",
+                                 object={})
+
+            deadline = monotonic() + timeout
+            attempt = 0
+            while True:
+                try:
+                    result['object'] = self.apply_manifest_dict(custom_resource_dict,
+                                                                namespace)
+                except (ResourceNotFoundError, ApiException) as e:
+                    retryable = (isinstance(e, ResourceNotFoundError) or
+                                 e.status in RETRYABLE_STATUS_CODES or
+                                 namespace_not_found(e))
+                    backoff = min(0.5 * 2 ** attempt, 8)
+                    if retryable and monotonic() + backoff < deadline:
+                        log.debug(f"Retrying {resource_name} in {backoff}s: {e}")
+                        sleep(backoff)
+                        attempt += 1
+                        continue
+                    result['error'] = str(e)
+                    log.error(f"Could not apply {resource_name}: {e}")
+                else:
+                    result['applied'] = True
+                    log.info(f"Applied {resource_name}")
+                break
 
-            commands[f'Installing {resource_name}'] = k_cmd + yaml_file_name
+            results.append(result)
 
-        # loops with progress bar until this succeeds
-        simple_loading_bar(commands)
+        return results
 
     def update_secret_key(self,
                           secret_name: str,
                           secret_namespace: str,
                           updated_values_dict: dict,
-                          in_line_key_name: str = 'secret_vars.yaml') -> None:
+                          in_line_key_name: str = 'secret_vars.yaml',
+                          secret_keys: dict = {},
+                          retries: int = 5) -> None:
         """
-        update a key in a k8s secret
+        update keys in a k8s secret in place, with one patch, so the secret
+        never goes missing. Creates the secret if it doesn't exist yet.
+
         if in_line_key_name is set to a key name, you can specify a base key in a
-        secret that contains an inline yaml block
+        secret that contains an inline yaml block, and updated_values_dict are
+        keys in that yaml block. Otherwise they're keys of the secret itself.
+        secret_keys are extra keys of the secret itself, updated in the same patch.
+
+        Updating an inline yaml block means reading it first, so that patch
+        includes the resourceVersion we read. If the secret changed since then,
+        the api server refuses it with a 409, and we read it and try again.
         """
+        if in_line_key_name:
+            string_data = dict(secret_keys)
+        else:
+            string_data = {**secret_keys, **updated_values_dict}
+
+        for attempt in range(retries):
+            patch = {"stringData": dict(string_data)}
 
-        # get current secret data, but catch if there's no secret at all
-        try:
-            secret_data = self.get_secret(secret_name, secret_namespace)['data']
-        except Exception as e:
-            log.error(f"Error getting secret: {e}")
-            log.info("creating new secret")
             if in_line_key_name:
-                self.create_secret(secret_name,
-                                   secret_namespace,
-                                   updated_values_dict,
-                                   in_line_key_name)
-            else:
-                self.create_secret(secret_name,
-                                   secret_namespace,
-                                   updated_values_dict)
-            # return immediately so we don't do the rest of the function
-            return
+                secret = self.get_secret(secret_name, secret_namespace)
+                if secret:
+                    file_key = secret.get('data', {}).get(in_line_key_name, "")
+                    decoded_data = b64dec(str.encode(file_key)).decode('utf8')
+                    # load the yaml as a python dictionary
+                    in_line_yaml = YAML(typ='safe').load(decoded_data) or {}
+                    patch["metadata"] = {
+                            "resourceVersion": secret['metadata']['resourceVersion']
+                            }
+                else:
+                    in_line_yaml = {}
+
+                in_line_yaml.update(updated_values_dict)
+                # https://pypi.org/project/ruamel.yaml.string/
+                safe_yaml = YAML(typ=['rt', 'string'])
+                patch["stringData"][in_line_key_name] = safe_yaml.dump_to_string(in_line_yaml)
 
-        # if this is a secret with a filename key and then inline yaml inside...
-        if in_line_key_name:
-            yaml = YAML(typ='safe')
-            file_key = secret_data[in_line_key_name]
-            decoded_data  = b64dec(str.encode(file_key)).decode('utf8')
-            # load the yaml as a python dictionary
-            in_line_yaml = yaml.load(decoded_data)
-            # for each key, updated_value in updated_values_dict
-            for key, updated_value in updated_values_dict.items():
-               # update the in-line yaml
-               in_line_yaml[key] = updated_value
-            self.delete_secret(secret_name, secret_namespace)
-            # update the inline yaml for the dict we'll feed back to
-            self.create_secret(secret_name,
-                               secret_namespace,
-                               in_line_yaml,
-                               in_line_key_name)
-        else:
-            for key, updated_value in updated_values_dict.items():
-               # update the keys in the secret yaml one by one
-               secret_data[key] = b64enc(bytes(updated_value))
-            self.delete_secret(secret_name, secret_namespace)
-            self.create_secret(secret_name, secret_namespace, secret_data)
+            try:
+                self.core_v1_api.patch_namespaced_secret(secret_name,
+                                                         secret_namespace,
+                                                         patch)
+                return
+            except ApiException as e:
+                if e.status == 404:
+                    log.info(f"creating new secret {secret_name} in {secret_namespace}")
+                    body = client.V1Secret(
+                            metadata=client.V1ObjectMeta(name=secret_name),
+                            string_data=patch["stringData"])
+                    try:
+                        self.core_v1_api.create_namespaced_secret(secret_namespace,
+                                                                  body)
+                        return
+                    except ApiException as create_error:
+                        # someone else created it first, so patch theirs
+                        if create_error.status != 409:
+                            raise
+                elif e.status != 409:
+                    raise
+                log.debug(f"Secret {secret_name} changed while we were updating "
+                          f"it, trying again (attempt {attempt + 1}/{retries})")
+
+        raise Exception(f"Could not update secret {secret_name} in "
+                        f"{secret_namespace} after {retries} attempts, because "
+                        "it kept changing")
 
     def run_k8s_cmd(self,
                     pod_name: str,
@@ -359,42 +644,138 @@ class K8s():
         return self.core_v1_api.connect_get_namespaced_pod_exec(**run_dict)
 
 
+    def watch_until(self,
+                    api_version: str,
+                    kind: str,
+                    namespace: str,
+                    done: Callable[[dict], bool],
+                    name: str = "",
+                    label_selector: str = "",
+                    timeout: int = 600) -> dict:
+        """
+        watches all resources of a kind that match name or label_selector in a
+        namespace until done returns True or we run out of time.
+
+        done is called with a dict of {name: resource dict} for every matching
+        resource that currently exists, every time one is added, modified, or
+        deleted. Returns that same dict once done returns True. Raises a
+        TimeoutError if timeout (in seconds) runs out first.
+        """
+        resource = self.get_resource(api_version, kind)
+        field_selector = f"metadata.name={name}" if name else None
+        label_selector = label_selector or None
+        namespace = namespace if resource.namespaced else None
+        description = f"{kind} {name or label_selector} in {namespace}"
+        deadline = monotonic() + timeout
+        resource_version = None
+
+        while True:
+            # list first, so we know the current state and where to watch from
+            if not resource_version:
+                current = self.dynamic_client.get(resource,
+                                                  namespace=namespace,
+                                                  field_selector=field_selector,
+                                                  label_selector=label_selector)
+                objects = {obj['metadata']['name']: obj
+                           for obj in current.to_dict()['items']}
+                resource_version = current.metadata.resourceVersion
+
+            if done(objects):
+                return objects
+
+            remaining = int(deadline - monotonic())
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out after {timeout}s waiting on "
+                                   f"{description}")
+
+            log.debug(f"Watching {description} for up to {remaining}s")
+            try:
+                for event in self.dynamic_client.watch(
+                        resource,
+                        namespace=namespace,
+                        field_selector=field_selector,
+                        label_selector=label_selector,
+                        resource_version=resource_version,
+                        timeout=remaining):
+                    obj = event['raw_object']
+                    resource_version = obj['metadata']['resourceVersion']
+                    if event['type'] == "DELETED":
+                        objects.pop(obj['metadata']['name'], None)
+                    else:
+                        objects[obj['metadata']['name']] = obj
+
+                    if done(objects):
+                        return objects
+            except ApiException as e:
+                # 410 Gone means our resource_version is too old, so list again
+                if e.status != 410:
+                    raise
+                resource_version = None
+
+    def wait_for(self,
+                 api_version: str,
+                 kind: str,
+                 namespace: str,
+                 predicate: Callable[[dict], bool],
+                 name: str = "",
+                 label_selector: str = "",
+                 timeout: int = 600) -> list[dict]:
+        """
+        waits until there's at least one resource matching name or
+        label_selector and predicate returns True for all of them, e.g.:
+
+            k8s.wait_for("batch/v1", "Job", "nextcloud", job_complete,
+                         name="my-job")
+
+        Blocks on watch events instead of polling, so we return as soon as the
+        resource is ready. Returns the matching resources as a list of dicts.
+        """
+        objects = self.watch_until(
+                api_version, kind, namespace,
+                lambda objs: bool(objs) and all(map(predicate, objs.values())),
+                name, label_selector, timeout)
+        return list(objects.values())
+
+    def wait_for_deleted(self,
+                         api_version: str,
+                         kind: str,
+                         namespace: str,
+                         name: str = "",
+                         label_selector: str = "",
+                         timeout: int = 600) -> None:
+        """
+        waits until no resources match name or label_selector anymore
+        """
+        self.watch_until(api_version, kind, namespace, lambda objs: not objs,
+                         name, label_selector, timeout)
+
     def wait(self,
              namespace: str,
              name: str = "",
              instance: str = "",
              quiet: bool = False) -> str:
         """
-        wait for a given deployment, statefulset, pod, or job to complete or be ready.
-        must pass in either name or instance args.
+        wait for a given pod or pods to be ready. must pass in either name or
+        instance args.
 
         args:
             namespace  - str, namespace of resource to wait on
-            name       - str, optional name of resource to wait on
+            name       - str, optional name of pod to wait on
             instance   - str, optional value for app.kubernetes.io/instance label
         """
-        wait_cmd = (
-                f'kubectl wait pod -n {namespace} --for=condition=ready --timeout=10m'
-                )
-
         if instance:
-            wait_cmd += f" -l app.kubernetes.io/instance={instance}"
+            wait_dict = {"label_selector": f"app.kubernetes.io/instance={instance}"}
         elif name:
-            wait_cmd += f" {name}"
+            wait_dict = {"name": name}
         else:
             log.error("Expected [i]name[/i] or [i]instance[/i] for wait command")
             return
 
-        # keep retrying till we find the thing...
-        while True:
-            if not quiet:
-                res = subproc([wait_cmd], error_ok=True)
-            else:
-                res = subproc([wait_cmd], error_ok=True, quiet=True)
+        if not quiet:
+            log.info(f"Waiting for pods {name or instance} in {namespace} to be ready")
 
-            if "no matching resources found" not in res:
-                log.info("found resource and waited on it")
-                return res
-            else:
-                log.debug("No matching resource found, waiting 3 seconds...")
-                sleep(3)
+        pods = self.wait_for("v1", "Pod", namespace, pod_ready, **wait_dict)
+
+        log.info("found resource and waited on it")
+        return "\n".join([f"pod/{pod['metadata']['name']} condition met"
+                          for pod in pods])
@@ -7,7 +7,7 @@ DESCRIPTION: restore stuff with k8up (restic on k8s) and cnpg operator
 # internal libraries
 from smol_k8s_lab.constants import XDG_CACHE_DIR
 from smol_k8s_lab.k8s_tools.argocd_util import ArgoCD
-from smol_k8s_lab.k8s_tools.k8s_lib import K8s
+from smol_k8s_lab.k8s_tools.k8s_lib import K8s, job_complete, raise_for_failed
 from smol_k8s_lab.k8s_tools.helm import Helm
 from smol_k8s_lab.utils.run.subproc import subproc
 from smol_k8s_lab.utils.minio_lib import BetterMinio
@@ -48,6 +48,7 @@ def restore_seaweedfs(argocd: ArgoCD,
     pvc_appset = (
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argocd_path}s3_pvc_appset.yaml")
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(pvc_appset, argocd.namespace)
 
     for swfs_pvc, snapshot_id in snapshots.items():
@@ -68,6 +69,7 @@ def restore_seaweedfs(argocd: ArgoCD,
     seaweedfs_appset = (
             f"https://raw.githubusercontent.com/small-hack/argocd-apps/{revision}/"
             f"{argocd_path}s3_provider_argocd_appset.yaml")
+    argocd.flush_appset_secret()
     argocd.k8s.apply_manifests(seaweedfs_appset, argocd.namespace)
 
     # and finally wait for the seaweedfs helm chart app to be ready
@@ -143,25 +145,25 @@ def k8up_restore_pvc(k8s_obj: K8s,
                                                                restic_repo_password)
 
     # apply the k8up restore job
-    k8s_obj.apply_custom_resources([restore_dict])
+    raise_for_failed(k8s_obj.apply_custom_resources([restore_dict]))
 
-    # loop on check to make sure the restore is done before continuing
-    check_cmd = (f"kubectl get restore -n {namespace} --no-headers -o "
-                 f"custom-columns=COMPLETION:.status.finished {pvc}-{now}")
-    while True:
-        restore_done = subproc([check_cmd]).strip()
-        log.debug(f"restore done returns {restore_done}")
+    # wait to make sure the restore is done before continuing
+    log.info(f"Waiting for k8up restore: {pvc}-{now}")
+    k8s_obj.wait_for("k8up.io/v1", "Restore", namespace, restore_finished,
+                     name=f"{pvc}-{now}", timeout=1800)
 
-        pod_cmd = (f"kubectl get pods -n {namespace} --no-headers -o "
-                   f"custom-columns=NAME:.metadata.name | grep {pvc}-{now}")
-        pod = subproc([pod_cmd], universal_newlines=True, shell=True)
-        subproc([f"kubectl logs -n {namespace} --tail=5 {pod}"], error_ok=True)
+    # tail the logs out for the pod now that we're done
+    pod_cmd = (f"kubectl get pods -n {namespace} --no-headers -o "
+               f"custom-columns=NAME:.metadata.name | grep {pvc}-{now}")
+    pod = subproc([pod_cmd], universal_newlines=True, shell=True)
+    subproc([f"kubectl logs -n {namespace} --tail=5 {pod}"], error_ok=True)
 
-        if restore_done != "true":
-            # sleep then try again
-            sleep(5)
-        else:
-            break
+
+def restore_finished(restore: dict) -> bool:
+    """
+    predicate for K8s.wait_for: k8up Restore has status.finished set to true
+    """
+    return restore.get('status', {}).get('finished', False) is True
 
 
 def get_latest_snapshot(pvc: str,
@@ -300,20 +302,14 @@ def restore_cnpg_cluster(k8s_obj: K8s,
     # check for cnpg recovery job and wait for it.
     # example job name: nextcloud-postgres-1-full-recovery
     recover_job = f"{cluster_name}-1-full-recovery"
-    wait_cmd = (f"kubectl wait -n {namespace} --for=condition=complete "
-                f"--timeout=30m job/{recover_job}")
-    wait_msg = f"Waiting on cnpg recovery job: {recover_job}"
-    while True:
-        log.debug(wait_msg)
-        res = subproc([wait_cmd], error_ok=True)
-        if "NotFound" in res:
-            sleep(1)
-        else:
-            pods = k8s_obj.get_pod_names(recover_job, namespace)
-            if pods:
-                tail_out = subproc([f"kubectl tail -n {namespace} {pods[0]}"])
-                log.info(tail_out)
-            break
+    log.info(f"Waiting on cnpg recovery job: {recover_job}")
+    k8s_obj.wait_for("batch/v1", "Job", namespace, job_complete,
+                     name=recover_job, timeout=1800)
+
+    pods = k8s_obj.get_pod_names(recover_job, namespace)
+    if pods:
+        tail_out = subproc([f"kubectl tail -n {namespace} {pods[0]}"])
+        log.info(tail_out)
 
     # fix backups after restore
     restore_dict['bootstrap'].pop('recovery')
@@ -397,7 +393,7 @@ def recreate_pvc(k8s_obj: K8s,
                 }
 
     # apply the pvc_dict
-    k8s_obj.apply_custom_resources([pvc_dict])
+    raise_for_failed(k8s_obj.apply_custom_resources([pvc_dict]))
 
     # label the PVCs so Argo CD doesn't complain
     if argo_label:
@@ -543,23 +539,15 @@ def create_restic_restore_job(k8s_obj: K8s,
         restore_job['spec']['template']['spec']['tolerations'] = tolerations_dict
 
     # creates the restore job
-    k8s_obj.apply_custom_resources([restore_job])
+    raise_for_failed(k8s_obj.apply_custom_resources([restore_job]))
 
     # wait for restore job to complete
-    wait_cmd = (f"kubectl wait job -n {namespace} --for=condition=complete "
-                f"{app}-restic-restore-{now} --timeout=15m")
+    log.info(f"Waiting for restore job: {app}-restic-restore-{now}")
+    k8s_obj.wait_for("batch/v1", "Job", namespace, job_complete,
+                     name=f"{app}-restic-restore-{now}", timeout=900)
+
+    # tail the logs out for the pod if we're done
     pod_cmd = (f"kubectl get pods -n {namespace} --no-headers -o "
                f"custom-columns=NAME:.metadata.name | grep {app}-restic-restore-{now}")
-    log.info(wait_cmd)
-    while True:
-        log.debug(f"Waiting for restore job: {app}-restic-restore-{now}")
-        res = subproc([wait_cmd], error_ok=True)
-        log.debug(res)
-
-        if "NotFound" in res:
-            sleep(1)
-        else:
-            # tail the logs out for the pod if we're done
-            pod = subproc([pod_cmd], universal_newlines=True, shell=True)
-            subproc([f"kubectl logs -n {namespace} --tail=5 {pod}"], error_ok=True)
-            break
+    pod = subproc([pod_cmd], universal_newlines=True, shell=True)
+    subproc([f"kubectl logs -n {namespace} --tail=5 {pod}"], error_ok=True)
@@ -409,7 +409,7 @@ class AppsConfigScreen(Screen):
 
         # sync the app
         self.log(f"♻️ Syncing {app} via the TUI...")
-        res = self.argocd.sync_app(app, spinner=False)
+        res = self.argocd.sync_app(app, spinner=False, wait=False)
 
         if res:
             severity = "information"
@@ -1,6 +1,6 @@
 # smol-k8s-lab libraries
 from smol_k8s_lab.constants import INITIAL_USR_CONFIG, XDG_CONFIG_FILE, VERSION
-from smol_k8s_lab.k8s_distros import check_all_contexts
+from smol_k8s_lab.k8s_distros import cached_contexts, check_all_contexts
 from smol_k8s_lab.tui.apps_screen import AppsConfigScreen
 from smol_k8s_lab.tui.base_widgets.audio_widget import SmolAudio
 from smol_k8s_lab.tui.base_widgets.cluster_modal import ClusterModalScreen
@@ -16,13 +16,27 @@ from smol_k8s_lab.tui.tui_config_screen import TuiConfigScreen
 from pyfiglet import Figlet
 from rich.text import Text
 from ruamel.yaml import YAML
-from textual import on
+from textual import on, work
 from textual.app import App, ComposeResult
 from textual.events import DescendantFocus
 from textual.binding import Binding
 from textual.containers import Grid
 from textual.widgets import Footer, DataTable, Label
 
+CLUSTER_COLUMNS = ["cluster", "distro", "version", "platform"]
+
+
+def styled_cluster_row(row: tuple) -> list[Text]:
+    """
+    returns a row of the cluster table with each cell centered, and the
+    version greyed out if we couldn't reach the cluster
+    """
+    # we use an extra line to center the rows vertically
+    styled_row = [Text(str("\n" + cell), justify="center") for cell in row]
+    if row[2] == "unreachable":
+        styled_row[2].stylize("grey53 italic")
+    return styled_row
+
 
 class BaseApp(App):
     BINDINGS = [
@@ -106,8 +120,9 @@ class BaseApp(App):
         title = "[#ffaff9]Create[/] a [i]new[/] [#C1FF87]cluster[/] with the name below"
         self.get_widget_by_id("base-new-cluster-input-box-grid").border_title = title
 
-        # get all clusters
-        clusters = check_all_contexts()
+        # show the clusters from last time right away, and then check them all
+        # in the background, so we don't wait on clusters that aren't there
+        clusters = cached_contexts()
 
         if clusters:
             self.generate_cluster_table(clusters)
@@ -116,6 +131,38 @@ class BaseApp(App):
             self.get_widget_by_id("base-screen-container").add_class("no-cluster-table")
             self.call_after_refresh(self.play_screen_audio, screen="base")
 
+        self.refresh_cluster_table()
+
+    @work(thread=True, exclusive=True, group="check-clusters-worker")
+    def refresh_cluster_table(self) -> None:
+        """
+        checks every cluster in the kubeconfig, and updates each one's row in
+        the cluster table as soon as it answers
+        """
+        check_all_contexts(
+                on_probed=lambda row: self.call_from_thread(self.update_cluster_row, row)
+                )
+
+    def update_cluster_row(self, row: tuple) -> None:
+        """
+        update a cluster's row in the cluster table, adding the row (or the
+        whole table) if it's not there yet
+        """
+        if not self.cluster_names:
+            screen = self.get_widget_by_id("base-screen-container")
+            screen.remove_class("no-cluster-table")
+            self.generate_cluster_table([row])
+            return
+
+        data_table = self.get_widget_by_id("clusters-data-table")
+        if row[0] not in self.cluster_names:
+            data_table.add_row(*styled_cluster_row(row), height=3, key=row[0])
+            self.cluster_names.append(row[0])
+            return
+
+        for column, cell in zip(CLUSTER_COLUMNS, styled_cluster_row(row)):
+            data_table.update_cell(row[0], column, cell)
+
     def generate_cluster_table(self, clusters: list) -> None:
         """
         generate a readable table for all the clusters.
@@ -128,17 +175,13 @@ class BaseApp(App):
                                cursor_type="row")
 
         # then fill in the cluster table
-        data_table.add_column(Text("Cluster", justify="center"))
-        data_table.add_column(Text("Distro", justify="center"))
-        data_table.add_column(Text("Version", justify="center"))
-        data_table.add_column(Text("Platform", justify="center"))
+        for column in CLUSTER_COLUMNS:
+            data_table.add_column(Text(column.title(), justify="center"),
+                                  key=column)
 
         for row in clusters:
-            # we use an extra line to center the rows vertically
-            styled_row = [Text(str("\n" + cell), justify="center") for cell in row]
-
             # we add extra height to make the rows more readable
-            data_table.add_row(*styled_row, height=3, key=row[0])
+            data_table.add_row(*styled_cluster_row(row), height=3, key=row[0])
 
             self.cluster_names.append(row[0])
 
@@ -0,0 +1,93 @@
+"""
+Run a set of tasks that depend on each other, running the independent ones
+concurrently, so that one slow task doesn't hold up everything else.
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging as log
+from typing import Callable
+
+
+def check_for_cycles(dependencies: dict) -> None:
+    """
+    raises a ValueError if dependencies, a dict of {task: set(tasks it needs)},
+    has a cycle in it, because then those tasks could never run
+    """
+    remaining = {task: set(deps) for task, deps in dependencies.items()}
+    while remaining:
+        ready = [task for task, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError("These tasks depend on each other in a cycle: "
+                             f"{', '.join(sorted(remaining))}")
+        for task in ready:
+            remaining.pop(task)
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def run_dag(tasks: dict[str, Callable[[dict], object]],
+            dependencies: dict[str, list] = {},
+            max_workers: int = 4) -> dict:
+    """
+    Runs tasks on a pool of at most max_workers threads, starting each task as
+    soon as all the tasks it depends on have finished.
+
+    Arguments:
+        tasks:        dict of {task name: callable}. Each callable is passed
+                      the dict of results from the tasks that are done so far
+        dependencies: dict of {task name: [names of tasks it needs first]}.
+                      Names that aren't in tasks are ignored, because they're
+                      either disabled or already done
+        max_workers:  max number of tasks to run at the same time
+
+    Returns a dict of {task name: result}. If any task fails, the tasks that
+    depend on it are skipped, the rest are still run, and then an Exception
+    with every failure is raised.
+    """
+    pending = {task: set(dependencies.get(task, [])) & tasks.keys()
+               for task in tasks}
+    check_for_cycles(pending)
+
+    results = {}
+    errors = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            # start everything that isn't waiting on anything anymore
+            for task in [task for task, deps in pending.items() if not deps]:
+                pending.pop(task)
+                log.debug(f"Starting {task}")
+                running[executor.submit(tasks[task], results)] = task
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    results[task] = future.result()
+                except Exception as e:
+                    log.error(f"{task} failed: {e}")
+                    errors[task] = e
+                    failed = [task]
+                else:
+                    log.debug(f"Finished {task}")
+                    failed = []
+
+                # skip anything that depended on a failed task, and so on
+                while failed:
+                    failed_task = failed.pop()
+                    for other, deps in list(pending.items()):
+                        if failed_task in deps:
+                            log.error(f"Skipping {other}, because it needs "
+                                      f"{failed_task}, which failed")
+                            errors[other] = Exception(f"needs {failed_task}")
+                            pending.pop(other)
+                            failed.append(other)
+
+                for deps in pending.values():
+                    deps.discard(task)
+
+    if errors:
+        raise Exception("These tasks did not complete: " +
+                        "; ".join([f"{task}: {e}" for task, e in errors.items()]))
+
+    return results
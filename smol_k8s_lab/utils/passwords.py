@@ -1,32 +1,120 @@
 import secrets
 import string
-from random import randrange
 
 
-def create_password(special_character: bool = False, characters: int = 32) -> str:
+class PasswordPolicy():
+    """
+    what a generated password looks like: how long it is, which kinds of
+    characters it can have, and how many of each kind it needs at least
+    """
+    def __init__(self,
+                 length: int = 32,
+                 min_lowercase: int = 1,
+                 min_uppercase: int = 1,
+                 min_digits: int = 3,
+                 special: bool = False,
+                 special_characters: str = ".",
+                 min_special: int = 1):
+        """
+        length:             int, number of characters in the password
+        min_lowercase:      int, least number of lowercase letters
+        min_uppercase:      int, least number of uppercase letters
+        min_digits:         int, least number of digits
+        special:            bool, if True, also use special_characters
+        special_characters: str of the special characters we can use
+        min_special:        int, least number of special characters, if special
+        """
+        self.length = length
+        self.min_lowercase = min_lowercase
+        self.min_uppercase = min_uppercase
+        self.min_digits = min_digits
+        self.special = special
+        self.special_characters = special_characters
+        self.min_special = min_special
+
+        if self.special and not self.special_characters:
+            raise ValueError("special is True, but there are no special_characters")
+
+        required = (self.min_lowercase + self.min_uppercase + self.min_digits +
+                    self.required_special())
+        if required > self.length:
+            raise ValueError(f"A password of length {self.length} can't have the "
+                             f"{required} characters this policy requires")
+
+    def replace(self, **changes) -> 'PasswordPolicy':
+        """
+        returns a copy of this policy with the given args changed
+        """
+        args = {"length": self.length,
+                "min_lowercase": self.min_lowercase,
+                "min_uppercase": self.min_uppercase,
+                "min_digits": self.min_digits,
+                "special": self.special,
+                "special_characters": self.special_characters,
+                "min_special": self.min_special}
+        args.update(changes)
+        return PasswordPolicy(**args)
+
+    def required_special(self) -> int:
+        """
+        returns the least number of special characters a password needs
+        """
+        return self.min_special if self.special else 0
+
+    def alphabet(self) -> str:
+        """
+        returns a str of every character a password can have
+        """
+        alphabet = string.ascii_letters + string.digits
+        if self.special:
+            alphabet += self.special_characters
+        return alphabet
+
+    def is_valid(self, password: str) -> bool:
+        """
+        returns True if the password has enough of each kind of character
+        """
+        return (len(password) == self.length
+                and sum(c.islower() for c in password) >= self.min_lowercase
+                and sum(c.isupper() for c in password) >= self.min_uppercase
+                and sum(c.isdigit() for c in password) >= self.min_digits
+                and sum(c in self.special_characters for c in password
+                        ) >= self.required_special())
+
+    def generate(self) -> str:
+        """
+        returns a new random password that meets this policy:
+        https://docs.python.org/3/library/secrets.html#recipes-and-best-practices
+        """
+        alphabet = self.alphabet()
+        while True:
+            password = ''.join(secrets.choice(alphabet) for i in range(self.length))
+            if self.is_valid(password):
+                return password
+
+
+# the policy create_password and BwCLI.generate use, unless told otherwise
+DEFAULT_PASSWORD_POLICY = PasswordPolicy()
+
+
+def create_password(special_character: bool = False,
+                    characters: int = 32,
+                    policy: PasswordPolicy = None) -> str:
     """
     Generate a 32 (or more) alphanumeric password with at least one lowercase
-    character, one uppercase character, and three digits:
-    https://docs.python.org/3/library/secrets.html#recipes-and-best-practices
+    character, one uppercase character, and three digits, or whatever the
+    optional PasswordPolicy, policy, asks for instead.
 
-    Takes optional special_character bool. If true, sets a random character in
-    the password string to . (period).
+    Takes optional special_character bool. If true, the password also has at
+    least one of the policy's special characters, which is . (period) by
+    default.
 
     returns password str
     """
-    alphabet = string.ascii_letters + string.digits
-    while True:
-        password = ''.join(secrets.choice(alphabet) for i in range(characters))
-        if (any(c.islower() for c in password)
-                and any(c.isupper() for c in password)
-                and sum(c.isdigit() for c in password) >= 3):
-            break
-
-    # if special character requested in the password, we'll replace a random
-    # random character in the password string with periods
-    if special_character:
-        random_number = randrange(0,31)
-        replace_character = password[random_number]
-        password = password.replace(replace_character, '.')
-
-    return password
+    if not policy:
+        policy = DEFAULT_PASSWORD_POLICY.replace(length=characters)
+
+    if special_character and not policy.special:
+        policy = policy.replace(special=True)
+
+    return policy.generate()
@@ -3,13 +3,14 @@ Using Textualize's rich library to pretty print subprocess outputs,
 so during long running commands, the user isn't wondering what's going on,
 even if you don't actually output anything from stdout/stderr of the command.
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging as log
 from subprocess import Popen, PIPE
 import re
 from rich.console import Console
 from rich.markup import MarkupError
 from rich.theme import Theme
-from rich.progress import Progress
+from rich.progress import Progress, SpinnerColumn, TextColumn
 from time import sleep
 
 
@@ -34,6 +35,31 @@ def basic_syntax(bash_string: str):
         return bash_string
 
 
+def status_line(cmd: str, quiet: bool = False) -> str:
+    """
+    returns a rich formatted line describing the command we're about to run.
+    Truncates anything after the word password and hides the arguments
+    entirely if quiet is True
+    """
+    # do some very basic syntax highlighting
+    printed_cmd = basic_syntax(cmd)
+    if not quiet:
+        line = "[green] Running:[/green] "
+
+        # make sure I'm not about to print a password, oof
+        if 'password' not in cmd.lower():
+            line += printed_cmd
+        else:
+            line += printed_cmd.split('assword')[0] + \
+                'assword[warn]:warning: TRUNCATED'
+    else:
+        cmd_parts = printed_cmd.split(' ')
+        msg = '[green]Running [i]secret[/i] command:[b] ' + cmd_parts[0]
+        line = " ".join([msg, cmd_parts[1], '[dim]...'])
+
+    return line
+
+
 def subproc(commands: list, **kwargs):
     """
     Takes a list of command strings to run in subprocess
@@ -45,42 +71,38 @@ def subproc(commands: list, **kwargs):
         cwd             - path to run commands in. Default: pwd of user
         shell           - use shell with subprocess or not. Default: False
         env             - dictionary of env variables for BASH. Default: None
+        parallel        - run the commands concurrently, because they don't
+                          depend on each other. Returns a list of outputs in
+                          the same order as commands. A command can also be
+                          a list of commands, which run in order, one at a
+                          time, and get a list of outputs. Default: False
+        max_workers     - max commands to run at once if parallel is True.
+                          Default: 4
     """
     # get/set defaults and remove the 2 output specific args from the key word
     # args dict so we can use the rest to pass into subproc.Popen later on
     spinner = kwargs.pop('spinner', True)
     quiet = kwargs.get('quiet', False)
+    parallel = kwargs.pop('parallel', False)
+    max_workers = kwargs.pop('max_workers', 4)
+
+    if parallel:
+        return subproc_parallel(commands, max_workers, spinner, **kwargs)
 
     if spinner:
         # only need this if we're doing a progress spinner
         console = Console()
 
     for cmd in commands:
-
-        # do some very basic syntax highlighting
-        printed_cmd = basic_syntax(cmd)
-        if not quiet:
-            status_line = "[green] Running:[/green] "
-
-            # make sure I'm not about to print a password, oof
-            if 'password' not in cmd.lower():
-                status_line += printed_cmd
-            else:
-                status_line += printed_cmd.split('assword')[0] + \
-                    'assword[warn]:warning: TRUNCATED'
-        else:
-            cmd_parts = printed_cmd.split(' ')
-            msg = '[green]Running [i]secret[/i] command:[b] ' + cmd_parts[0]
-            status_line = " ".join([msg, cmd_parts[1], '[dim]...'])
-        status_line += '\n'
+        line = status_line(cmd, quiet) + '\n'
 
         # Sometimes we need to not use a little loading bar
         if not spinner:
-            log.info(status_line, extra={"markup": True})
+            log.info(line, extra={"markup": True})
             output = run_subprocess(cmd, **kwargs)
         else:
             log.debug(cmd)
-            with console.status(status_line,
+            with console.status(line,
                                 spinner='aesthetic',
                                 speed=0.75) as status:
                 output = run_subprocess(cmd, **kwargs)
@@ -88,6 +110,98 @@ def subproc(commands: list, **kwargs):
     return output
 
 
+def subproc_parallel(commands: list,
+                     max_workers: int = 4,
+                     spinner: bool = True,
+                     **kwargs) -> list:
+    """
+    Takes a list of independent command strings and runs them on a bounded
+    pool of threads, each one still using run_subprocess. Any item in commands
+    can also be a list of command strings, a group that depends on its own
+    order, e.g. unsealing one pod with each key share. A group runs one
+    command at a time in a single thread, and stops at its first failure,
+    unless error_ok is True.
+
+    Returns a list of outputs in the same order as the commands passed in,
+    with a list of outputs for each group. If error_ok is False, waits for
+    every command to finish and then raises one Exception with the errors of
+    all the failed commands. If error_ok is True, the failed command's error
+    is returned in its place in the list.
+
+    Accepts the same keyword args as subproc, except for parallel.
+    """
+    quiet = kwargs.get('quiet', False)
+    error_ok = kwargs.get('error_ok', False)
+    results = [None] * len(commands)
+    errors = {}
+
+    if not commands:
+        return results
+
+    with Progress(SpinnerColumn(spinner_name='aesthetic', speed=0.75),
+                  TextColumn("{task.description}"),
+                  disable=not spinner) as progress:
+
+        def run_group(group: list) -> list:
+            """
+            runs each (cmd, task, line) of a group in order, updating its
+            spinner row, and returns the outputs up to the first failure
+            """
+            outputs = []
+            for cmd, task, line in group:
+                try:
+                    outputs.append(run_subprocess(cmd, **kwargs.copy()))
+                except Exception as e:
+                    errors[cmd] = str(e)
+                    outputs.append(str(e))
+                    done_line = line.replace("[green] Running:[/green]",
+                                             "[red] Failed:[/red]", 1)
+                    progress.update(task, description=done_line, completed=1)
+                    # skip the rest of this group, since it depends on order
+                    for _, skipped_task, skipped_line in group[len(outputs):]:
+                        skipped_line = skipped_line.replace(
+                                "[green] Running:[/green]", "[dim] Skipped:[/dim]", 1)
+                        progress.update(skipped_task, description=skipped_line,
+                                        completed=1)
+                    break
+                done_line = line.replace("[green] Running:[/green]",
+                                         "[green] Finished:[/green]", 1)
+                progress.update(task, description=done_line, completed=1)
+            return outputs
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for index, cmds in enumerate(commands):
+                group = []
+                for cmd in ([cmds] if isinstance(cmds, str) else cmds):
+                    line = status_line(cmd, quiet)
+                    log.debug(cmd)
+                    if not spinner:
+                        log.info(line, extra={"markup": True})
+
+                    # each command gets it's own spinner row
+                    group.append((cmd, progress.add_task(line, total=1), line))
+
+                futures[executor.submit(run_group, group)] = index
+
+            for future in as_completed(futures):
+                index = futures[future]
+                outputs = future.result()
+                results[index] = outputs[0] if isinstance(commands[index], str) else outputs
+
+    if errors:
+        err = "\n".join([f"{cmd}: {e}" for cmd, e in errors.items()])
+        num_commands = sum(1 if isinstance(cmds, str) else len(cmds)
+                           for cmds in commands)
+        if error_ok:
+            log.error(err)
+        else:
+            raise Exception(f"{len(errors)} of {num_commands} commands "
+                            f"failed:\n{err}")
+
+    return results
+
+
 def run_subprocess(command: str, decode_ascii: bool = False, **kwargs):
     """
     Takes a str commmand to run in BASH in a subprocess.